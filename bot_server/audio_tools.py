@@ -0,0 +1,386 @@
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import os
+import time
+import wave
+from collections import deque
+from typing import AsyncIterator, List, Tuple, Union
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Sample rate STT expects: 16 kHz, mono, 16-bit
+STT_SAMPLE_RATE = 16000
+# 100 ms of 16 kHz mono 16-bit audio
+PCM_CHUNK_BYTES = 3200
+# EBU R128 loudness for reference voices, so quiet and loud recordings clone alike
+LOUDNORM_FILTER = 'loudnorm=I=-16:TP=-1.5:LRA=11'
+
+
+class TranscodeError(Exception):
+    """Raised when ffmpeg can't convert the audio"""
+
+
+class AudioRejected(Exception):
+    """Raised when audio fails a check made from its header, the message says why"""
+
+
+class AudioBusy(Exception):
+    """Raised by AudioPool when all workers are busy and the wait queue is full"""
+
+
+class AudioPool:
+    """
+    Limits how many ffmpeg conversions run at once, one per CPU by default,
+    so a burst of voice messages doesn't starve the server of cores.
+    At most max_queue callers wait for a free worker, further ones get
+    AudioBusy right away.
+    """
+
+    def __init__(self, workers: int = None, max_queue: int = 32):
+        self.workers = workers or os.cpu_count() or 4
+        self.max_queue = max_queue
+        self._slots = None
+        self.running = 0
+        self.waiting = 0
+        self.completed = 0
+        self.rejected = 0
+        self._waits = deque(maxlen=1000)
+        self._encodes = deque(maxlen=1000)
+
+    def full(self) -> bool:
+        return self.running >= self.workers and self.waiting >= self.max_queue
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """Holds one worker for the duration of the block"""
+        if self.full():
+            self.rejected += 1
+            raise AudioBusy(f"All {self.workers} audio workers busy, {self.waiting} conversions waiting")
+        if self._slots is None:
+            # Created here so the semaphore binds to the server's event loop
+            self._slots = asyncio.Semaphore(self.workers)
+        queued = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        started = time.perf_counter()
+        self._waits.append(started - queued)
+        self.running += 1
+        try:
+            yield
+        finally:
+            self.running -= 1
+            self._slots.release()
+            self._encodes.append(time.perf_counter() - started)
+            self.completed += 1
+
+    async def run(self, func, *args, **kwargs):
+        """Awaits func(*args, **kwargs) in a worker slot"""
+        async with self.slot():
+            return await func(*args, **kwargs)
+
+    async def read_ahead(self, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        """
+        Takes a worker for a decoding stream and returns its chunks as they
+        come. The stream is read ahead into memory, so the worker is free
+        once decoding is done, however slowly the chunks are consumed.
+        Raises AudioBusy right away like slot().
+        """
+        stack = contextlib.AsyncExitStack()
+        await stack.enter_async_context(self.slot())
+        buffer = asyncio.Queue()
+
+        async def produce():
+            try:
+                async for chunk in chunks:
+                    buffer.put_nowait(chunk)
+                buffer.put_nowait(None)
+            except Exception as e:
+                buffer.put_nowait(e)
+            finally:
+                await stack.aclose()
+
+        producer = asyncio.create_task(produce())
+
+        async def consume():
+            try:
+                while True:
+                    item = await buffer.get()
+                    if item is None:
+                        return
+                    if isinstance(item, Exception):
+                        raise item
+                    yield item
+            finally:
+                producer.cancel()
+                await asyncio.gather(producer, return_exceptions=True)
+
+        return consume()
+
+    def stats(self) -> dict:
+        stats = {
+            'workers': self.workers,
+            'running': self.running,
+            'waiting': self.waiting,
+            'max_queue': self.max_queue,
+            'completed': self.completed,
+            'rejected': self.rejected
+        }
+        for name, values in (('wait', self._waits), ('encode', self._encodes)):
+            values = sorted(values)
+            stats[f'{name}_avg_sec'] = round(sum(values) / len(values), 3) if values else 0.0
+            stats[f'{name}_p95_sec'] = round(values[int(0.95 * (len(values) - 1))], 3) if values else 0.0
+            stats[f'{name}_max_sec'] = round(values[-1], 3) if values else 0.0
+        return stats
+
+
+async def transcode(source: Union[str, bytes], output_args: List[str]) -> bytes:
+    """
+    Converts audio with a single ffmpeg process, stdin to stdout.
+    source is the input as bytes or a path, output_args the ffmpeg output options.
+    """
+    # Bytes are piped to stdin, a path is read by ffmpeg itself
+    piped = isinstance(source, (bytes, bytearray))
+    process = await asyncio.create_subprocess_exec(
+        'ffmpeg', '-loglevel', 'error',
+        '-i', 'pipe:0' if piped else source,
+        *output_args,
+        'pipe:1',
+        stdin=asyncio.subprocess.PIPE if piped else asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = await process.communicate(source if piped else None)
+    if process.returncode != 0:
+        raise TranscodeError(f"ffmpeg exited with {process.returncode}: {stderr.decode(errors='replace').strip()}")
+    return stdout
+
+
+def pcm_to_wav(pcm: bytes, sample_rate: int = STT_SAMPLE_RATE) -> bytes:
+    """Wraps mono 16-bit PCM in a WAV header"""
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(pcm)
+    return buffer.getvalue()
+
+
+async def to_wav(source: Union[str, bytes], sample_rate: int = STT_SAMPLE_RATE) -> bytes:
+    """
+    Convert audio to WAV with 16kHz sample rate, mono channel, and 16-bit depth.
+    Returns the WAV file contents.
+    """
+    # ffmpeg can't seek back into a pipe to fill in the WAV sizes, so it
+    # writes raw PCM and the header is added here
+    pcm = await transcode(source, ['-f', 's16le', '-acodec', 'pcm_s16le', '-ac', '1', '-ar', str(sample_rate)])
+    return pcm_to_wav(pcm, sample_rate)
+
+
+async def wav_to_ogg(wav: bytes) -> bytes:
+    """Convert WAV to OGG with the OPUS codec Telegram voice notes use"""
+    return await transcode(wav, ['-acodec', 'libopus', '-strict', '-2', '-f', 'ogg'])
+
+
+async def probe(path: str) -> dict:
+    """
+    Duration, sample rate and size of an audio file, read by ffprobe from the
+    container header without decoding. Values the header lacks are None.
+    """
+    process = await asyncio.create_subprocess_exec(
+        'ffprobe', '-v', 'error',
+        '-select_streams', 'a:0',
+        '-show_entries', 'format=duration,size:stream=sample_rate,channels',
+        '-of', 'json',
+        path,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    stdout, _ = await process.communicate()
+    if process.returncode != 0:
+        raise AudioRejected("it is not an audio format I can read")
+    info = json.loads(stdout or b'{}')
+    streams = info.get('streams') or []
+    if not streams:
+        raise AudioRejected("it has no audio track")
+    header = info.get('format') or {}
+
+    def number(value, kind):
+        try:
+            return kind(value)
+        except (TypeError, ValueError):
+            return None
+
+    return {
+        'duration': number(header.get('duration'), float),
+        'size': number(header.get('size'), int) or os.path.getsize(path),
+        'sample_rate': number(streams[0].get('sample_rate'), int),
+        'channels': number(streams[0].get('channels'), int)
+    }
+
+
+async def prepare_reference(path: str, max_seconds: float = 30.0, min_seconds: float = 3.0,
+                            min_sample_rate: int = 16000, max_bytes: int = 20 * 2 ** 20,
+                            sample_rate: int = STT_SAMPLE_RATE) -> bytes:
+    """
+    Checks a reference voice recording from its header, then decodes at most
+    max_seconds of it, loudness normalized, to WAV in a single ffmpeg pass.
+    Raises AudioRejected for files that are too large, too short or too
+    low quality, before any of them is decoded.
+    """
+    info = await probe(path)
+    if info['size'] > max_bytes:
+        raise AudioRejected(f"it is larger than {max_bytes / 2 ** 20:g} MB")
+    if info['duration'] is not None and info['duration'] < min_seconds:
+        raise AudioRejected(f"it is shorter than {min_seconds:g} seconds")
+    if info['sample_rate'] is not None and info['sample_rate'] < min_sample_rate:
+        raise AudioRejected(f"its sample rate is below {min_sample_rate} Hz")
+    # -t as an output option stops decoding at max_seconds, however long the file is
+    pcm = await transcode(path, [
+        '-t', str(max_seconds),
+        '-af', LOUDNORM_FILTER,
+        '-f', 's16le', '-acodec', 'pcm_s16le', '-ac', '1', '-ar', str(sample_rate)
+    ])
+    logger.info(f"Reference voice: {info}, kept {len(pcm) / 2 / sample_rate:.1f} s")
+    return pcm_to_wav(pcm, sample_rate)
+
+
+async def stream_pcm(input_path: str, sample_rate: int = STT_SAMPLE_RATE, chunk_size: int = PCM_CHUNK_BYTES) -> AsyncIterator[bytes]:
+    """
+    Decode any audio file ffmpeg can read into raw mono 16-bit PCM and yield
+    it in chunks while ffmpeg is still decoding.
+    """
+    process = await asyncio.create_subprocess_exec(
+        'ffmpeg', '-nostdin', '-loglevel', 'error',
+        '-i', input_path,
+        '-f', 's16le', '-acodec', 'pcm_s16le', '-ac', '1', '-ar', str(sample_rate),
+        'pipe:1',
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        while True:
+            chunk = await process.stdout.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+        stderr = await process.stderr.read()
+        if await process.wait() != 0:
+            raise TranscodeError(f"ffmpeg failed to decode {input_path}: {stderr.decode(errors='replace').strip()}")
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+
+
+def concatenate_wavs(chunks: List[bytes]) -> bytes:
+    """Join WAV files with identical parameters, given and returned as bytes"""
+    frames = []
+    params = None
+    for chunk in chunks:
+        with wave.open(io.BytesIO(chunk), 'rb') as f:
+            params = params or f.getparams()
+            frames.append(f.readframes(f.getnframes()))
+
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as f:
+        f.setparams(params)
+        for frame in frames:
+            f.writeframes(frame)
+    return buffer.getvalue()
+
+
+def wav_samples(wav: bytes) -> Tuple[np.ndarray, int]:
+    """Samples of a mono 16-bit WAV file as an int16 array, and its sample rate"""
+    with wave.open(io.BytesIO(wav), 'rb') as f:
+        if f.getnchannels() != 1 or f.getsampwidth() != 2:
+            raise ValueError("Expected mono 16-bit WAV")
+        return np.frombuffer(f.readframes(f.getnframes()), dtype='<i2'), f.getframerate()
+
+
+def frame_levels(samples: np.ndarray, frame: int) -> np.ndarray:
+    """RMS level of each frame of `frame` samples in dBFS, the last frame padded with silence"""
+    count = -(-len(samples) // frame)
+    padded = np.zeros(count * frame, dtype=np.float32)
+    padded[:len(samples)] = samples
+    rms = np.sqrt(np.mean((padded.reshape(count, frame) / 32768.0) ** 2, axis=1))
+    return 20 * np.log10(rms + 1e-10)
+
+
+def split_speech(wav: bytes, max_seconds: float = 55.0, threshold_db: float = -45.0,
+                 min_pause: float = 0.3, padding: float = 0.2, frame_ms: int = 30) -> List[bytes]:
+    """
+    Energy based voice activity detection: drops leading and trailing
+    silence, shortens pauses to min_pause and splits the speech at pauses
+    into WAV chunks of at most max_seconds. Speech without a pause that
+    long is cut at its quietest frame. Returns no chunks for silence.
+    """
+    samples, sample_rate = wav_samples(wav)
+    frame = sample_rate * frame_ms // 1000
+    if not len(samples):
+        return []
+    levels = frame_levels(samples, frame)
+    voiced = levels > threshold_db
+    if not voiced.any():
+        return []
+    # Keep a little audio around speech so word edges aren't clipped
+    pad = int(padding * 1000 / frame_ms)
+    if pad:
+        voiced = np.convolve(voiced, np.ones(2 * pad + 1), mode='same') > 0
+    # Runs of voiced frames as [start, end) frame indexes
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], voiced.astype(np.int8), [0]))))
+    runs = edges.reshape(-1, 2).tolist()
+
+    # Pauses shorter than min_pause belong to the speech around them
+    gap = max(1, int(min_pause * 1000 / frame_ms))
+    segments = [runs[0]]
+    for start, end in runs[1:]:
+        if start - segments[-1][1] < gap:
+            segments[-1][1] = end
+        else:
+            segments.append([start, end])
+
+    max_frames = max(2, int(max_seconds * 1000 / frame_ms) - gap)
+    pieces = []
+    for start, end in segments:
+        while end - start > max_frames:
+            # The quietest frame in the second half, the latest one on ties
+            window = levels[start + max_frames // 2:start + max_frames]
+            cut = start + max_frames // 2 + len(window) - 1 - int(np.argmin(window[::-1]))
+            pieces.append((start, cut))
+            start = cut
+        pieces.append((start, end))
+
+    # Consecutive pieces share a chunk while it stays under max_seconds
+    chunks = [[pieces[0]]]
+    length = pieces[0][1] - pieces[0][0]
+    for start, end in pieces[1:]:
+        size = end - start + gap
+        if length + size > max_frames:
+            chunks.append([])
+            length = 0
+        chunks[-1].append((start, end))
+        length += size
+
+    result = []
+    previous_end = 0
+    for chunk in chunks:
+        parts = []
+        for i, (start, end) in enumerate(chunk):
+            # Up to min_pause of the silence before a piece stays in the chunk
+            first = max(previous_end, start - gap) if i else start
+            parts.append(samples[first * frame:end * frame])
+            previous_end = end
+        result.append(pcm_to_wav(np.concatenate(parts).tobytes(), sample_rate))
+    kept = sum(len(chunk) for chunk in result) / 2 / sample_rate
+    logger.info(f"VAD kept {kept:.1f} of {len(samples) / sample_rate:.1f} s of audio in {len(result)} chunks")
+    return result
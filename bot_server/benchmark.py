@@ -0,0 +1,1636 @@
+"""
+Benchmarks for the bot server.
+
+concurrency: drives /message in-process with fake Telegram, LLM and TTS
+backends and reports how latency grows with the number of concurrent
+conversations on a single worker. --blocking makes the fakes block the
+event loop the way synchronous clients do, which reproduces the server
+behaviour before the async pipeline.
+
+turns: runs text and voice turns for one user and checks that each turn
+makes exactly one LLM completion and adds exactly one history entry, and
+that /metrics exports a latency histogram for every stage of a voice turn.
+
+history: fills a HistoryStore with many users and deep histories, then
+times appends and reads of the recent window. --legacy times the same reads
+against the old one-JSON-file-per-turn layout for comparison.
+
+transcode: converts a voice note to 16 kHz WAV and a TTS-sized WAV to
+OGG/OPUS the way a voice turn does, in a child process per mode, and reports
+latency and peak RSS (server process and ffmpeg) per conversion. --legacy
+also runs the old pydub path through data/<uuid>/ temp files. Needs ffmpeg.
+
+audio: sends a burst of conversions at an AudioPool with a fake ffmpeg
+encode, checks that callers beyond the workers and the wait queue are
+turned away immediately and reports queue wait and encode times.
+
+config: times the per-request config lookups of a voice turn (allow list
+check and supported languages) from ConfigStore against re-reading
+data/users.txt and BCP-47.txt, and checks that an edited file is picked up.
+
+speech: repeats the same reply for one user in both TTS_STREAM_MODEs and
+checks that only the first turn synthesizes and uploads audio, that
+later turns resend the cached note by Telegram file_id, and that uploading
+a new reference voice invalidates the user's cached notes.
+
+telegram: sends a burst of replies to many chats and a run of replies to
+one chat through TelegramClient against a stub Bot API server enforcing
+Telegram's flood limits, first with limits and retries off, then with them
+on, and checks that no reply fails. Also compares pooled connections with
+a new connection per call.
+
+vad: trims and splits a long synthetic voice message with the energy VAD
+and compares billed audio seconds and recognition time of the whole
+message against its chunks transcribed in parallel by a fake STT backend
+whose latency grows with the audio length.
+
+languages: recognizes voice messages of one user who speaks one language,
+then switches to another, with a fake STT backend that gets slower with
+every language asked for and is unsure when the spoken one is missing.
+Checks that the profile narrows recognition to the spoken language, falls
+back to all languages after the switch and is reloaded from disk.
+
+reference: prepares a long reference voice recording the way an uploaded
+audio document is, and compares it with decoding the whole file. Checks
+that it is cut to REFERENCE_MAX_SECONDS and that short, low sample rate
+and non-audio files are rejected from their header. Needs ffmpeg.
+
+workers: starts several processes that each run a job queue over one
+shared history directory and send turns for the same user, the way
+`uvicorn --workers N` does. Every turn reads the history, then appends how
+many turns it saw. Checks that the log has every turn, parses line by line
+and that no two turns saw the same history. --no-locks runs the processes
+without USER_LOCKS and shared history for comparison.
+
+tracing: runs text turns through a LangChain fake chat model with
+tracing off, sampled and full, against a LangSmith stand-in that is slow to
+accept runs, and reports the added time per turn. Checks that failed turns
+are always exported, and that a full export queue drops traces instead of
+slowing turns down.
+
+startup: imports server.py in a fresh process and times the import, the
+background model loading and warmup until /ready answers 200, and the
+first turn after that; --no-warmup skips opening the outbound connections.
+Also lists the slowest imports left at import time. --history appends the
+results to a JSONL file, with the git commit, to track them over time.
+
+llm_cache: sends a mix of common questions, with and without history,
+and unique ones from many users through the completion cache, with a
+fake chat model of configurable latency, and reports LLM calls, saved
+LLM seconds and tokens. Checks that "/fresh" skips the cache, that
+entries expire after LLM_CACHE_TTL and that the disk tier answers a new
+process.
+
+janitor: fills a scratch data/ with what failed requests leave behind
+(old data/<uuid>/ directories, speech_<uuid>.wav and *.tmp files, idle lock
+files), expired cached answers, legacy per-turn histories, logs with a
+long pruned prefix, histories over USER_QUOTA_MB and many small users,
+then sweeps it while turns run. Checks that only old leftovers and unheld
+locks are removed, that every user is under the quota and every history
+still reads, and that the report adds up. A second sweep with
+DATA_QUOTA_MB evicts the caches first, then clears the least recently
+active users, and a third is skipped while another process sweeps.
+
+load: drives /message with a mix of text and voice updates from many
+users, through the real Telegram and TTS clients against a stub Bot API
+server on :8081 and a stub TTS server, with a fake STT backend and chat
+model of configurable latency. Reports p50/p95/p99 latency per message
+type, turns per second and RSS.
+
+progress: runs voice turns against a fake Telegram with slow edits and
+checks that progress edits stay within one per PROGRESS_INTERVAL per chat,
+that every turn still ends with its Done edit, also when editMessageText
+answers 429 with retry_after, and that the turn never waits for an edit.
+
+tts: runs TTSClient and AsyncTTSClient against a local stub TTS server
+that fails every Nth request, checks that retries recover every request
+and compares pooled connections with a new connection per request.
+
+Usage:
+    python benchmark.py tts [--requests 200] [--fail-every 10]
+    python benchmark.py concurrency [--blocking] [--levels 1,2,4,8,16,32]
+    python benchmark.py turns [--turns 5] [--workers 1]
+    python benchmark.py history [--users 10000] [--turns 50] [--legacy]
+    python benchmark.py transcode [--conversions 20] [--seconds 30] [--legacy]
+    python benchmark.py audio [--burst 100] [--workers 4] [--queue 16]
+    python benchmark.py config [--requests 100000] [--users 10000]
+    python benchmark.py speech [--turns 5]
+    python benchmark.py progress [--turns 3] [--interval 1.0]
+    python benchmark.py vad [--seconds 180] [--chunk-seconds 55]
+    python benchmark.py languages [--messages 10]
+    python benchmark.py reference [--seconds 600] [--max-seconds 30]
+    python benchmark.py load [--users 50] [--concurrency 20] [--turns 3] [--voice-ratio 0.5]
+    python benchmark.py telegram [--chats 50] [--messages 3] [--hot-messages 8]
+    python benchmark.py workers [--processes 4] [--turns 25] [--no-locks]
+    python benchmark.py tracing [--turns 200] [--sample-rate 0.1] [--collector-latency 0.05]
+    python benchmark.py startup [--runs 3] [--no-warmup] [--history startup_times.jsonl]
+    python benchmark.py llm_cache [--users 50] [--common 5] [--llm-latency 0.2]
+    python benchmark.py janitor [--users 500] [--orphans 50] [--quota-kb 64]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from fakes import document_update, text_update, voice_update
+
+BOT_SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_server(**settings):
+    """Import server.py from a scratch directory with a dummy config plus settings"""
+    os.chdir(scratch_dir(**settings))
+    sys.path.insert(0, BOT_SERVER_DIR)
+    import server
+    return server
+
+
+def scratch_dir(**settings):
+    """A directory with a dummy config.json plus settings, and the files server.py reads"""
+    workdir = tempfile.mkdtemp(prefix='echobridge_bench_')
+    os.makedirs(os.path.join(workdir, 'data'), exist_ok=True)
+    with open(os.path.join(workdir, 'config.json'), 'w') as f:
+        json.dump({
+            "TOKEN": "bench",
+            "OPENAI_API_KEY": "bench",
+            "LANGSMITH_API_KEY": "bench",
+            "LANGSMITH_PROJECT": "bench",
+            # Keep benchmark runs out of LangSmith and off the network
+            "LANGSMITH_TRACING": False,
+            "WARMUP": False,
+            # Repeated benchmark questions would be answered from the cache
+            "LLM_CACHE": False,
+            **settings
+        }, f)
+    for name in ('BCP-47.txt', 'greeting.txt'):
+        with open(os.path.join(BOT_SERVER_DIR, name)) as src, open(os.path.join(workdir, name), 'w') as dst:
+            dst.write(src.read())
+    return workdir
+
+
+def percentile(values, q):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))
+    return values[index]
+
+
+async def run_level(server, client, concurrency, turn):
+    """Run one turn for each of `concurrency` users at once, return latencies"""
+    base_id = turn * 100000
+
+    async def conversation(user_id):
+        start = time.perf_counter()
+        response = await client.post('/message', json=text_update(user_id, base_id + user_id, "Hello!"))
+        response.raise_for_status()
+        await server.bot.wait_reply(user_id)
+        return time.perf_counter() - start
+
+    started = time.perf_counter()
+    latencies = await asyncio.gather(*[conversation(user_id) for user_id in range(1, concurrency + 1)])
+    return latencies, time.perf_counter() - started
+
+
+async def concurrency_benchmark(args):
+    from fakes import FakeChatModel, FakeTelegram, FakeTTS, fake_wav_to_ogg
+
+    server = load_server()
+    server.wav_to_ogg = fake_wav_to_ogg
+    server.bot = FakeTelegram(latency=args.telegram_latency, blocking=args.blocking)
+    server.llm = FakeChatModel(latency=args.llm_latency, blocking=args.blocking)
+    server.tts = FakeTTS(latency=args.tts_latency, blocking=args.blocking)
+    if args.queue_workers:
+        server.job_queue.workers = args.queue_workers
+
+    single_turn = args.llm_latency + args.tts_latency + args.telegram_latency
+    mode = 'blocking' if args.blocking else 'async'
+    print(f"mode={mode} ideal turn={single_turn:.2f}s")
+    print(f"{'concurrency':>11} {'wall s':>8} {'p50 s':>8} {'p95 s':>8} {'turns/s':>8}")
+
+    supported = 0
+    # ASGITransport does not run lifespan events, start the job queue by hand
+    await server.startup()
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+        for turn, concurrency in enumerate(args.levels):
+            latencies, wall = await run_level(server, client, concurrency, turn)
+            p95 = percentile(latencies, 95)
+            print(f"{concurrency:>11} {wall:>8.2f} {statistics.median(latencies):>8.2f} "
+                  f"{p95:>8.2f} {concurrency / wall:>8.2f}")
+            if p95 <= single_turn * args.slowdown:
+                supported = concurrency
+    print(f"Queue: {server.job_queue.stats()}")
+    await server.shutdown()
+    print(f"Concurrent conversations within {args.slowdown}x of an idle turn: {supported}")
+
+
+async def turns_benchmark(args):
+    from fakes import FakeChatModel, FakeTelegram, FakeTTS, FakeSTT, fake_to_wav, fake_wav_to_ogg, fake_stream_pcm, write_silence
+
+    server = load_server(WORKERS=args.workers)
+    server.bot = FakeTelegram(latency=0)
+    server.llm = FakeChatModel(latency=0)
+    server.tts = FakeTTS(latency=0)
+    server.stt = FakeSTT(latency=0)
+    server.to_wav = fake_to_wav
+    server.wav_to_ogg = fake_wav_to_ogg
+    server.stream_pcm = fake_stream_pcm
+    voice_file = write_silence('data/voice.wav')
+
+    await server.startup()
+    transport = httpx.ASGITransport(app=server.app)
+    ok = True
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+        for kind, user_id in (('text', 1), ('voice', 2), ('voice-stream', 3)):
+            server.STT_STREAMING = kind == 'voice-stream'
+            calls_before = server.llm.calls
+            for message_id in range(1, args.turns + 1):
+                if kind == 'text':
+                    update = text_update(user_id, message_id, "Hello!")
+                else:
+                    update = voice_update(user_id, message_id, voice_file)
+                (await client.post('/message', json=update)).raise_for_status()
+                await server.bot.wait_reply(user_id)
+            # History is written after the reply went out
+            await drain(server)
+            llm_calls = server.llm.calls - calls_before
+            history_entries = len(server.get_chat_history(str(user_id))) // 2
+            print(f"{kind:>5}: {args.turns} turns, {llm_calls} LLM calls, {history_entries} history entries")
+            ok = ok and llm_calls == args.turns and history_entries == args.turns
+        metrics = (await client.get('/metrics')).text
+    # Every stage a voice turn goes through has a histogram
+    for stage in ('fetch', 'transcode', 'vad', 'stt', 'history_load', 'llm', 'tts', 'encode', 'upload', 'history_write'):
+        found = f'stage="{stage}",type="voice"' in metrics
+        print(f"{stage:>13}: {'exported' if found else 'missing'} in /metrics")
+        ok = ok and found
+    await server.shutdown()
+    if not ok:
+        sys.exit("Expected exactly one LLM call and one history entry per turn, and all stages in /metrics")
+
+
+def legacy_read(user_dir):
+    """The pre-JSONL get_chat_history: list, stat and parse every turn file"""
+    files = []
+    for name in os.listdir(user_dir):
+        if name.endswith('.json'):
+            filepath = os.path.join(user_dir, name)
+            files.append((filepath, os.path.getctime(filepath)))
+    files.sort(key=lambda x: x[1])
+    history = []
+    for filepath, _ in files:
+        with open(filepath, 'r', encoding='utf-8') as f:
+            message_data = json.load(f)
+            history.extend([("user", message_data['user']), ("assistant", message_data['assistant'])])
+    return history
+
+
+def report(name, durations):
+    print(f"{name:>14}: {len(durations)} ops, {len(durations) / sum(durations):>9.0f} ops/s, "
+          f"p50 {statistics.median(durations) * 1e6:>7.0f} us, p99 {percentile(durations, 99) * 1e6:>7.0f} us")
+
+
+def history_benchmark(args):
+    sys.path.insert(0, BOT_SERVER_DIR)
+    from history_tools import HistoryStore
+
+    root = tempfile.mkdtemp(prefix='echobridge_history_')
+    store = HistoryStore(os.path.join(root, 'users'), max_tokens=args.max_tokens)
+    users = [str(user_id) for user_id in range(args.users)]
+    turn = [("user", "q" * args.turn_chars), ("assistant", "a" * args.turn_chars)]
+
+    started = time.perf_counter()
+    for message_id in range(args.turns):
+        for user_id in users:
+            store.append(user_id, message_id, turn)
+    fill = time.perf_counter() - started
+    print(f"Filled {args.users} users x {args.turns} turns in {fill:.1f}s")
+
+    # A fresh store measures reads that hit the disk index, not warm memory
+    store = HistoryStore(os.path.join(root, 'users'), max_tokens=args.max_tokens)
+    sample = random.sample(users, min(args.samples, len(users)))
+    appends, cold_reads, warm_reads = [], [], []
+    for user_id in sample:
+        started = time.perf_counter()
+        store.read(user_id)
+        cold_reads.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        store.append(user_id, args.turns, turn)
+        appends.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        store.read(user_id)
+        warm_reads.append(time.perf_counter() - started)
+    report('read (cold)', cold_reads)
+    report('append', appends)
+    report('read', warm_reads)
+
+    files = sum(len(names) for _, _, names in os.walk(root))
+    size = sum(os.path.getsize(os.path.join(d, n)) for d, _, names in os.walk(root) for n in names)
+    print(f"{files} files, {size / 2 ** 20:.1f} MiB on disk")
+
+    if args.legacy:
+        legacy_root = os.path.join(root, 'legacy')
+        for user_id in sample:
+            user_dir = os.path.join(legacy_root, user_id)
+            os.makedirs(user_dir)
+            for message_id in range(args.turns):
+                with open(os.path.join(user_dir, f"20250101_000000_{message_id}.json"), 'w') as f:
+                    json.dump({"user": turn[0][1], "assistant": turn[1][1]}, f)
+        legacy_reads = []
+        for user_id in sample:
+            started = time.perf_counter()
+            legacy_read(os.path.join(legacy_root, user_id))
+            legacy_reads.append(time.perf_counter() - started)
+        report('legacy read', legacy_reads)
+
+
+def legacy_round_trip(voice_path, speech_path):
+    """The pre-pipe conversions: pydub decode and export through data/<uuid>/ files"""
+    import uuid
+    from pydub import AudioSegment
+
+    output_dir = f'data/{uuid.uuid4()}'
+    os.makedirs(output_dir)
+    wav_path = os.path.join(output_dir, 'audio.wav')
+    audio = AudioSegment.from_file(voice_path).set_frame_rate(16000).set_channels(1).set_sample_width(2)
+    audio.export(wav_path, format="wav", parameters=["-acodec", "pcm_s16le"])
+    with open(wav_path, 'rb') as f:
+        f.read()
+    os.remove(wav_path)
+    os.rmdir(output_dir)
+
+    ogg_path = os.path.join('data', f'speech_{uuid.uuid4()}.ogg')
+    AudioSegment.from_wav(speech_path).export(ogg_path, format="ogg", codec="libopus", parameters=["-strict", "-2"])
+    with open(ogg_path, 'rb') as f:
+        f.read()
+    os.remove(ogg_path)
+
+
+async def pipe_round_trips(voice_path, speech, conversions):
+    """The in-memory conversions: one ffmpeg process each, stdin to stdout"""
+    from audio_tools import to_wav, wav_to_ogg
+
+    latencies = []
+    for _ in range(conversions):
+        started = time.perf_counter()
+        await to_wav(voice_path)
+        await wav_to_ogg(speech)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def transcode_worker(args):
+    """Runs one mode in this process, prints latencies and peak RSS as JSON"""
+    sys.path.insert(0, BOT_SERVER_DIR)
+    os.chdir(args.workdir)
+    voice_path, speech_path = 'voice.ogg', 'speech.wav'
+    with open(speech_path, 'rb') as f:
+        speech = f.read()
+    if args.worker == 'legacy':
+        latencies = []
+        for _ in range(args.conversions):
+            started = time.perf_counter()
+            legacy_round_trip(voice_path, speech_path)
+            latencies.append(time.perf_counter() - started)
+    else:
+        latencies = asyncio.run(pipe_round_trips(voice_path, speech, args.conversions))
+    # ru_maxrss is in KiB on Linux; the children value is the largest ffmpeg
+    print(json.dumps({
+        'latencies': latencies,
+        'server_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'ffmpeg_rss_kib': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    }))
+
+
+def transcode_benchmark(args):
+    if not shutil.which('ffmpeg'):
+        sys.exit("transcode needs ffmpeg on PATH")
+    workdir = tempfile.mkdtemp(prefix='echobridge_transcode_')
+    os.makedirs(os.path.join(workdir, 'data'))
+    # A Telegram-like voice note and a 24 kHz TTS reply of the same length
+    for output, codec_args in (('voice.ogg', ['-ar', '48000', '-c:a', 'libopus']),
+                               ('speech.wav', ['-ar', '24000', '-ac', '1', '-c:a', 'pcm_s16le'])):
+        subprocess.run(
+            ['ffmpeg', '-loglevel', 'error', '-f', 'lavfi', '-i', f'sine=frequency=440:duration={args.seconds}',
+             *codec_args, os.path.join(workdir, output)],
+            check=True
+        )
+
+    modes = ['pipe'] + (['legacy'] if args.legacy else [])
+    print(f"{args.conversions} round trips of {args.seconds}s audio (voice note to WAV, speech WAV to OGG)")
+    for mode in modes:
+        # A fresh process per mode keeps the peak RSS of one mode out of the other
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), 'transcode', '--worker', mode, '--workdir', workdir,
+             '--conversions', str(args.conversions)],
+            check=True, capture_output=True, text=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        latencies = result['latencies']
+        print(f"{mode:>7}: p50 {statistics.median(latencies) * 1e3:>7.1f} ms, "
+              f"p95 {percentile(latencies, 95) * 1e3:>7.1f} ms, "
+              f"peak RSS server {result['server_rss_kib'] / 1024:>6.1f} MiB, "
+              f"ffmpeg {result['ffmpeg_rss_kib'] / 1024:>6.1f} MiB")
+    leftovers = os.listdir(os.path.join(workdir, 'data'))
+    if leftovers:
+        sys.exit(f"Conversions left files behind: {leftovers}")
+
+
+async def audio_benchmark(args):
+    sys.path.insert(0, BOT_SERVER_DIR)
+    from audio_tools import AudioPool, AudioBusy
+
+    pool = AudioPool(workers=args.workers, max_queue=args.queue)
+    rejections = []
+
+    async def conversion():
+        started = time.perf_counter()
+        try:
+            await pool.run(asyncio.sleep, args.encode)
+            return True
+        except AudioBusy:
+            rejections.append(time.perf_counter() - started)
+            return False
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*[conversion() for _ in range(args.burst)])
+    wall = time.perf_counter() - started
+    accepted = sum(results)
+    print(f"burst of {args.burst}: {accepted} converted, {len(rejections)} busy replies in {wall:.2f}s")
+    if rejections:
+        print(f"busy reply after at most {max(rejections) * 1e3:.2f} ms")
+    print(f"Audio: {pool.stats()}")
+    if accepted != min(args.burst, args.workers + args.queue):
+        sys.exit("Expected exactly workers + queue conversions to be admitted")
+
+
+def config_benchmark(args):
+    sys.path.insert(0, BOT_SERVER_DIR)
+    from config_tools import ConfigStore
+
+    os.chdir(tempfile.mkdtemp(prefix='echobridge_config_'))
+    os.makedirs('data')
+    with open('config.json', 'w') as f:
+        json.dump({"TOKEN": "bench"}, f)
+    with open('data/users.txt', 'w') as f:
+        f.write("\n".join(str(user_id) for user_id in range(args.users)))
+    with open(os.path.join(BOT_SERVER_DIR, 'BCP-47.txt')) as src, open('BCP-47.txt', 'w') as dst:
+        dst.write(src.read())
+
+    def legacy_lookup(user_id):
+        with open('data/users.txt') as f:
+            allowed = str(user_id) in f.read().splitlines()
+        with open("BCP-47.txt", "r") as f:
+            languages = [line.strip() for line in f if line.strip()]
+        return allowed, languages
+
+    store = ConfigStore()
+
+    def cached_lookup(user_id):
+        return store.allowed(user_id), store.languages
+
+    for name, lookup in (('legacy', legacy_lookup), ('cached', cached_lookup)):
+        requests = args.requests if name == 'cached' else max(1, args.requests // 100)
+        started = time.perf_counter()
+        for i in range(requests):
+            lookup(i % args.users)
+        elapsed = time.perf_counter() - started
+        print(f"{name:>7}: {elapsed / requests * 1e6:>9.2f} us per request")
+
+    # A new user becomes visible once the file changed and the check interval passed
+    with open('data/users.txt', 'a') as f:
+        f.write(f"\n{args.users}")
+    time.sleep(1.1)
+    if not store.allowed(args.users):
+        sys.exit("Edited users.txt was not reloaded")
+    print(f"Config: {store.stats()}")
+
+
+async def drain(server):
+    """Waits until the job queue has finished every submitted message"""
+    while server.job_queue.depth or server.job_queue.stats()['in_flight']:
+        await asyncio.sleep(0.01)
+
+
+async def speech_benchmark(args):
+    from fakes import FakeChatModel, FakeTelegram, FakeTTS, fake_wav_to_ogg, silence_wav, write_silence
+
+    server = load_server()
+    server.bot = FakeTelegram(latency=0)
+    server.llm = FakeChatModel(latency=0)
+    server.tts = FakeTTS(latency=0)
+    encodes = 0
+    uploads = 0
+
+    async def distinct_reference(path, **limits):
+        # Every upload is a different voice, or users would share cached notes
+        nonlocal uploads
+        uploads += 1
+        return silence_wav(seconds=uploads)
+
+    server.prepare_reference = distinct_reference
+
+    async def counting_wav_to_ogg(wav):
+        nonlocal encodes
+        encodes += 1
+        return await fake_wav_to_ogg(wav)
+
+    server.wav_to_ogg = counting_wav_to_ogg
+    reference = write_silence('data/reference.wav')
+
+    await server.startup()
+    transport = httpx.ASGITransport(app=server.app)
+    ok = True
+    message_id = 0
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+
+        async def turns(user_id, count):
+            nonlocal message_id
+            before = (server.tts.calls, encodes, server.bot.calls['sendVoiceByFileId'])
+            for _ in range(count):
+                message_id += 1
+                (await client.post('/message', json=text_update(user_id, message_id, "Hello!"))).raise_for_status()
+                await drain(server)
+            return (server.tts.calls - before[0], encodes - before[1], server.bot.calls['sendVoiceByFileId'] - before[2])
+
+        for user_id, mode in ((1, 'concat'), (2, 'separate')):
+            server.TTS_STREAM_MODE = mode
+            sentences = len(server.SentenceSplitter().feed(server.llm.reply + ' '))
+            syntheses, encoded, by_file_id = await turns(user_id, args.turns)
+            print(f"{mode:>8}: {args.turns} turns, {syntheses} syntheses, {encoded} encodes, {by_file_id} sent by file_id")
+            # Every sentence once; separate mode resends each sentence, concat the whole reply
+            resent = (args.turns - 1) * (sentences if mode == 'separate' else 1)
+            ok = ok and syntheses == sentences and by_file_id == resent
+            # One encode per note sent: every sentence in separate mode, the joined reply in concat
+            ok = ok and encoded == (sentences if mode == 'separate' else 1)
+
+            message_id += 1
+            (await client.post('/message', json=document_update(user_id, message_id, reference))).raise_for_status()
+            await drain(server)
+            syntheses, encoded, _ = await turns(user_id, 1)
+            print(f"{mode:>8}: after a new reference voice, {syntheses} syntheses, {encoded} encodes")
+            ok = ok and syntheses == sentences and encoded == (sentences if mode == 'separate' else 1)
+    print(f"Speech cache: {server.speech_cache.stats()}")
+    await server.shutdown()
+    if not ok:
+        sys.exit("Expected one synthesis per distinct sentence and voice, one encode per note and file_id reuse for repeats")
+
+
+def tts_benchmark(args):
+    sys.path.insert(0, BOT_SERVER_DIR)
+    from fakes import make_tts_stub, serve_in_thread, write_silence
+    from tts_tools import TTSClient, AsyncTTSClient
+
+    os.chdir(tempfile.mkdtemp(prefix='echobridge_tts_'))
+    # Retries of the injected failures are expected
+    logging.getLogger('tts_tools').setLevel(logging.ERROR)
+    stub = make_tts_stub(latency=args.latency, fail_every=args.fail_every)
+    serve_in_thread(stub, args.port)
+    api_url = f"http://127.0.0.1:{args.port}"
+    reference = write_silence('reference.wav', seconds=5)
+    failures = 0
+
+    def run_sync(client_factory):
+        nonlocal failures
+        started = time.perf_counter()
+        client = client_factory()
+        for i in range(args.requests):
+            if client is None:
+                with TTSClient(api_url, backoff=0.01) as fresh:
+                    path = fresh.generate_speech(f"Request {i}", 'en')
+            else:
+                path = client.generate_speech(f"Request {i}", 'en')
+            if path is None:
+                failures += 1
+            else:
+                os.remove(path)
+        return time.perf_counter() - started
+
+    pooled = run_sync(lambda: TTSClient(api_url, backoff=0.01))
+    fresh = run_sync(lambda: None)
+    print(f"sync pooled:  {args.requests / pooled:8.1f} req/s")
+    print(f"sync fresh:   {args.requests / fresh:8.1f} req/s")
+
+    async def run_async():
+        nonlocal failures
+        client = AsyncTTSClient(api_url, backoff=0.01)
+        started = time.perf_counter()
+        paths = await asyncio.gather(*[client.generate_speech(f"Request {i}", 'en') for i in range(args.requests)])
+        elapsed = time.perf_counter() - started
+        for path in paths:
+            if path is None:
+                failures += 1
+            else:
+                os.remove(path)
+        await client.upload_reference_file(reference, filename='bench.wav')
+        await client.aclose()
+        return elapsed
+
+    elapsed = asyncio.run(run_async())
+    print(f"async pooled: {args.requests / elapsed:8.1f} req/s")
+    TTSClient(api_url, backoff=0.01).upload_reference_file(reference, filename='bench_sync.wav')
+    print(f"stub saw {stub.state.requests} requests, references {stub.state.references}")
+    # The stub records the multipart body size, which includes the whole file
+    if failures or stub.state.references.get('bench.wav', 0) < os.path.getsize(reference):
+        sys.exit(f"{failures} requests failed despite retries")
+
+
+def telegram_benchmark(args):
+    sys.path.insert(0, BOT_SERVER_DIR)
+    from fakes import make_telegram_stub, serve_in_thread
+    from telegram_tools import TelegramClient, TelegramError
+
+    stub = make_telegram_stub()
+    serve_in_thread(stub, args.port)
+    api_url = f"http://127.0.0.1:{args.port}"
+    # Retries of the stub's 429s are expected
+    logging.getLogger('telegram_tools').setLevel(logging.ERROR)
+
+    async def burst(client):
+        """Replies to many chats at once plus a run of messages to one chat"""
+        async def send(chat_id, i):
+            try:
+                await client.send_message(chat_id, f"Reply {i}")
+                return True
+            except TelegramError:
+                return False
+
+        calls = [send(chat_id, i) for chat_id in range(1, args.chats + 1) for i in range(args.messages)]
+        calls += [send(0, i) for i in range(args.hot_messages)]
+        started = time.perf_counter()
+        results = await asyncio.gather(*calls)
+        elapsed = time.perf_counter() - started
+        await client.aclose()
+        return results.count(False), elapsed, client.stats()
+
+    # Limits off and no retries: the old behaviour, bursts end in errors
+    failed_raw, elapsed, _ = asyncio.run(burst(TelegramClient(
+        'bench', api_url, rate=1e9, chat_rate=1e9, chat_burst=1e9, retries=0)))
+    total = args.chats * args.messages + args.hot_messages
+    print(f"unlimited: {total} messages, {failed_raw} failed with 429, {elapsed:.2f}s")
+    # Let the stub's per-chat limits refill after the first burst
+    time.sleep(3.5)
+    failed, elapsed, stats = asyncio.run(burst(TelegramClient('bench', api_url)))
+    print(f"  limited: {total} messages, {failed} failed, {elapsed:.2f}s, {stats}")
+
+    async def sequential(pooled):
+        client = TelegramClient('bench', api_url)
+        started = time.perf_counter()
+        for i in range(args.requests):
+            if pooled:
+                await client.get_file(f"file-{i}")
+            else:
+                fresh = TelegramClient('bench', api_url)
+                await fresh.get_file(f"file-{i}")
+                await fresh.aclose()
+        await client.aclose()
+        return args.requests / (time.perf_counter() - started)
+
+    print(f"   pooled: {asyncio.run(sequential(True)):8.1f} calls/s")
+    print(f"    fresh: {asyncio.run(sequential(False)):8.1f} calls/s")
+    if failed:
+        sys.exit(f"{failed} messages failed despite rate limiting")
+
+
+async def progress_benchmark(args):
+    from fakes import FakeChatModel, FakeTelegram, FakeTTS, FakeSTT, fake_to_wav, fake_wav_to_ogg, write_silence
+
+    server = load_server()
+    server.llm = FakeChatModel(latency=args.llm_latency)
+    server.tts = FakeTTS(latency=0)
+    server.stt = FakeSTT(latency=0.1)
+    server.to_wav = fake_to_wav
+    server.wav_to_ogg = fake_wav_to_ogg
+    server.progress_reporter.interval = args.interval
+    voice_file = write_silence('data/voice.wav')
+    reporter = server.progress_reporter
+
+    async def settled():
+        while reporter.stats()['active']:
+            await asyncio.sleep(0.01)
+
+    await server.startup()
+    transport = httpx.ASGITransport(app=server.app)
+    ok = True
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+        for phase, (name, bot) in enumerate((
+            ('normal', FakeTelegram(latency=args.telegram_latency)),
+            ('429', FakeTelegram(latency=args.telegram_latency, rate_limited_edits=2, retry_after=args.retry_after))
+        )):
+            server.bot = bot
+            before = dict(reporter.stats())
+            latencies = []
+            for turn in range(args.turns):
+                started = time.perf_counter()
+                # New message ids, or the queue drops them as redelivered
+                update = voice_update(1, phase * 1000 + turn, voice_file)
+                (await client.post('/message', json=update)).raise_for_status()
+                await bot.wait_reply(1)
+                latencies.append(time.perf_counter() - started)
+            await settled()
+            edits = bot.edits[1]
+            stats = reporter.stats()
+            delta = {key: stats[key] - before[key] for key in ('edits', 'coalesced', 'rate_limited')}
+            # One edit right away, then at most one per interval while the turn runs
+            allowed = args.turns * (math.ceil(max(latencies) / args.interval) + 1)
+            print(f"{name:>6}: {args.turns} turns, p50 {statistics.median(latencies):.2f}s, "
+                  f"{len(edits)} edits (limit {allowed}), {delta['coalesced']} coalesced, "
+                  f"{delta['rate_limited']} rate limited, last: {edits[-1] if edits else None}")
+            done = sum('Done' in text for text in edits)
+            ok = ok and len(edits) <= allowed and done == args.turns
+        # Awaiting five edits inline cost this much per turn before
+        print(f"Inline edits would add {5 * args.telegram_latency:.2f}s per turn")
+    await server.shutdown()
+    if not ok:
+        sys.exit("Expected at most one edit per interval and a final Done edit for every turn")
+
+
+def rss_mb():
+    """Current resident set size of this process"""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+async def load_benchmark(args):
+    from fakes import FakeChatModel, FakeSTT, make_telegram_stub, make_tts_stub, serve_in_thread, write_silence
+    from fakes import fake_to_wav, fake_wav_to_ogg
+
+    server = load_server(TTS_API_URL=f"http://127.0.0.1:{args.tts_port}", TTS_STREAM_MODE='concat')
+    # Quiet the per-request logging, it would dominate the profile
+    logging.disable(logging.INFO)
+    telegram_stub = make_telegram_stub()
+    serve_in_thread(telegram_stub, args.telegram_port)
+    serve_in_thread(make_tts_stub(latency=args.tts_latency), args.tts_port)
+    server.bot = server.TelegramClient('bench', api_url=f"http://127.0.0.1:{args.telegram_port}")
+    server.llm = FakeChatModel(latency=args.llm_latency)
+    server.stt = FakeSTT(latency=args.stt_latency)
+    if not args.ffmpeg:
+        server.to_wav = fake_to_wav
+        server.wav_to_ogg = fake_wav_to_ogg
+    if not args.speech_cache:
+        # Every fake reply is the same text, real ones are not
+        server.speech_cache = None
+    voice_file = os.path.abspath(write_silence('data/voice.wav', seconds=3))
+
+    loop = asyncio.get_running_loop()
+    waiting = {}
+
+    def on_reply(chat_id, text):
+        future = waiting.pop(str(chat_id), None)
+        if future:
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(text))
+
+    telegram_stub.state.on_reply = on_reply
+    latencies = {'text': [], 'voice': []}
+    errors = 0
+    peak_rss = rss_mb()
+    slots = asyncio.Semaphore(args.concurrency)
+    rng = random.Random(1)
+
+    async def turn(client, user_id, message_id, kind):
+        nonlocal errors
+        future = waiting[str(user_id)] = loop.create_future()
+        if kind == 'voice':
+            update = voice_update(user_id, message_id, voice_file, duration=3)
+        else:
+            update = text_update(user_id, message_id, f"Hello, this is message {message_id}")
+        started = time.perf_counter()
+        (await client.post('/message', json=update)).raise_for_status()
+        text = await asyncio.wait_for(future, args.timeout)
+        latencies[kind].append(time.perf_counter() - started)
+        if text and text.startswith('Sorry'):
+            errors += 1
+
+    async def user(client, user_id):
+        async with slots:
+            for message_id in range(1, args.turns + 1):
+                kind = 'voice' if rng.random() < args.voice_ratio else 'text'
+                await turn(client, user_id, message_id, kind)
+
+    async def sample_rss():
+        nonlocal peak_rss
+        while True:
+            peak_rss = max(peak_rss, rss_mb())
+            await asyncio.sleep(0.1)
+
+    await server.startup()
+    sampler = asyncio.create_task(sample_rss())
+    rss_before = rss_mb()
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+        started = time.perf_counter()
+        await asyncio.gather(*[user(client, user_id) for user_id in range(1, args.users + 1)])
+        wall = time.perf_counter() - started
+    sampler.cancel()
+    await server.shutdown()
+
+    total = sum(len(values) for values in latencies.values())
+    print(f"users={args.users} concurrency={args.concurrency} turns/user={args.turns} "
+          f"voice={args.voice_ratio:.0%} llm={args.llm_latency}s stt={args.stt_latency}s tts={args.tts_latency}s")
+    print(f"{'type':>5} {'turns':>6} {'p50 s':>7} {'p95 s':>7} {'p99 s':>7}")
+    for kind, values in latencies.items():
+        if values:
+            print(f"{kind:>5} {len(values):>6} {statistics.median(values):>7.2f} "
+                  f"{percentile(values, 95):>7.2f} {percentile(values, 99):>7.2f}")
+    print(f"{total} turns in {wall:.1f}s: {total / wall:.2f} turns/s, {errors} errors")
+    # Stubs run in this process too, their share is small and constant
+    print(f"RSS: {rss_before:.0f} MB at start, {peak_rss:.0f} MB peak")
+    print(f"Telegram stub: {telegram_stub.state.requests} calls, {telegram_stub.state.rejected} answered 429")
+    if errors:
+        sys.exit(f"{errors} turns ended in an error reply")
+
+
+def synthetic_speech(seconds, sample_rate=16000, phrase=8.0, pause=1.0, lead=3.0, tail=5.0):
+    """Tone phrases separated by pauses, with silence before and after, over background noise"""
+    import numpy as np
+
+    rng = np.random.default_rng(1)
+    t = np.arange(int(phrase * sample_rate)) / sample_rate
+    tone = 8000 * np.sin(2 * np.pi * 220 * t) * (1 + 0.5 * np.sin(2 * np.pi * 3 * t))
+    parts = [np.zeros(int(lead * sample_rate))]
+    speech = seconds - lead - tail
+    while speech > 0:
+        parts.append(tone[:int(min(phrase, speech) * sample_rate)])
+        parts.append(np.zeros(int(pause * sample_rate)))
+        speech -= phrase + pause
+    parts.append(np.zeros(int(tail * sample_rate)))
+    samples = np.concatenate(parts)
+    samples += rng.normal(0, 30, len(samples))
+    return samples.astype('<i2').tobytes()
+
+
+async def vad_benchmark(args):
+    sys.path.insert(0, BOT_SERVER_DIR)
+    from audio_tools import pcm_to_wav, split_speech, wav_samples
+    from fakes import FakeSTT
+    from stt_tools import transcribe_chunks
+
+    wav = pcm_to_wav(synthetic_speech(args.seconds))
+    started = time.perf_counter()
+    chunks = split_speech(wav, args.chunk_seconds)
+    elapsed = time.perf_counter() - started
+    lengths = [len(wav_samples(chunk)[0]) / 16000 for chunk in chunks]
+    print(f"VAD: {args.seconds:.0f}s in {elapsed * 1000:.1f} ms, "
+          f"{len(chunks)} chunks of {', '.join(f'{length:.1f}' for length in lengths)}s")
+
+    full = FakeSTT(latency=args.stt_latency, realtime_factor=args.realtime_factor)
+    started = time.perf_counter()
+    await full.transcribe(wav, ['en-US'])
+    whole = time.perf_counter() - started
+    chunked = FakeSTT(latency=args.stt_latency, realtime_factor=args.realtime_factor)
+    started = time.perf_counter()
+    await transcribe_chunks(chunked, chunks, ['en-US'])
+    parallel = time.perf_counter() - started
+    print(f"  whole message: {full.billed_seconds:6.1f} s billed, {whole:.2f}s STT")
+    print(f"trimmed chunks: {chunked.billed_seconds:6.1f} s billed, {parallel:.2f}s STT")
+
+    silent = split_speech(pcm_to_wav(bytes(32000 * 5)), args.chunk_seconds)
+    if (max(lengths) > args.chunk_seconds or chunked.billed_seconds >= full.billed_seconds
+            or parallel >= whole or silent):
+        sys.exit("Expected shorter chunks than the limit, fewer billed seconds, faster STT and no chunks for silence")
+
+
+async def languages_benchmark(args):
+    from fakes import FakeSTT, tone_wav
+    from language_tools import LanguageProfiles
+
+    server = load_server()
+    languages = server.config_store.languages
+    stt = server.stt = FakeSTT(latency=args.stt_latency, language_latency=args.language_latency)
+    chunks = [tone_wav()]
+    user_id = '1'
+
+    async def messages(language, count):
+        stt.language_code = language
+        durations, sent = [], []
+        for _ in range(count):
+            before = stt.calls
+            started = time.perf_counter()
+            await server.recognize_voice(user_id, languages, chunks=chunks)
+            durations.append(time.perf_counter() - started)
+            sent.append(stt.calls - before)
+        codes = await server.language_profiles.codes(user_id, languages)
+        print(f"{language:>11}: {count} messages, {sum(sent)} STT calls, mean {statistics.mean(durations):.2f}s, "
+              f"now asking for {codes}")
+        return codes
+
+    print(f"All languages: {languages}")
+    first = await messages('ru-ru', args.messages)
+    # Switching languages falls back to the full list once, then the profile follows
+    second = await messages('ja-jp', args.messages)
+    print(f"Profiles: {server.language_profiles.stats()}")
+    reloaded = await LanguageProfiles('data/users').codes(user_id, languages)
+    print(f"Reloaded from disk: {reloaded}")
+    if first != ['ru-RU'] or second[0] != 'ja-JP' or len(second) == len(languages) or reloaded != second:
+        sys.exit("Expected the profile to narrow to the spoken language, follow a switch and survive a restart")
+
+
+async def reference_benchmark(args):
+    if not (shutil.which('ffmpeg') and shutil.which('ffprobe')):
+        sys.exit("reference needs ffmpeg and ffprobe on PATH")
+    sys.path.insert(0, BOT_SERVER_DIR)
+    from audio_tools import AudioRejected, prepare_reference, to_wav
+
+    workdir = tempfile.mkdtemp(prefix='echobridge_reference_')
+    os.chdir(workdir)
+
+    def make(name, seconds, sample_rate=48000):
+        subprocess.run(
+            ['ffmpeg', '-loglevel', 'error', '-f', 'lavfi', '-i', f'sine=frequency=220:duration={seconds}',
+             '-af', 'volume=0.05', '-ar', str(sample_rate), '-c:a', 'libopus' if sample_rate == 48000 else 'pcm_s16le',
+             name],
+            check=True
+        )
+        return name
+
+    long_file = make('long.ogg', args.seconds)
+    started = time.perf_counter()
+    full = await to_wav(long_file)
+    decode_all = time.perf_counter() - started
+    started = time.perf_counter()
+    reference = await prepare_reference(long_file, max_seconds=args.max_seconds)
+    prepared = time.perf_counter() - started
+    print(f"{args.seconds}s reference: full decode {decode_all * 1e3:.0f} ms, {len(full) / 2 ** 20:.1f} MiB; "
+          f"header check, cut and loudnorm {prepared * 1e3:.0f} ms, {len(reference) / 2 ** 20:.1f} MiB")
+
+    rejected = {}
+    with open('notes.txt', 'w') as f:
+        f.write("not audio")
+    for name, path in (('too short', make('short.ogg', 1)), ('8 kHz', make('narrow.wav', 10, 8000)),
+                       ('not audio', 'notes.txt')):
+        started = time.perf_counter()
+        try:
+            await prepare_reference(path, max_seconds=args.max_seconds)
+        except AudioRejected as e:
+            rejected[name] = str(e)
+        print(f"{name:>10}: {rejected.get(name, 'accepted')} in {(time.perf_counter() - started) * 1e3:.0f} ms")
+    kept = (len(reference) - 44) / 2 / 16000
+    if len(rejected) != 3 or abs(kept - args.max_seconds) > 0.5:
+        sys.exit(f"Expected the reference cut to {args.max_seconds}s and every bad file rejected")
+
+
+async def workers_turns(args):
+    """One server process: a job queue whose turns read and append the shared history"""
+    from history_tools import HistoryStore
+    from queue_tools import FileLocks, JobQueue
+
+    store = HistoryStore(os.path.join(args.workdir, 'users'), max_tokens=10 ** 9, shared=not args.no_locks)
+    done = asyncio.Event()
+    finished = []
+
+    async def handle(payload):
+        try:
+            turns = store.read_turns('user')
+            # Time the LLM would take between reading the history and writing the turn
+            await asyncio.sleep(args.think)
+            store.append('user', payload['message_id'], [('user', json.dumps({'seen': len(turns)}))])
+        finally:
+            finished.append(payload['message_id'])
+            if len(finished) == args.turns:
+                done.set()
+
+    locks = None if args.no_locks else FileLocks(os.path.join(args.workdir, 'locks'))
+    queue = JobQueue(handle, workers=4, locks=locks)
+    await queue.start()
+    for turn in range(args.turns):
+        await queue.submit('user', f"{os.getpid()}:{turn}", {'message_id': f"{os.getpid()}:{turn}"})
+    await done.wait()
+    await queue.stop()
+    print(json.dumps({'lock_waits': locks.waits if locks else 0, 'reloads': store.reloads, 'failed': queue.failed}))
+
+
+def workers_benchmark(args):
+    sys.path.insert(0, BOT_SERVER_DIR)
+    if args.worker:
+        asyncio.run(workers_turns(args))
+        return
+    workdir = tempfile.mkdtemp(prefix='echobridge_workers_')
+    command = [sys.executable, os.path.abspath(__file__), 'workers', '--worker', '--workdir', workdir,
+               '--turns', str(args.turns), '--think', str(args.think)]
+    if args.no_locks:
+        command.append('--no-locks')
+    started = time.perf_counter()
+    processes = [subprocess.Popen(command, stdout=subprocess.PIPE, text=True) for _ in range(args.processes)]
+    results = [json.loads(process.communicate()[0].strip().splitlines()[-1]) for process in processes]
+    elapsed = time.perf_counter() - started
+
+    lines, broken, seen = 0, 0, []
+    with open(os.path.join(workdir, 'users', 'user', 'history.jsonl'), 'rb') as f:
+        for line in f:
+            lines += 1
+            try:
+                seen.append(json.loads(json.loads(line)['messages'][0][1])['seen'])
+            except ValueError:
+                broken += 1
+    expected = args.processes * args.turns
+    print(f"{args.processes} processes x {args.turns} turns for one user in {elapsed:.2f}s "
+          f"({'no locks' if args.no_locks else 'file locks, shared history'})")
+    print(f"History lines: {lines} of {expected}, unparsable {broken}, "
+          f"turns that saw the same history: {len(seen) - len(set(seen))}")
+    print(f"Failed turns: {sum(result['failed'] for result in results)}, "
+          f"lock waits: {sum(result['lock_waits'] for result in results)}, "
+          f"index reloads: {sum(result['reloads'] for result in results)}")
+    shutil.rmtree(workdir)
+    if not args.no_locks and (lines != expected or broken or sorted(seen) != list(range(expected))
+                              or any(result['failed'] for result in results)):
+        sys.exit("Expected every turn in the log, one at a time, each seeing all turns before it")
+
+
+async def tracing_benchmark(args):
+    import itertools
+    from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+    from langchain_core.messages import AIMessage
+    from fakes import FakeChatModel, FakeLangSmith, FakeTelegram, FakeTTS, fake_wav_to_ogg
+    from tracing_tools import Tracer
+
+    server = load_server(SPEECH_CACHE=False)
+    server.bot = FakeTelegram(latency=0)
+    server.tts = FakeTTS(latency=0)
+    server.wav_to_ogg = fake_wav_to_ogg
+    # A real LangChain model, so every streamed token goes through the callbacks
+    server.llm = GenericFakeChatModel(messages=itertools.repeat(AIMessage(
+        "This is a fake reply. It has two sentences, and a few more words to stream token by token."
+    )))
+
+    modes = (('off', None), ('sampled', args.sample_rate), ('full', 1.0))
+    baseline = None
+    results = {}
+    message_id = 0
+    for name, rate in modes:
+        collector = FakeLangSmith(latency=args.collector_latency)
+        server.tracer = Tracer(sample_rate=rate, slow_seconds=None, queue_size=args.queue_size,
+                               client=collector) if rate is not None else None
+        latencies = []
+        for turn in range(args.turns):
+            message_id += 1
+            started = time.perf_counter()
+            await server.handle_message(text_update(1, message_id, f"Question {turn}"))
+            latencies.append(time.perf_counter() - started)
+        mean = statistics.mean(latencies)
+        baseline = baseline or mean
+        stats = server.tracer.stats() if server.tracer else {}
+        print(f"{name:>8}: {mean * 1e3:6.2f} ms/turn (+{(mean - baseline) * 1e3:5.2f} ms), "
+              f"p95 {percentile(latencies, 95) * 1e3:6.2f} ms, kept {stats.get('sampled', 0)}, "
+              f"dropped {stats.get('dropped', 0)}")
+        results[name] = stats
+        if server.tracer:
+            server.tracer.close(timeout=1)
+
+    # A failed turn is kept whatever the sample rate
+    collector = FakeLangSmith(latency=0)
+    server.tracer = Tracer(sample_rate=0.0, slow_seconds=None, client=collector)
+    server.llm = FakeChatModel(latency=0, reply=None)
+    await server.handle_message(text_update(1, message_id + 1, "This one fails"))
+    server.tracer.close()
+    print(f"Failed turn at sample rate 0: {server.tracer.stats()}")
+    expected = args.turns * args.sample_rate
+    if (results['full']['dropped'] == 0 and args.collector_latency > 0) or server.tracer.stats()['failed_kept'] != 1 \
+            or abs(results['sampled']['sampled'] - expected) > 3 * math.sqrt(expected) + 1:
+        sys.exit("Expected sampled turns near the sample rate, drops under a slow collector and failed turns kept")
+
+
+async def startup_worker(args):
+    """One cold start in this process, printed as JSON"""
+    started = time.perf_counter()
+    sys.path.insert(0, BOT_SERVER_DIR)
+    os.chdir(args.workdir)
+    import server
+    imported = time.perf_counter() - started
+    from fakes import FakeChatModel, FakeSTT, FakeTelegram, FakeTTS, fake_wav_to_ogg
+
+    # Stand-ins that take connect_latency to warm up, the chat model itself is the real one
+    server.bot = FakeTelegram(latency=args.connect_latency)
+    server.tts = FakeTTS(latency=args.connect_latency)
+    server.stt = FakeSTT(latency=args.connect_latency)
+    server.wav_to_ogg = fake_wav_to_ogg
+
+    async def warm_llm():
+        await asyncio.sleep(args.connect_latency)
+    server.warm_llm = warm_llm
+
+    started = time.perf_counter()
+    await server.startup()
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+        before = (await client.get('/ready')).status_code
+        await server.ready.wait()
+        ready = time.perf_counter() - started
+        after = (await client.get('/ready')).status_code
+    server.llm = FakeChatModel(latency=0)
+    server.bot.latency = server.tts.latency = 0
+    started = time.perf_counter()
+    await server.handle_message(text_update(1, 1, "Hello"))
+    first_turn = time.perf_counter() - started
+    await server.shutdown()
+    print(json.dumps({
+        'import': imported, 'ready': ready, 'first_turn': first_turn, 'status': [before, after],
+        'warmup': server.warmup_report
+    }))
+
+
+def startup_benchmark(args):
+    if args.worker:
+        asyncio.run(startup_worker(args))
+        return
+    workdir = scratch_dir(WARMUP=not args.no_warmup, OPENAI_API_KEY="sk-bench")
+    env = {**os.environ, 'PYTHONPATH': BOT_SERVER_DIR}
+    runs = []
+    for _ in range(args.runs):
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), 'startup', '--worker', '--workdir', workdir,
+             '--connect-latency', str(args.connect_latency)],
+            check=True, capture_output=True, text=True, env=env
+        ).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    result = {name: statistics.median(run[name] for run in runs) for name in ('import', 'ready', 'first_turn')}
+    print(f"{args.runs} cold starts ({'no warmup' if args.no_warmup else 'warmup'}): "
+          f"import {result['import'] * 1e3:.0f} ms, ready {result['ready'] * 1e3:.0f} ms later, "
+          f"first turn {result['first_turn'] * 1e3:.1f} ms")
+    print(f"Warmup steps (s): {runs[-1]['warmup']}")
+
+    # -X importtime lines: "import time: self [us] | cumulative | imported package", nested ones indented
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import server'],
+                            cwd=workdir, env=env, check=True, capture_output=True, text=True).stderr
+    imports = []
+    for line in stderr.splitlines():
+        fields = line.split('|')
+        # Modules server.py imports itself are one level below it
+        if len(fields) == 3 and fields[1].strip().isdigit() and fields[2].startswith('   ') \
+                and not fields[2].startswith('     '):
+            imports.append((int(fields[1]), fields[2].strip()))
+    print("Slowest imports left in server.py: " + ", ".join(
+        f"{name} {micros / 1e3:.0f} ms" for micros, name in sorted(imports, reverse=True)[:args.top]))
+    shutil.rmtree(workdir)
+
+    if args.history:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BOT_SERVER_DIR,
+                                capture_output=True, text=True).stdout.strip()
+        previous = None
+        if os.path.exists(args.history):
+            with open(args.history) as f:
+                lines = f.read().splitlines()
+            previous = json.loads(lines[-1]) if lines else None
+        with open(args.history, 'a') as f:
+            f.write(json.dumps({'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'commit': commit,
+                                'warmup': not args.no_warmup, **result}) + '\n')
+        if previous:
+            print(f"Since {previous['commit']} ({previous['date']}): import "
+                  f"{(result['import'] - previous['import']) * 1e3:+.0f} ms, ready "
+                  f"{(result['ready'] - previous['ready']) * 1e3:+.0f} ms")
+    if any(run['status'] != [503, 200] for run in runs):
+        sys.exit("Expected /ready to answer 503 during warmup and 200 after it")
+
+
+async def llm_cache_benchmark(args):
+    from completion_tools import CompletionCache
+    from fakes import FakeChatModel, FakeTelegram, FakeTTS, fake_wav_to_ogg
+
+    server = load_server(LLM_CACHE=True, LLM_CACHE_DISK=True, SPEECH_CACHE=False)
+    server.bot = FakeTelegram(latency=0)
+    server.tts = FakeTTS(latency=0)
+    server.wav_to_ogg = fake_wav_to_ogg
+    server.llm = FakeChatModel(latency=args.llm_latency)
+
+    common = [f"What can you do, number {i}?" for i in range(args.common)]
+    message_id = 0
+
+    async def ask(user_id, text):
+        nonlocal message_id
+        message_id += 1
+        await server.handle_message(text_update(user_id, message_id, text))
+
+    started = time.perf_counter()
+    turns = 0
+    for user_id in range(1, args.users + 1):
+        # A common first question, asked again after /reset and in another spelling, a follow-up
+        # that has the same history for every user with that question, then a question of their own
+        question = common[user_id % args.common]
+        await ask(user_id, question)
+        await ask(user_id, '/reset')
+        await ask(user_id, '  ' + question.upper() + ' ')
+        await ask(user_id, "Tell me more")
+        await ask(user_id, f"Question of user {user_id}")
+        turns += 4
+    elapsed = time.perf_counter() - started
+    stats = server.completion_cache.stats()
+    print(f"{turns} turns from {args.users} users in {elapsed:.1f}s: {server.llm.calls} LLM calls, "
+          f"hit rate {stats['hit_rate']}, saved {stats['saved_llm_seconds']:.1f} LLM seconds "
+          f"and {stats['saved_tokens']} tokens")
+    uncached = server.llm.calls + stats['hits']
+
+    calls = server.llm.calls
+    await ask(1, '/fresh ' + common[1 % args.common])
+    fresh = server.llm.calls - calls
+
+    expiring = CompletionCache(ttl=0.2)
+    key = expiring.key('gpt-4', 'system', 'en', [], 'Hi')
+    expiring.put(key, 'Hello', 1.0, 10)
+    hit_before = expiring.get(key) is not None
+    time.sleep(0.3)
+    hit_after = expiring.get(key) is not None
+
+    restarted = CompletionCache(root='data/llm_cache')
+    key = restarted.key(server.LLM_MODEL, server.SYSTEM_PROMPT.format(language='en'), 'en', [], common[0])
+    from_disk = restarted.get(key) is not None
+    print(f"/fresh LLM calls: {fresh}, hit before/after TTL: {hit_before}/{hit_after}, "
+          f"hit from disk after a restart: {from_disk}")
+    expected_calls = 2 * args.common + args.users
+    if server.llm.calls - fresh != expected_calls or uncached != turns or fresh != 1 \
+            or not hit_before or hit_after or not from_disk:
+        sys.exit(f"Expected {expected_calls} LLM calls for {turns} turns, /fresh to skip the cache, "
+                 f"expiry and disk hits")
+
+
+async def janitor_benchmark(args):
+    import fcntl
+    import uuid
+    from history_tools import HistoryStore
+    from janitor_tools import SPEECH_NAME, UUID_NAME, usage
+    from fakes import FakeChatModel, FakeTelegram, FakeTTS, fake_wav_to_ogg
+
+    server = load_server(
+        LLM_CACHE=True, LLM_CACHE_DISK=True, USER_QUOTA_MB=args.quota_kb / 1024,
+        JANITOR_ORPHAN_AGE=600, HISTORY_MAX_TOKENS=100000
+    )
+    server.bot = FakeTelegram(latency=0)
+    server.tts = FakeTTS(latency=0)
+    server.wav_to_ogg = fake_wav_to_ogg
+    server.llm = FakeChatModel(latency=0.01)
+    janitor = server.janitor
+    now = time.time()
+    old = now - 3600
+
+    def age(path, when):
+        os.utime(path, (when, when))
+
+    # Leftovers of failed requests, old ones and ones a running request may still use
+    kept = []
+    for i in range(args.orphans):
+        for when in (old, now):
+            directory = os.path.join('data', str(uuid.uuid4()))
+            os.makedirs(directory)
+            with open(os.path.join(directory, 'audio.wav'), 'wb') as f:
+                f.write(b'\0' * 20000)
+            age(os.path.join(directory, 'audio.wav'), when)
+            age(directory, when)
+            speech = os.path.join('data', f"speech_{uuid.uuid4()}.wav")
+            with open(speech, 'wb') as f:
+                f.write(b'\0' * 20000)
+            age(speech, when)
+            if when == now:
+                kept += [directory, speech]
+
+    # Histories: many small users active at different times, legacy per-turn files,
+    # logs with a pruned prefix and histories over the user quota
+    filler = HistoryStore('data/users', max_tokens=100000, compact_min_bytes=2 ** 40)
+    pruning = HistoryStore('data/users', max_tokens=300, compact_min_bytes=2 ** 40)
+    small = [str(user_id) for user_id in range(1, args.users + 1)]
+    legacy = [str(10000 + i) for i in range(args.orphans)]
+    bloated = [str(20000 + i) for i in range(args.orphans)]
+    heavy = [str(30000 + i) for i in range(args.orphans)]
+    for user_id in small:
+        for turn in range(3):
+            filler.append(user_id, turn, [('user', f"Question {turn}"), ('assistant', "Answer " * 20)])
+    for user_id in legacy:
+        user_dir = os.path.join('data', 'users', user_id)
+        os.makedirs(user_dir)
+        for turn in range(30):
+            with open(os.path.join(user_dir, f"20240101_{turn:06d}_{turn}.json"), 'w') as f:
+                json.dump({'user': f"Question {turn}", 'assistant': "Answer " * 20}, f)
+    for user_id in bloated:
+        for turn in range(60):
+            pruning.append(user_id, turn, [('user', f"Question {turn}"), ('assistant', "Answer " * 20)])
+    for user_id in heavy:
+        for turn in range(500):
+            filler.append(user_id, turn, [('user', f"Question {turn}"), ('assistant', "Answer " * 20)])
+    for index, user_id in enumerate(small + legacy + bloated + heavy):
+        user_dir = os.path.join('data', 'users', user_id)
+        for name in os.listdir(user_dir):
+            age(os.path.join(user_dir, name), old - index * 60)
+        with open(os.path.join(user_dir, 'history.jsonl.tmp'), 'w') as f:
+            f.write('{"torn')
+        age(os.path.join(user_dir, 'history.jsonl.tmp'), old)
+
+    # Lock files of past turns, one of them held by a turn in another process
+    os.makedirs('data/locks')
+    for user_id in small[:args.orphans]:
+        path = os.path.join('data', 'locks', f"{user_id}.lock")
+        open(path, 'w').close()
+        age(path, old)
+    held = os.open(os.path.join('data', 'locks', f"{small[0]}.lock"), os.O_RDWR)
+    fcntl.flock(held, fcntl.LOCK_EX)
+
+    # Cached answers, some of them expired, and cached voice notes
+    ttl = server.completion_cache.ttl
+    for i in range(args.orphans * 2):
+        server.completion_cache.ttl = 0 if i % 2 else ttl
+        key = server.completion_cache.key('gpt-4', 'system', 'en', [], f"Question {i}")
+        server.completion_cache.put(key, "Answer " * 20, 1.0, 50)
+    server.completion_cache.ttl = ttl
+    for i in range(args.orphans):
+        server.speech_cache.put(f"note{i}", small[i], b'\0' * 20000)
+
+    async def turns():
+        active = small[-5:]
+        for turn in range(10):
+            await asyncio.gather(*(
+                server.handle_message(text_update(user_id, 1000 + turn, f"New question {turn}"))
+                for user_id in active
+            ))
+        return active
+
+    before_turns = {user_id: len(server.history_store.read_turns(user_id)) for user_id in small[-5:]}
+    report, active = await asyncio.gather(janitor.sweep(), turns())
+    os.close(held)
+    quota = int(args.quota_kb * 1024)
+
+    print(f"Sweep of {report['files_before']} files, {report['bytes_before'] / 2 ** 20:.1f} MB "
+          f"in {report['seconds']:.2f}s, now {report['files_after']} files, "
+          f"{report['bytes_after'] / 2 ** 20:.1f} MB")
+    for category, reclaimed in report['reclaimed'].items():
+        print(f"  {category:10} {reclaimed['files']:6} files {reclaimed['bytes'] / 1024:10.1f} KB")
+    leftovers = [
+        name for name in os.listdir('data')
+        if (UUID_NAME.match(name) or SPEECH_NAME.match(name)) and os.path.join('data', name) not in kept
+    ]
+    tmp_files = [
+        name for user_id in os.listdir('data/users')
+        for name in os.listdir(os.path.join('data', 'users', user_id)) if name.endswith('.tmp')
+    ]
+    locks = sorted(os.listdir('data/locks'))
+    over_quota = [
+        user_id for user_id in os.listdir('data/users')
+        if usage(os.path.join('data', 'users', user_id))[0] > quota
+    ]
+    unreadable = []
+    for user_id in os.listdir('data/users'):
+        try:
+            server.history_store.store.read_turns(user_id)
+            HistoryStore('data/users').read_turns(user_id)
+        except Exception:
+            unreadable.append(user_id)
+    legacy_left = [
+        user_id for user_id in legacy
+        if len(os.listdir(os.path.join('data', 'users', user_id))) != 1
+    ]
+    bloated_left = [
+        user_id for user_id in bloated
+        if HistoryStore('data/users')._stored_start(user_id) != 0
+    ]
+    lost_turns = [
+        user_id for user_id in active
+        if len(server.history_store.read_turns(user_id)) != before_turns[user_id] + 10
+    ]
+    measured = report['bytes_before'] - report['bytes_after']
+    print(f"Leftovers: {len(leftovers)} old, {len(tmp_files)} tmp left, {len(kept)} recent kept: "
+          f"{all(os.path.exists(path) for path in kept)}; lock files left: {locks}")
+    print(f"Users over the {args.quota_kb} KB quota: {len(over_quota)}, trimmed: {len(report['trimmed_users'])}, "
+          f"unreadable: {len(unreadable)}, legacy not merged: {len(legacy_left)}, "
+          f"logs not compacted: {len(bloated_left)}, active users with lost turns: {len(lost_turns)}")
+    print(f"Reported {report['reclaimed_bytes']} bytes reclaimed, measured {measured} "
+          f"while turns added some")
+    if leftovers or tmp_files or not all(os.path.exists(path) for path in kept) \
+            or locks != [f"{small[0]}.lock"] or over_quota or unreadable or legacy_left or bloated_left \
+            or lost_turns or sorted(report['trimmed_users']) != sorted(heavy) \
+            or report['reclaimed']['llm_cache']['files'] != args.orphans \
+            or report['reclaimed_bytes'] < measured:
+        sys.exit("Expected old leftovers removed, held locks and recent files kept, every user under the quota "
+                 "with a readable history and the report to add up")
+
+    # Global quota: caches go first, then the oldest turns of the users inactive the longest
+    idle = [user_id for _, user_id in janitor._idle_users()]
+    for user_id in idle:
+        with open(os.path.join('data', 'users', user_id, 'languages.json'), 'w') as f:
+            json.dump({'en': 1.0}, f)
+    cache_bytes = usage(server.speech_cache.root)[0] + usage(server.completion_cache.root)[0]
+    cache_files = len(os.listdir(server.speech_cache.root)) + len(os.listdir(server.completion_cache.root))
+    # More than the caches hold, so some histories have to give up turns too
+    janitor.quota_keep_bytes = 4 * 1024
+    janitor.max_bytes = usage('data')[0] - cache_bytes - 100 * 1024
+    report = await janitor.sweep()
+    trimmed = report['trimmed_users']
+    emptied = [user_id for user_id in idle if not server.history_store.read_turns(user_id)]
+    print(f"Global quota of {janitor.max_bytes / 2 ** 20:.2f} MB: {report['reclaimed']['quota']['files']} files "
+          f"from {cache_files} cache files, oldest turns of {len(trimmed)} users, "
+          f"now {report['bytes_after'] / 2 ** 20:.2f} MB")
+    if report['bytes_after'] > janitor.max_bytes or server.speech_cache.stats()['entries'] \
+            or server.completion_cache.stats()['disk_entries'] \
+            or not trimmed or trimmed != [user_id for user_id in idle if user_id in trimmed][:len(trimmed)] \
+            or report['cleared_users'] or emptied:
+        sys.exit("Expected data/ under the quota, caches evicted before the oldest turns of idle users, "
+                 "and every user keeping a history")
+
+    # Below what trimming frees, users are cleared only when that is enabled
+    janitor.max_bytes = usage('data')[0] // 4
+    report = await janitor.sweep()
+    print(f"Quota below the kept turns: still {report['bytes_after'] / 2 ** 20:.2f} MB without clearing, "
+          f"{len(report['cleared_users'])} users cleared")
+    if report['cleared_users'] or report['bytes_after'] <= janitor.max_bytes:
+        sys.exit("Expected no user cleared without DATA_QUOTA_CLEAR_USERS")
+    # Every idle user is down to the kept turns now, so only clearing frees more
+    janitor.clear_users = True
+    janitor.max_bytes = usage('data')[0] - 100 * 1024
+    report = await janitor.sweep()
+    cleared = report['cleared_users']
+    profiles_left = [
+        user_id for user_id in cleared if os.path.exists(os.path.join('data', 'users', user_id, 'languages.json'))
+    ]
+    print(f"With DATA_QUOTA_CLEAR_USERS: {len(cleared)} users cleared, now {report['bytes_after'] / 2 ** 20:.2f} MB")
+    if report['bytes_after'] > janitor.max_bytes or not cleared or cleared != idle[:len(cleared)] or profiles_left:
+        sys.exit("Expected the least recently active users cleared, language profiles included")
+
+    blocker = os.open(os.path.join('data', janitor.LOCK_NAME), os.O_RDWR)
+    fcntl.flock(blocker, fcntl.LOCK_EX)
+    skipped = await janitor.sweep()
+    os.close(blocker)
+    print(f"Sweep while another process sweeps: {'skipped' if skipped is None else 'ran'}")
+    if skipped is not None:
+        sys.exit("Expected the sweep to be skipped")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    concurrency = subparsers.add_parser('concurrency', help='Concurrent conversations per worker')
+    concurrency.add_argument('--blocking', action='store_true', help='Fakes block the event loop')
+    concurrency.add_argument('--levels', type=lambda s: [int(x) for x in s.split(',')], default=[1, 2, 4, 8, 16, 32])
+    concurrency.add_argument('--llm-latency', type=float, default=1.0)
+    concurrency.add_argument('--tts-latency', type=float, default=0.5)
+    concurrency.add_argument('--telegram-latency', type=float, default=0.05)
+    concurrency.add_argument('--queue-workers', type=int, help='Override QUEUE_WORKERS')
+    concurrency.add_argument('--slowdown', type=float, default=2.0, help='Allowed p95 latency vs an idle turn')
+
+    turns = subparsers.add_parser('turns', help='LLM calls and history entries per turn')
+    turns.add_argument('--turns', type=int, default=5)
+    turns.add_argument('--workers', type=int, default=1, help='WORKERS, more than one runs the multi-process setup')
+
+    history = subparsers.add_parser('history', help='History store appends and reads')
+    history.add_argument('--users', type=int, default=10000)
+    history.add_argument('--turns', type=int, default=50, help='Turns written per user')
+    history.add_argument('--turn-chars', type=int, default=200, help='Characters per message')
+    history.add_argument('--max-tokens', type=int, default=16000, help='HISTORY_MAX_TOKENS')
+    history.add_argument('--samples', type=int, default=1000, help='Users timed after the fill')
+    history.add_argument('--legacy', action='store_true', help='Also time the old per-file layout')
+
+    transcode = subparsers.add_parser('transcode', help='Latency and peak RSS per audio conversion')
+    transcode.add_argument('--conversions', type=int, default=20)
+    transcode.add_argument('--seconds', type=int, default=30, help='Length of the test audio')
+    transcode.add_argument('--legacy', action='store_true', help='Also run the old pydub/temp file path, needs pydub')
+    transcode.add_argument('--worker', choices=['pipe', 'legacy'], help=argparse.SUPPRESS)
+    transcode.add_argument('--workdir', help=argparse.SUPPRESS)
+
+    audio = subparsers.add_parser('audio', help='Audio worker pool admission control')
+    audio.add_argument('--burst', type=int, default=100, help='Conversions started at once')
+    audio.add_argument('--workers', type=int, default=4, help='AUDIO_WORKERS')
+    audio.add_argument('--queue', type=int, default=16, help='AUDIO_QUEUE_SIZE')
+    audio.add_argument('--encode', type=float, default=0.1, help='Fake encode time')
+
+    config = subparsers.add_parser('config', help='Per-request cost of config and allow list lookups')
+    config.add_argument('--requests', type=int, default=100000)
+    config.add_argument('--users', type=int, default=10000, help='Lines in users.txt')
+
+    speech = subparsers.add_parser('speech', help='Speech cache hits, file_id reuse and invalidation')
+    speech.add_argument('--turns', type=int, default=5)
+
+    telegram = subparsers.add_parser('telegram', help='Outbound Telegram rate limiting against a stub Bot API server')
+    telegram.add_argument('--chats', type=int, default=50)
+    telegram.add_argument('--messages', type=int, default=3, help='Messages per chat')
+    telegram.add_argument('--hot-messages', type=int, default=8, help='Messages to a single chat')
+    telegram.add_argument('--requests', type=int, default=300, help='Sequential calls, pooled vs fresh')
+    telegram.add_argument('--port', type=int, default=5056)
+
+    progress = subparsers.add_parser('progress', help='Coalesced, rate-limited progress message edits')
+    progress.add_argument('--turns', type=int, default=3)
+    progress.add_argument('--interval', type=float, default=1.0, help='PROGRESS_INTERVAL')
+    progress.add_argument('--llm-latency', type=float, default=1.5)
+    progress.add_argument('--telegram-latency', type=float, default=0.2)
+    progress.add_argument('--retry-after', type=int, default=1, help='retry_after of the fake 429s')
+
+    tts = subparsers.add_parser('tts', help='TTS client against a local stub server')
+    tts.add_argument('--requests', type=int, default=200)
+    tts.add_argument('--fail-every', type=int, default=10, help='Stub answers 503 to every Nth request')
+    tts.add_argument('--latency', type=float, default=0.01, help='Stub synthesis time')
+    tts.add_argument('--port', type=int, default=5055)
+
+    load = subparsers.add_parser('load', help='Latency percentiles, throughput and RSS under load')
+    load.add_argument('--users', type=int, default=50)
+    load.add_argument('--concurrency', type=int, default=20, help='Users sending at once')
+    load.add_argument('--turns', type=int, default=3, help='Turns per user')
+    load.add_argument('--voice-ratio', type=float, default=0.5, help='Share of voice messages')
+    load.add_argument('--llm-latency', type=float, default=1.0)
+    load.add_argument('--stt-latency', type=float, default=0.3)
+    load.add_argument('--tts-latency', type=float, default=0.5)
+    load.add_argument('--timeout', type=float, default=120, help='Seconds to wait for one reply')
+    load.add_argument('--ffmpeg', action='store_true', help='Real audio conversions instead of fakes')
+    load.add_argument('--speech-cache', action='store_true', help='Keep the speech cache on')
+    load.add_argument('--telegram-port', type=int, default=8081)
+    load.add_argument('--tts-port', type=int, default=5057)
+
+    vad = subparsers.add_parser('vad', help='Silence trimming and chunked transcription of long voice messages')
+    vad.add_argument('--seconds', type=float, default=180, help='Length of the voice message')
+    vad.add_argument('--chunk-seconds', type=float, default=55, help='STT_CHUNK_SECONDS')
+    vad.add_argument('--stt-latency', type=float, default=0.3)
+    vad.add_argument('--realtime-factor', type=float, default=0.05, help='Fake STT time per second of audio')
+
+    languages = subparsers.add_parser('languages', help='Per-user language profiles narrowing STT languages')
+    languages.add_argument('--messages', type=int, default=10, help='Voice messages per language')
+    languages.add_argument('--stt-latency', type=float, default=0.2)
+    languages.add_argument('--language-latency', type=float, default=0.1, help='Fake STT time per language asked for')
+
+    reference = subparsers.add_parser('reference', help='Reference voice checks, cutting and normalization')
+    reference.add_argument('--seconds', type=int, default=600, help='Length of the uploaded recording')
+    reference.add_argument('--max-seconds', type=float, default=30, help='REFERENCE_MAX_SECONDS')
+
+    workers = subparsers.add_parser('workers', help='Per-user ordering and history across server processes')
+    workers.add_argument('--processes', type=int, default=4)
+    workers.add_argument('--turns', type=int, default=25, help='Turns per process')
+    workers.add_argument('--think', type=float, default=0.01, help='Seconds between reading and writing history')
+    workers.add_argument('--no-locks', action='store_true', help='Run without user locks and shared history')
+    workers.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    workers.add_argument('--workdir', help=argparse.SUPPRESS)
+
+    tracing = subparsers.add_parser('tracing', help='Per-turn overhead of sampled and full LangSmith tracing')
+    tracing.add_argument('--turns', type=int, default=200, help='Turns per mode')
+    tracing.add_argument('--sample-rate', type=float, default=0.1, help='TRACE_SAMPLE_RATE of the sampled mode')
+    tracing.add_argument('--collector-latency', type=float, default=0.05, help='LangSmith stand-in time per run')
+    tracing.add_argument('--queue-size', type=int, default=100, help='TRACE_QUEUE_SIZE')
+
+    startup = subparsers.add_parser('startup', help='Import time, time to ready and the first turn after a cold start')
+    startup.add_argument('--runs', type=int, default=3, help='Cold starts, the median is reported')
+    startup.add_argument('--no-warmup', action='store_true', help='WARMUP false')
+    startup.add_argument('--connect-latency', type=float, default=0.2, help='Stand-in time to open a connection')
+    startup.add_argument('--top', type=int, default=8, help='Slowest imports listed')
+    startup.add_argument('--history', help='JSONL file the results are appended to')
+    startup.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    startup.add_argument('--workdir', help=argparse.SUPPRESS)
+
+    llm_cache = subparsers.add_parser('llm_cache', help='Completion cache hits, skips, expiry and savings')
+    llm_cache.add_argument('--users', type=int, default=50)
+    llm_cache.add_argument('--common', type=int, default=5, help='Distinct common questions')
+    llm_cache.add_argument('--llm-latency', type=float, default=0.2)
+
+    janitor = subparsers.add_parser('janitor', help='Leftover cleanup, history compaction and disk quotas of data/')
+    janitor.add_argument('--users', type=int, default=500, help='Users with a small history')
+    janitor.add_argument('--orphans', type=int, default=50, help='Leftovers of each kind')
+    janitor.add_argument('--quota-kb', type=int, default=64, help='USER_QUOTA_MB in KB')
+
+    args = parser.parse_args()
+    if args.command == 'concurrency':
+        asyncio.run(concurrency_benchmark(args))
+    elif args.command == 'turns':
+        asyncio.run(turns_benchmark(args))
+    elif args.command == 'history':
+        history_benchmark(args)
+    elif args.command == 'transcode':
+        if args.worker:
+            transcode_worker(args)
+        else:
+            transcode_benchmark(args)
+    elif args.command == 'audio':
+        asyncio.run(audio_benchmark(args))
+    elif args.command == 'config':
+        config_benchmark(args)
+    elif args.command == 'speech':
+        asyncio.run(speech_benchmark(args))
+    elif args.command == 'telegram':
+        telegram_benchmark(args)
+    elif args.command == 'vad':
+        asyncio.run(vad_benchmark(args))
+    elif args.command == 'languages':
+        asyncio.run(languages_benchmark(args))
+    elif args.command == 'reference':
+        asyncio.run(reference_benchmark(args))
+    elif args.command == 'load':
+        asyncio.run(load_benchmark(args))
+    elif args.command == 'progress':
+        asyncio.run(progress_benchmark(args))
+    elif args.command == 'workers':
+        workers_benchmark(args)
+    elif args.command == 'tracing':
+        asyncio.run(tracing_benchmark(args))
+    elif args.command == 'startup':
+        startup_benchmark(args)
+    elif args.command == 'llm_cache':
+        asyncio.run(llm_cache_benchmark(args))
+    elif args.command == 'janitor':
+        asyncio.run(janitor_benchmark(args))
+    elif args.command == 'tts':
+        tts_benchmark(args)
+
+
+if __name__ == '__main__':
+    main()
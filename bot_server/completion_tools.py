@@ -0,0 +1,187 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_question(text: str) -> str:
+    """Question as far as the cache is concerned: NFKC, case-folded, single spaces, no outer punctuation"""
+    text = unicodedata.normalize('NFKC', text).casefold()
+    return ' '.join(text.split()).strip(' .!?…')
+
+
+def history_fingerprint(history: List[Tuple[str, str]]) -> str:
+    """Hash of the history window sent with a prompt"""
+    return hashlib.sha256(json.dumps(history, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+class CompletionCache:
+    """
+    LLM completions keyed by model, system prompt, language, history window
+    and normalized question, kept for ttl seconds. Recent entries live in
+    memory, evicted least recently used beyond max_entries. With a root the
+    entries are also written to one JSON file each, so they survive restarts
+    and are shared by server processes; files beyond max_disk_entries are
+    removed oldest first.
+    Every entry remembers what its completion cost, so hits add up the LLM
+    seconds and tokens they saved.
+    """
+
+    def __init__(self, ttl: float = 3600, max_entries: int = 1000, root: Optional[str] = None,
+                 max_disk_entries: int = 10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.root = root
+        self.max_disk_entries = max_disk_entries
+        self._entries = OrderedDict()  # key -> entry
+        self._files = OrderedDict()  # key -> expiry of the file, oldest written first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.skipped = 0
+        self.stores = 0
+        self.evictions = 0
+        self.saved_seconds = 0.0
+        self.saved_tokens = 0
+        if root:
+            os.makedirs(root, exist_ok=True)
+            self._scan()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, f"{key}.json")
+
+    def _scan(self):
+        entries = []
+        for name in os.listdir(self.root):
+            if name.endswith('.json'):
+                try:
+                    entries.append((os.path.getmtime(os.path.join(self.root, name)), name[:-len('.json')]))
+                except FileNotFoundError:
+                    pass
+        for mtime, key in sorted(entries):
+            self._files[key] = mtime + self.ttl
+
+    @staticmethod
+    def key(model: str, system_prompt: str, language: str, history: List[Tuple[str, str]], question: str) -> str:
+        material = json.dumps(
+            [model, system_prompt, language, history_fingerprint(history), normalize_question(question)],
+            ensure_ascii=False
+        )
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def _read_file(self, key: str) -> Optional[dict]:
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            logger.warning(f"Unreadable completion cache entry {key}: {e}")
+            return None
+
+    def _remove_file(self, key: str) -> None:
+        self._files.pop(key, None)
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def get(self, key: str) -> Optional[dict]:
+        """Cached {'reply', 'seconds', 'tokens'} or None, counted as a hit or miss; blocks on the disk tier"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry['expires'] <= now:
+                del self._entries[key]
+                entry = None
+            if entry is None and self.root:
+                # Another process may have written it, so the file is read even if this one never saw it
+                entry = self._read_file(key)
+                if entry is not None and entry['expires'] <= now:
+                    self._remove_file(key)
+                    entry = None
+                if entry is not None:
+                    self.disk_hits += 1
+                    self._files.setdefault(key, entry['expires'])
+                    self._remember(key, entry)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.saved_seconds += entry['seconds']
+            self.saved_tokens += entry['tokens']
+            return dict(entry)
+
+    def _remember(self, key: str, entry: dict) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def put(self, key: str, reply: str, seconds: float, tokens: int) -> None:
+        """Stores a completion with the LLM time and tokens it took; blocks on the disk tier"""
+        entry = {'reply': reply, 'seconds': seconds, 'tokens': tokens, 'expires': time.time() + self.ttl}
+        with self._lock:
+            self._remember(key, entry)
+            self.stores += 1
+            if not self.root:
+                return
+            tmp_path = f"{self._path(key)}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, self._path(key))
+            self._files[key] = entry['expires']
+            self._files.move_to_end(key)
+            while len(self._files) > self.max_disk_entries:
+                self._remove_file(next(iter(self._files)))
+
+    def purge(self) -> int:
+        """Removes expired entries from memory and disk, returns how many files were removed"""
+        now = time.time()
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if entry['expires'] <= now]:
+                del self._entries[key]
+            expired = [key for key, expires in self._files.items() if expires <= now]
+            for key in expired:
+                self._remove_file(key)
+            return len(expired)
+
+    def evict(self, bytes_needed: int = 0, files_needed: int = 0) -> Tuple[int, int]:
+        """Removes the oldest files of the disk tier until both amounts are freed, returns (bytes, files) freed"""
+        freed_bytes = freed_files = 0
+        with self._lock:
+            while self._files and (freed_bytes < bytes_needed or freed_files < files_needed):
+                key = next(iter(self._files))
+                try:
+                    freed_bytes += os.path.getsize(self._path(key))
+                except FileNotFoundError:
+                    pass
+                self._remove_file(key)
+                freed_files += 1
+        return freed_bytes, freed_files
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'disk_entries': len(self._files) if self.root else None,
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'skipped': self.skipped,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            'stores': self.stores,
+            'evictions': self.evictions,
+            'saved_llm_seconds': round(self.saved_seconds, 3),
+            'saved_tokens': self.saved_tokens
+        }
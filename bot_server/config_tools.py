@@ -0,0 +1,158 @@
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, FrozenSet, List
+
+logger = logging.getLogger(__name__)
+
+
+def read_text(path: str) -> str:
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def read_lines(path: str) -> List[str]:
+    """Non-empty lines of a file, stripped"""
+    return [line.strip() for line in read_text(path).splitlines() if line.strip()]
+
+
+def read_id_set(path: str) -> FrozenSet[str]:
+    return frozenset(read_lines(path))
+
+
+def read_json(path: str):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+class FileCache:
+    """
+    Parsed contents of one file, kept in memory and reloaded only when the
+    file's mtime or size changes. The file is stat'ed at most once per
+    check_interval seconds, so reads in between cost no I/O at all.
+    A missing file gives the default value, unless required, in which case
+    it is loaded right away and errors surface to the caller.
+    """
+
+    def __init__(self, path: str, parse: Callable, default=None, check_interval: float = 1.0,
+                 required: bool = False):
+        self.path = path
+        self.parse = parse
+        self.default = default
+        self.check_interval = check_interval
+        self.reloads = 0
+        self._value = default
+        self._signature = None
+        self._checked = 0.0
+        self._loaded = False
+        self._lock = threading.Lock()
+        if required:
+            self._signature = self._stat()
+            self._value = parse(path)
+            self._checked = time.monotonic()
+            self._loaded = True
+            self.reloads = 1
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _load(self, signature):
+        if signature is None:
+            if self.reloads:
+                # Keep serving the last version while the file is being replaced
+                logger.warning(f"{self.path} disappeared, keeping the previous version")
+            else:
+                logger.warning(f"{self.path} not found, using {self.default!r}")
+            self._signature = None
+            return
+        # Not retried until the file changes again
+        self._signature = signature
+        try:
+            self._value = self.parse(self.path)
+        except Exception as e:
+            # Keep serving the last good version of a half-written file
+            logger.error(f"Failed to load {self.path}, keeping the previous version: {e}")
+            return
+        self.reloads += 1
+        logger.info(f"Loaded {self.path}")
+
+    def get(self):
+        now = time.monotonic()
+        if now - self._checked >= self.check_interval:
+            with self._lock:
+                if now - self._checked >= self.check_interval:
+                    self._checked = now
+                    signature = self._stat()
+                    if signature != self._signature or not self._loaded:
+                        self._load(signature)
+                        self._loaded = True
+        return self._value
+
+    def reload(self):
+        """Re-reads the file now, whether it changed or not"""
+        with self._lock:
+            self._checked = time.monotonic()
+            self._load(self._stat())
+            self._loaded = True
+        return self._value
+
+
+class ConfigStore:
+    """
+    In-memory config.json, user allow list, supported languages and greeting,
+    each reloaded when its file changes or on reload().
+    Settings that size clients and pools are read once at startup; the
+    cached files and per-request keys like ACCESS_CONTROL apply live.
+    """
+
+    def __init__(self, config_path: str = 'config.json', users_path: str = 'data/users.txt',
+                 languages_path: str = 'BCP-47.txt', greeting_path: str = 'greeting.txt',
+                 check_interval: float = 1.0):
+        self._config = FileCache(config_path, read_json, {}, check_interval, required=True)
+        self._users = FileCache(users_path, read_id_set, frozenset(), check_interval)
+        self._languages = FileCache(languages_path, read_lines, [], check_interval)
+        self._greeting = FileCache(greeting_path, read_text, None, check_interval)
+
+    @property
+    def config(self) -> dict:
+        return self._config.get()
+
+    @property
+    def users(self) -> FrozenSet[str]:
+        return self._users.get()
+
+    @property
+    def languages(self) -> List[str]:
+        return self._languages.get()
+
+    @property
+    def greeting(self):
+        """Greeting text, None if greeting.txt is missing"""
+        return self._greeting.get()
+
+    def allowed(self, user_id) -> bool:
+        return str(user_id) in self.users
+
+    def reload(self) -> dict:
+        """Re-reads every file, returns what is loaded now"""
+        for cache in (self._config, self._users, self._languages, self._greeting):
+            cache.reload()
+        logger.info("Config reloaded")
+        return self.stats()
+
+    def stats(self) -> dict:
+        return {
+            'users': len(self.users),
+            'languages': len(self.languages),
+            'greeting': self.greeting is not None,
+            'reloads': {
+                os.path.basename(cache.path): cache.reloads
+                for cache in (self._config, self._users, self._languages, self._greeting)
+            }
+        }
@@ -0,0 +1,457 @@
+"""
+Local stand-ins for the external services the bot talks to.
+Used by benchmark.py and the tests to drive the server without network access or paid APIs.
+"""
+import array
+import asyncio
+import io
+import math
+import os
+import re
+import threading
+import time
+import wave
+from collections import defaultdict
+from types import SimpleNamespace
+
+from stt_tools import STTBackend
+from telegram_tools import TelegramError
+
+
+async def fake_wait(latency, blocking=False):
+    """Sleep for latency seconds, blocking the event loop if requested"""
+    if blocking:
+        # Reproduces a synchronous client called from async code
+        time.sleep(latency)
+    else:
+        await asyncio.sleep(latency)
+
+
+def write_silence(path, seconds=1.0, frame_rate=16000):
+    """Write a mono 16-bit PCM WAV file of silence to a path or file object"""
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(frame_rate)
+        f.writeframes(b'\x00\x00' * int(seconds * frame_rate))
+    return path
+
+
+def text_update(user_id, message_id, text):
+    return {
+        'message_id': message_id,
+        'from': {'id': user_id},
+        'chat': {'id': user_id},
+        'text': text
+    }
+
+
+def voice_update(user_id, message_id, file_path, duration=5):
+    return {
+        'message_id': message_id,
+        'from': {'id': user_id},
+        'chat': {'id': user_id},
+        'voice': {'file_id': file_path, 'duration': duration, 'mime_type': 'audio/ogg'}
+    }
+
+
+def document_update(user_id, message_id, file_path):
+    return {
+        'message_id': message_id,
+        'from': {'id': user_id},
+        'chat': {'id': user_id},
+        'document': {'file_id': file_path, 'mime_type': 'audio/ogg'}
+    }
+
+
+class FakeChatModel:
+    """Chat model answering every prompt with the same reply after a delay"""
+
+    def __init__(self, latency=1.0, reply="This is a fake reply. It has two sentences.", blocking=False,
+                 fail_after=None):
+        self.latency = latency
+        self.reply = reply
+        self.blocking = blocking
+        # Streaming raises after this many words, like a connection dropped mid-reply
+        self.fail_after = fail_after
+        self.calls = 0
+
+    def invoke(self, prompt, config=None):
+        self.calls += 1
+        time.sleep(self.latency)
+        return SimpleNamespace(content=self.reply)
+
+    async def ainvoke(self, prompt, config=None):
+        self.calls += 1
+        await fake_wait(self.latency, self.blocking)
+        return SimpleNamespace(content=self.reply)
+
+    async def astream(self, prompt, config=None):
+        """Streams the reply word by word, spread over the latency"""
+        self.calls += 1
+        words = self.reply.split(' ')
+        for i, word in enumerate(words):
+            if i == self.fail_after:
+                raise ConnectionError("LLM stream interrupted")
+            await fake_wait(self.latency / len(words), self.blocking)
+            yield SimpleNamespace(content=word if i == len(words) - 1 else word + ' ')
+
+
+class FakeLangSmith:
+    """LangSmith client stand-in that takes latency seconds per posted run, or fails when down"""
+
+    def __init__(self, latency=0.05, down=False):
+        self.latency = latency
+        self.down = down
+        self.runs = []
+
+    def create_run(self, name, inputs, run_type, **kwargs):
+        time.sleep(self.latency)
+        if self.down:
+            raise ConnectionError("LangSmith is unreachable")
+        self.runs.append({'name': name, 'run_type': run_type, **kwargs})
+
+
+class FakeTelegram:
+    """In-memory replacement for TelegramClient that records outgoing calls"""
+
+    def __init__(self, latency=0.05, blocking=False, rate_limited_edits=0, retry_after=1):
+        self.latency = latency
+        self.blocking = blocking
+        # The first rate_limited_edits edits answer 429 like a flood-limited chat
+        self.rate_limited_edits = rate_limited_edits
+        self.retry_after = retry_after
+        self.calls = defaultdict(int)
+        self.replies = defaultdict(list)
+        self.edits = defaultdict(list)
+        self._message_id = 0
+        self._done = defaultdict(asyncio.Event)
+
+    async def warmup(self):
+        await fake_wait(self.latency, self.blocking)
+        return {'id': 1, 'is_bot': True}
+
+    def _next_message(self, chat_id, text=None):
+        self._message_id += 1
+        return {'message_id': self._message_id, 'chat': {'id': chat_id}, 'text': text}
+
+    async def send_message(self, chat_id, text, reply_to_message_id=None, parse_mode=None):
+        self.calls['sendMessage'] += 1
+        await fake_wait(self.latency, self.blocking)
+        # Progress messages are MarkdownV2, final replies are not
+        if parse_mode != 'MarkdownV2':
+            self.replies[chat_id].append(text)
+            self._done[chat_id].set()
+        return self._next_message(chat_id, text)
+
+    async def edit_message_text(self, text, chat_id, message_id, parse_mode=None):
+        self.calls['editMessageText'] += 1
+        await fake_wait(self.latency, self.blocking)
+        if self.rate_limited_edits:
+            self.rate_limited_edits -= 1
+            raise TelegramError(
+                'editMessageText',
+                429,
+                f"Too Many Requests: retry after {self.retry_after}",
+                {'retry_after': self.retry_after}
+            )
+        self.edits[chat_id].append(text)
+        return self._next_message(chat_id, text)
+
+    async def get_file(self, file_id):
+        self.calls['getFile'] += 1
+        await fake_wait(self.latency, self.blocking)
+        return {'file_id': file_id, 'file_path': file_id}
+
+    async def send_voice(self, chat_id, voice, reply_to_message_id=None):
+        self.calls['sendVoice'] += 1
+        if isinstance(voice, str):
+            # Resent by file_id, no upload
+            self.calls['sendVoiceByFileId'] += 1
+        await fake_wait(self.latency, self.blocking)
+        self.replies[chat_id].append(voice)
+        self._done[chat_id].set()
+        message = self._next_message(chat_id)
+        message['voice'] = {'file_id': voice if isinstance(voice, str) else f"voice-{message['message_id']}"}
+        return message
+
+    def stats(self):
+        return dict(self.calls)
+
+    async def wait_reply(self, chat_id):
+        """Wait until the chat got its final text or voice reply"""
+        await self._done[chat_id].wait()
+        self._done[chat_id].clear()
+
+    async def aclose(self):
+        pass
+
+
+class FakeSTT(STTBackend):
+    """
+    Speech-to-text backend implementing stt_tools.STTBackend.
+    Returns the transcript split over several results, like long audio does.
+    """
+
+    def __init__(self, transcript="Hello there. How are you today?", language_code='en-us', parts=2, latency=0.3,
+                 realtime_factor=0.0, language_latency=0.0):
+        self.transcript = transcript
+        # The language spoken; recognition without it among the codes is unsure
+        self.language_code = language_code
+        # Recognition time per language code asked for, on top of latency
+        self.language_latency = language_latency
+        self.parts = parts
+        self.latency = latency
+        # Recognition time per second of audio, on top of latency
+        self.realtime_factor = realtime_factor
+        self.calls = 0
+        self.streamed_bytes = 0
+        self.billed_seconds = 0.0
+
+    async def warmup(self):
+        await asyncio.sleep(self.latency)
+
+    def _response(self, language_codes):
+        words = self.transcript.split()
+        size = max(1, -(-len(words) // self.parts))
+        codes = [code.lower() for code in language_codes]
+        understood = self.language_code in codes
+        results = [
+            SimpleNamespace(
+                language_code=self.language_code if understood else codes[0],
+                alternatives=[SimpleNamespace(
+                    transcript=" ".join(words[i:i + size]),
+                    confidence=0.9 if understood else 0.3
+                )]
+            )
+            for i in range(0, len(words), size)
+        ]
+        return SimpleNamespace(results=results)
+
+    async def transcribe(self, audio_file, language_codes):
+        self.calls += 1
+        with wave.open(io.BytesIO(audio_file), 'rb') as f:
+            seconds = f.getnframes() / f.getframerate()
+        self.billed_seconds += seconds
+        await asyncio.sleep(self.latency + seconds * self.realtime_factor + len(language_codes) * self.language_latency)
+        return self._response(language_codes)
+
+    async def transcribe_stream(self, chunks, language_codes):
+        self.calls += 1
+        async for chunk in chunks:
+            self.streamed_bytes += len(chunk)
+        await asyncio.sleep(self.latency + len(language_codes) * self.language_latency)
+        return self._response(language_codes)
+
+
+async def fake_stream_pcm(input_path, chunk_size=3200):
+    """Replacement for audio_tools.stream_pcm that needs no ffmpeg, input must be a WAV file"""
+    with wave.open(input_path, 'rb') as f:
+        while True:
+            chunk = f.readframes(chunk_size // 2)
+            if not chunk:
+                break
+            yield chunk
+            await asyncio.sleep(0)
+
+
+def silence_wav(seconds=1.0, frame_rate=16000):
+    """Contents of a mono 16-bit PCM WAV file of silence"""
+    buffer = io.BytesIO()
+    write_silence(buffer, seconds, frame_rate)
+    return buffer.getvalue()
+
+
+def tone_wav(seconds=1.0, frame_rate=16000, frequency=220):
+    """Contents of a mono 16-bit PCM WAV file of a sine tone, which voice activity detection takes for speech"""
+    frames = int(seconds * frame_rate)
+    samples = array.array('h', (
+        int(10000 * math.sin(2 * math.pi * frequency * i / frame_rate)) for i in range(frames)
+    ))
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(frame_rate)
+        f.writeframes(samples.tobytes())
+    return buffer.getvalue()
+
+
+async def fake_to_wav(source, sample_rate=16000):
+    """Replacement for audio_tools.to_wav that needs no ffmpeg, decodes everything to one second of tone"""
+    return tone_wav(frame_rate=sample_rate)
+
+
+async def fake_prepare_reference(path, max_seconds=30.0, min_seconds=3.0, min_sample_rate=16000,
+                                 max_bytes=20 * 2 ** 20, sample_rate=16000):
+    """Replacement for audio_tools.prepare_reference that needs no ffmpeg, input must be a WAV file"""
+    from audio_tools import AudioRejected
+
+    with wave.open(path, 'rb') as f:
+        duration = f.getnframes() / f.getframerate()
+        if os.path.getsize(path) > max_bytes:
+            raise AudioRejected(f"it is larger than {max_bytes / 2 ** 20:g} MB")
+        if duration < min_seconds:
+            raise AudioRejected(f"it is shorter than {min_seconds:g} seconds")
+        if f.getframerate() < min_sample_rate:
+            raise AudioRejected(f"its sample rate is below {min_sample_rate} Hz")
+        frames = f.readframes(int(max_seconds * f.getframerate()))
+        params = f.getparams()
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as out:
+        out.setparams(params)
+        out.writeframes(frames)
+    return buffer.getvalue()
+
+async def fake_wav_to_ogg(wav):
+    """Replacement for audio_tools.wav_to_ogg that needs no ffmpeg, returns the WAV unchanged"""
+    return wav
+
+
+class FakeTTS:
+    """Replacement for tts_tools.AsyncTTSClient returning silence after a delay"""
+
+    def __init__(self, latency=0.5, seconds=1.0, blocking=False):
+        self.latency = latency
+        self.seconds = seconds
+        self.blocking = blocking
+        self.calls = 0
+        self.uploads = 0
+
+    async def warmup(self):
+        await fake_wait(self.latency, self.blocking)
+
+    async def synthesize(self, text, language, reference_file=None):
+        self.calls += 1
+        await fake_wait(self.latency, self.blocking)
+        return silence_wav(self.seconds)
+
+    async def upload_reference_file(self, file_path, filename="reference.wav"):
+        self.uploads += 1
+        await fake_wait(self.latency, self.blocking)
+        return {'message': 'File uploaded successfully', 'filename': filename}
+
+    async def aclose(self):
+        pass
+
+
+def make_tts_stub(latency=0.2, seconds=1.0, fail_every=0):
+    """
+    FastAPI app mimicking the TTS server's /tts and /upload_reference.
+    With fail_every=N every Nth request answers 503 to exercise retries.
+    """
+    from fastapi import FastAPI, Request
+    from fastapi.responses import JSONResponse, Response
+
+    app = FastAPI()
+    app.state.requests = 0
+    app.state.references = {}
+    audio = silence_wav(seconds)
+
+    def should_fail():
+        app.state.requests += 1
+        return fail_every and app.state.requests % fail_every == 0
+
+    @app.post("/tts")
+    async def tts(request: Request):
+        payload = await request.json()
+        if should_fail():
+            return JSONResponse(status_code=503, content={'error': 'Stub failure'})
+        if not payload.get('text'):
+            return JSONResponse(status_code=400, content={'error': 'No text provided'})
+        await asyncio.sleep(latency)
+        return Response(content=audio, media_type='audio/wav')
+
+    @app.post("/upload_reference")
+    async def upload_reference(request: Request):
+        # Parsed by hand so the stub needs no python-multipart
+        body = await request.body()
+        if should_fail():
+            return JSONResponse(status_code=503, content={'error': 'Stub failure'})
+        match = re.search(rb'name="filename"\r\n\r\n(.*?)\r\n', body)
+        if not match:
+            return JSONResponse(status_code=400, content={'error': 'No filename provided'})
+        filename = match.group(1).decode()
+        app.state.references[filename] = len(body)
+        return {'message': 'File uploaded successfully', 'filename': filename}
+
+    return app
+
+
+def make_telegram_stub(rate=30.0, chat_rate=1.0, chat_burst=3, latency=0.0):
+    """
+    FastAPI app mimicking the Bot API server's sendMessage, sendVoice,
+    editMessageText and getFile. Callers over Telegram's global or per-chat
+    limits get 429 with retry_after, like flood control does. getFile
+    answers with the file_id as the local file path.
+    app.state.on_reply, if set, is called from the stub's thread with the
+    chat id and text of every final reply: a voice note or a plain text message.
+    """
+    import math
+    from urllib.parse import parse_qs
+    from fastapi import FastAPI, Request
+    from telegram_tools import TokenBucket
+
+    app = FastAPI()
+    app.state.requests = 0
+    app.state.rejected = 0
+    app.state.sent = defaultdict(int)
+    app.state.on_reply = None
+    limits = {'global': TokenBucket(rate, rate)}
+
+    def form_fields(body, content_type):
+        # Parsed by hand so the stub needs no python-multipart
+        if content_type.startswith('multipart/'):
+            return {
+                name.decode(): value.decode(errors='replace')
+                for name, value in re.findall(rb'name="(\w+)"\r\n\r\n(.*?)\r\n', body, re.S)
+            }
+        return {name: values[0] for name, values in parse_qs(body.decode()).items()}
+
+    @app.post("/bot{token}/{method}")
+    async def call(token: str, method: str, request: Request):
+        app.state.requests += 1
+        fields = form_fields(await request.body(), request.headers.get('content-type', ''))
+        chat_id = fields.get('chat_id')
+        await asyncio.sleep(latency)
+        if chat_id is not None:
+            if chat_id not in limits:
+                limits[chat_id] = TokenBucket(chat_rate, chat_burst)
+            waits = [limits[chat_id].reserve(), limits['global'].reserve()]
+            if max(waits) > 0:
+                # Rejected calls don't use up the limit
+                limits[chat_id].tokens += 1
+                limits['global'].tokens += 1
+                app.state.rejected += 1
+                retry_after = math.ceil(max(waits))
+                return {
+                    'ok': False,
+                    'error_code': 429,
+                    'description': f"Too Many Requests: retry after {retry_after}",
+                    'parameters': {'retry_after': retry_after}
+                }
+            app.state.sent[chat_id] += 1
+        if method == 'getFile':
+            file_id = fields.get('file_id')
+            return {'ok': True, 'result': {'file_id': file_id, 'file_path': file_id}}
+        final = method == 'sendVoice' or (method == 'sendMessage' and fields.get('parse_mode') != 'MarkdownV2')
+        if final and app.state.on_reply:
+            app.state.on_reply(chat_id, fields.get('text'))
+        result = {'message_id': app.state.requests, 'chat': {'id': chat_id}, 'text': fields.get('text')}
+        if method == 'sendVoice':
+            result['voice'] = {'file_id': f"voice-{app.state.requests}"}
+        return {'ok': True, 'result': result}
+
+    return app
+
+
+def serve_in_thread(app, port):
+    """Runs an ASGI app with uvicorn in a daemon thread, returns the uvicorn server"""
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=port, log_level='warning'))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    return server
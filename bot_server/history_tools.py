@@ -0,0 +1,633 @@
+import asyncio
+import contextlib
+import functools
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime
+from typing import Callable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+LOG_NAME = 'history.jsonl'
+SUMMARY_NAME = 'summary.json'
+# Files kept next to the history by other stores, never legacy turns
+OTHER_FILES = {SUMMARY_NAME, 'languages.json'}
+
+
+def estimate_tokens(messages: List[Tuple[str, str]]) -> int:
+    """Rough token count used when no tokenizer is configured."""
+    return sum(4 + len(text) // 4 for _, text in messages)
+
+
+def make_turn(message_id: str, messages: List[Tuple[str, str]], tokens: int) -> dict:
+    return {'message_id': str(message_id), 'messages': messages, 'tokens': tokens}
+
+
+class _UserLog:
+    """In-memory index of the live window of one user's log."""
+
+    def __init__(self, start: int):
+        # Byte offset of the oldest live turn
+        self.start = start
+        # (byte offset, byte size, tokens) of each live turn, oldest first
+        self.turns = deque()
+        # Running token count of the live window
+        self.tokens = 0
+        self.end = start
+        # (inode, size, mtime) of the log when the index was last in sync
+        self.signature = None
+
+
+class HistoryStore:
+    """
+    Conversation history kept as one append-only JSONL log per user in
+    data/users/{user_id}/history.jsonl, one turn per line with its token
+    count precomputed, so prompt building never has to tokenize history.
+
+    Every line records the byte offset where the live window starts after
+    it was written. Pruning only moves that offset forward, so writes never
+    rewrite or rescan the log, and loading a user reads the last line and
+    the live window only. The dead prefix is dropped by compact() once it
+    outgrows the live window.
+
+    With shared set, other processes may write the same logs (one at a time
+    per user, see queue_tools.FileLocks), so the index of a user is rebuilt
+    whenever the log changed on disk since this process last touched it.
+
+    Indexes and locks are kept for the max_users most recently used users;
+    an evicted user's index is rebuilt from the log on next use.
+    """
+
+    def __init__(self, root: str = 'data/users', max_tokens: int = 16000,
+                 count_tokens: Optional[Callable[[List[Tuple[str, str]]], int]] = None,
+                 compact_min_bytes: int = 64 * 1024, shared: bool = False, max_users: int = 10000):
+        self.root = root
+        # Tokens kept per user, older turns are pruned
+        self.max_tokens = max_tokens
+        self.count_tokens = count_tokens or estimate_tokens
+        self.compact_min_bytes = compact_min_bytes
+        self.shared = shared
+        self.max_users = max_users
+        self.reloads = 0
+        self.evictions = 0
+        self._logs = OrderedDict()
+        # user_id -> [lock, holders and waiters], dropped once unused and the index is evicted
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+
+    @contextlib.contextmanager
+    def _lock(self, user_id: str):
+        with self._locks_guard:
+            entry = self._locks.get(user_id)
+            if entry is None:
+                entry = self._locks[user_id] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._locks_guard:
+                entry[1] -= 1
+                if not entry[1] and user_id not in self._logs:
+                    del self._locks[user_id]
+
+    def _remember(self, user_id: str, log: _UserLog) -> None:
+        """Keeps the index of a user, evicting the least recently used unlocked ones past max_users."""
+        with self._locks_guard:
+            self._logs[user_id] = log
+            self._logs.move_to_end(user_id)
+            candidates = len(self._logs)
+            while len(self._logs) > self.max_users and candidates:
+                candidates -= 1
+                oldest = next(iter(self._logs))
+                entry = self._locks.get(oldest)
+                if entry is not None and entry[1]:
+                    # In use, its lock has to stay the one all threads share
+                    self._logs.move_to_end(oldest)
+                    continue
+                del self._logs[oldest]
+                self._locks.pop(oldest, None)
+                self.evictions += 1
+
+    def _dir(self, user_id: str) -> str:
+        return os.path.join(self.root, str(user_id))
+
+    def _log_path(self, user_id: str) -> str:
+        return os.path.join(self._dir(user_id), LOG_NAME)
+
+    def _signature(self, user_id: str):
+        try:
+            stat = os.stat(self._log_path(user_id))
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def _load(self, user_id: str) -> _UserLog:
+        """Returns the index of the user's log, building it from disk on first use."""
+        log = self._logs.get(user_id)
+        if log is not None:
+            if not self.shared or log.signature == self._signature(user_id):
+                with self._locks_guard:
+                    self._logs.move_to_end(user_id)
+                return log
+            self.reloads += 1
+
+        path = self._log_path(user_id)
+        if not os.path.exists(path):
+            migrate_legacy_history(self._dir(user_id), self.count_tokens)
+        if not os.path.exists(path):
+            log = _UserLog(0)
+            self._remember(user_id, log)
+            return log
+
+        with open(path, 'rb') as f:
+            last = read_last_line(f)
+            start = json.loads(last).get('start', 0) if last else 0
+            log = _UserLog(start)
+            f.seek(start)
+            offset = start
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Torn write from a crash, the next append overwrites it
+                    break
+                record = json.loads(line)
+                tokens = record.get('tokens')
+                if tokens is None:
+                    tokens = self.count_tokens([tuple(message) for message in record['messages']])
+                log.turns.append((offset, len(line), tokens))
+                log.tokens += tokens
+                offset += len(line)
+            log.end = offset
+        log.signature = self._signature(user_id)
+        self._remember(user_id, log)
+        return log
+
+    def append(self, user_id: str, message_id: str, messages: List[Tuple[str, str]]) -> Tuple[dict, int]:
+        """
+        Appends one turn, a list of (role, text) pairs, and prunes the live window.
+        Returns the stored turn and the number of oldest turns pruned.
+        """
+        user_id = str(user_id)
+        tokens = self.count_tokens(messages)
+        with self._lock(user_id):
+            log = self._load(user_id)
+
+            # Drop the oldest turns past max_tokens, always keeping the new one
+            total = log.tokens + tokens
+            pruned = 0
+            while total > self.max_tokens and log.turns:
+                _, _, old_tokens = log.turns.popleft()
+                total -= old_tokens
+                pruned += 1
+            log.tokens = total
+            log.start = log.turns[0][0] if log.turns else log.end
+
+            record = {
+                'message_id': str(message_id),
+                'date': datetime.now().strftime('%Y%m%d_%H%M%S'),
+                'messages': [[role, text] for role, text in messages],
+                'tokens': tokens,
+                'start': log.start
+            }
+            line = (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+
+            if log.end == 0:
+                os.makedirs(self._dir(user_id), exist_ok=True)
+                mode = 'wb'
+            else:
+                mode = 'r+b'
+            with open(self._log_path(user_id), mode) as f:
+                f.seek(log.end)
+                f.write(line)
+                f.truncate()
+            log.turns.append((log.end, len(line), tokens))
+            log.end += len(line)
+
+            if log.start >= self.compact_min_bytes and log.start > log.end - log.start:
+                self._compact(user_id, log)
+            log.signature = self._signature(user_id)
+            return make_turn(message_id, list(messages), tokens), pruned
+
+    def read_turns(self, user_id: str) -> List[dict]:
+        """
+        Returns the live window as a list of turns, oldest first.
+        A turn is a dict with message_id, messages as (role, text) pairs and tokens.
+        """
+        user_id = str(user_id)
+        with self._lock(user_id):
+            log = self._load(user_id)
+            if not log.turns:
+                return []
+            with open(self._log_path(user_id), 'rb') as f:
+                f.seek(log.start)
+                data = f.read(log.end - log.start)
+            tokens = [turn_tokens for _, _, turn_tokens in log.turns]
+
+        turns = []
+        for line, turn_tokens in zip(data.splitlines(), tokens):
+            record = json.loads(line)
+            messages = [(role, text) for role, text in record['messages']]
+            turns.append(make_turn(record.get('message_id'), messages, turn_tokens))
+        return turns
+
+    def read(self, user_id: str) -> List[Tuple[str, str]]:
+        """Returns the live window as a list of (role, text) tuples, oldest first."""
+        return flatten_turns(self.read_turns(user_id))
+
+    def clear(self, user_id: str) -> None:
+        """Removes the user's log."""
+        user_id = str(user_id)
+        with self._lock(user_id):
+            if os.path.exists(self._log_path(user_id)):
+                os.remove(self._log_path(user_id))
+            self._remember(user_id, _UserLog(0))
+
+    def compact(self, user_id: str) -> int:
+        """Rewrites the user's log without the pruned prefix, returns the bytes reclaimed."""
+        user_id = str(user_id)
+        with self._lock(user_id):
+            if user_id not in self._logs and self._stored_start(user_id) == 0:
+                # Nothing to drop, so the index of an idle user isn't built just to find that out
+                return 0
+            log = self._load(user_id)
+            if log.start == 0:
+                return 0
+            return self._compact(user_id, log)
+
+    def _stored_start(self, user_id: str) -> Optional[int]:
+        """Start offset recorded in the log's last line, None without a log."""
+        try:
+            with open(self._log_path(user_id), 'rb') as f:
+                last = read_last_line(f)
+        except FileNotFoundError:
+            return None
+        return json.loads(last).get('start', 0) if last else 0
+
+    def trim(self, user_id: str, max_bytes: int) -> int:
+        """Drops the oldest turns until the user's log fits max_bytes, returns the bytes reclaimed."""
+        user_id = str(user_id)
+        with self._lock(user_id):
+            log = self._load(user_id)
+            if log.end <= max_bytes:
+                return 0
+            size = log.end
+            while log.turns and log.end - log.turns[0][0] > max_bytes:
+                _, _, tokens = log.turns.popleft()
+                log.tokens -= tokens
+            log.start = log.turns[0][0] if log.turns else log.end
+            self._compact(user_id, log)
+            return size - log.end
+
+    def _compact(self, user_id: str, log: _UserLog) -> int:
+        path = self._log_path(user_id)
+        with open(path, 'rb') as f:
+            f.seek(log.start)
+            lines = f.read(log.end - log.start).splitlines()
+
+        # Offsets shift, so the live turns are rewritten with start 0
+        log.turns = deque()
+        offset = 0
+        with open(path + '.tmp', 'wb') as f:
+            for line in lines:
+                record = json.loads(line)
+                record['start'] = 0
+                if record.get('tokens') is None:
+                    record['tokens'] = self.count_tokens([tuple(message) for message in record['messages']])
+                line = (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+                f.write(line)
+                log.turns.append((offset, len(line), record['tokens']))
+                offset += len(line)
+        # Keeps the time of the last turn, which tells how recently the user was active
+        stat = os.stat(path)
+        os.utime(path + '.tmp', ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        os.replace(path + '.tmp', path)
+        reclaimed = log.end - offset
+        log.start = 0
+        log.end = offset
+        log.signature = self._signature(user_id)
+        return reclaimed
+
+
+class HistoryCache:
+    """
+    Bounded LRU of per-user history windows in front of a HistoryStore.
+    Writes go through to the store and update the cached window in place,
+    so a user's history is read from disk at most once while it stays hot.
+    Memory is capped by user count and by an estimate of the cached text size.
+    """
+
+    # Rough per-message overhead of the tuple, list and str objects
+    MESSAGE_OVERHEAD = 100
+
+    def __init__(self, store: HistoryStore, max_users: int = 10000, max_bytes: int = 64 * 2 ** 20):
+        self.store = store
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        # user_id -> [disk reads in flight, writes since they started], so a slow read can't cache a stale window
+        self._reads = {}
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    def _turn_size(cls, turn: dict) -> int:
+        return sum(len(text) + cls.MESSAGE_OVERHEAD for _, text in turn['messages'])
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_users or self.bytes > self.max_bytes):
+            _, (_, size) = self._entries.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+
+    def _drop(self, user_id):
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+        if user_id in self._reads:
+            self._reads[user_id][1] += 1
+
+    def read_turns(self, user_id: str) -> List[dict]:
+        user_id = str(user_id)
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return list(entry[0])
+            self.misses += 1
+            reads = self._reads.setdefault(user_id, [0, 0])
+            reads[0] += 1
+            writes = reads[1]
+
+        try:
+            turns = self.store.read_turns(user_id)
+        finally:
+            with self._lock:
+                reads[0] -= 1
+                if not reads[0]:
+                    del self._reads[user_id]
+        with self._lock:
+            if reads[1] == writes and user_id not in self._entries:
+                size = sum(self._turn_size(turn) for turn in turns)
+                self._entries[user_id] = (deque(turns), size)
+                self.bytes += size
+                self._evict()
+        return turns
+
+    def read(self, user_id: str) -> List[Tuple[str, str]]:
+        return flatten_turns(self.read_turns(user_id))
+
+    def append(self, user_id: str, message_id: str, messages: List[Tuple[str, str]]) -> Tuple[dict, int]:
+        user_id = str(user_id)
+        turn, pruned = self.store.append(user_id, message_id, messages)
+        with self._lock:
+            entry = self._entries.get(user_id)
+            self._drop(user_id)
+            if entry is not None:
+                # Mirror the store: drop the pruned turns, add the new one
+                turns, size = entry
+                for _ in range(pruned):
+                    size -= self._turn_size(turns.popleft())
+                turns.append(turn)
+                size += self._turn_size(turn)
+                self._entries[user_id] = (turns, size)
+                self.bytes += size
+                self._evict()
+        return turn, pruned
+
+    def clear(self, user_id: str) -> None:
+        user_id = str(user_id)
+        self.store.clear(user_id)
+        with self._lock:
+            self._drop(user_id)
+
+    def compact(self, user_id: str) -> int:
+        return self.store.compact(user_id)
+
+    def trim(self, user_id: str, max_bytes: int) -> int:
+        user_id = str(user_id)
+        reclaimed = self.store.trim(user_id, max_bytes)
+        if reclaimed:
+            with self._lock:
+                self._drop(user_id)
+        return reclaimed
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'users': len(self._entries),
+                'max_users': self.max_users,
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0
+            }
+
+
+class HistorySummarizer:
+    """
+    Rolling summary of the turns that no longer fit the prompt budget.
+    Summaries are computed in the background and cached in memory and in
+    data/users/{user_id}/summary.json. A turn uses whatever summary is
+    ready and never waits for a new one.
+    """
+
+    def __init__(self, llm, root: str = 'data/users', max_tokens: int = 300, executor=None):
+        self.llm = llm
+        self.root = root
+        # Tokens of the prompt budget reserved for the summary
+        self.max_tokens = max_tokens
+        # Pool for the blocking file I/O, the loop's default one without it
+        self.executor = executor
+        self._cache = {}
+        self._pending = set()
+        # Running updates, referenced here since the event loop keeps only weak references
+        self._tasks = set()
+
+    async def _blocking(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(func, *args))
+
+    def _path(self, user_id: str) -> str:
+        return os.path.join(self.root, str(user_id), SUMMARY_NAME)
+
+    def _read(self, user_id: str) -> Optional[dict]:
+        try:
+            with open(self._path(user_id), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, user_id: str, entry: dict) -> None:
+        path = self._path(user_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(path + '.tmp', path)
+
+    async def get(self, user_id: str, older_turns: List[dict]) -> Optional[str]:
+        """
+        Returns the cached summary for the user, if any, and schedules a refresh
+        when it doesn't cover the newest of older_turns yet.
+        """
+        user_id = str(user_id)
+        if not older_turns:
+            return None
+        if user_id not in self._cache:
+            self._cache[user_id] = await self._blocking(self._read, user_id)
+        entry = self._cache[user_id]
+        if (entry is None or entry['upto'] != older_turns[-1]['message_id']) and user_id not in self._pending:
+            self._pending.add(user_id)
+            task = asyncio.create_task(self._update(user_id, entry, older_turns))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return entry['summary'] if entry else None
+
+    async def _update(self, user_id: str, entry: Optional[dict], older_turns: List[dict]) -> None:
+        try:
+            # Only turns after the last summarized one are new. If that turn was
+            # pruned from the log, everything still in it is newer.
+            new_turns = older_turns
+            if entry:
+                ids = [turn['message_id'] for turn in older_turns]
+                if entry['upto'] in ids:
+                    new_turns = older_turns[ids.index(entry['upto']) + 1:]
+            if not new_turns:
+                return
+
+            transcript = "\n".join(f"{role}: {text}" for role, text in flatten_turns(new_turns))
+            previous = entry['summary'] if entry else "(none)"
+            response = await self.llm.ainvoke([
+                ("system", "You maintain a short running summary of a conversation between a user "
+                           "and the assistant Janet. Keep facts about the user, their requests and "
+                           f"decisions made. Answer with the updated summary only, under {self.max_tokens // 2} words."),
+                ("human", f"Current summary:\n{previous}\n\nNew messages:\n{transcript}")
+            ])
+            entry = {'upto': older_turns[-1]['message_id'], 'summary': response.content}
+            self._cache[user_id] = entry
+            await self._blocking(self._write, user_id, entry)
+        except Exception as e:
+            logger.error(f"Error summarizing history of user {user_id}: {e}")
+        finally:
+            self._pending.discard(user_id)
+
+    def clear(self, user_id: str) -> None:
+        user_id = str(user_id)
+        self._cache[user_id] = None
+        if os.path.exists(self._path(user_id)):
+            os.remove(self._path(user_id))
+
+
+def flatten_turns(turns: List[dict]) -> List[Tuple[str, str]]:
+    """Turns as a flat list of (role, text) messages for the prompt."""
+    return [message for turn in turns for message in turn['messages']]
+
+
+def read_last_line(f, chunk_size: int = 4096) -> bytes:
+    """Returns the last complete line of a binary file, b'' if there is none."""
+    f.seek(0, os.SEEK_END)
+    end = f.tell()
+    data = b''
+    position = end
+    while position > 0:
+        step = min(chunk_size, position)
+        position -= step
+        f.seek(position)
+        data = f.read(step) + data
+        # Skip a torn trailing line, then look for the newline before the last one
+        complete = data[:data.rfind(b'\n') + 1]
+        if complete and (complete.rfind(b'\n', 0, len(complete) - 1) >= 0 or position == 0):
+            return complete[complete.rfind(b'\n', 0, len(complete) - 1) + 1:]
+    return b''
+
+
+def parse_legacy_message(message_data: dict) -> List[Tuple[str, str]]:
+    """Converts one legacy per-turn JSON file to (role, text) pairs."""
+    if 'user' in message_data and 'assistant' in message_data:
+        # New format
+        return [("user", message_data['user']), ("assistant", message_data['assistant'])]
+    if isinstance(message_data.get('content'), dict):
+        # Old conversation format
+        content = message_data['content']
+        return [("user", content['user_message']), ("assistant", content['assistant_response'])]
+    if 'role' in message_data:
+        # Legacy single message format
+        return [(message_data['role'], message_data['content'])]
+    # Single message written as {role: text}
+    return [(role, text) for role, text in message_data.items()]
+
+
+def migrate_legacy_history(user_dir: str, count_tokens=None) -> int:
+    """
+    Moves a user's legacy one-file-per-turn history into history.jsonl.
+    Unreadable files are kept, renamed to *.bad. Returns the number of migrated files.
+    """
+    if not os.path.isdir(user_dir):
+        return 0
+    files = []
+    for name in os.listdir(user_dir):
+        if name.endswith('.json') and name not in OTHER_FILES:
+            filepath = os.path.join(user_dir, name)
+            files.append((os.path.getctime(filepath), name, filepath))
+    if not files:
+        return 0
+
+    # Sort files by creation time (oldest first)
+    files.sort()
+    lines = []
+    migrated = []
+    unreadable = []
+    for _, name, filepath in files:
+        try:
+            with open(filepath, 'r', encoding='utf-8') as f:
+                messages = parse_legacy_message(json.load(f))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.warning(f"Keeping unreadable history file {filepath} as {filepath}.bad: {e}")
+            unreadable.append(filepath)
+            continue
+        record = {
+            'message_id': os.path.splitext(name)[0].split('_')[-1],
+            'date': datetime.fromtimestamp(os.path.getctime(filepath)).strftime('%Y%m%d_%H%M%S'),
+            'messages': [[role, text] for role, text in messages],
+            'tokens': (count_tokens or estimate_tokens)(messages),
+            'start': 0
+        }
+        lines.append(json.dumps(record, ensure_ascii=False) + '\n')
+        migrated.append(filepath)
+
+    log_path = os.path.join(user_dir, LOG_NAME)
+    with open(log_path + '.tmp', 'w', encoding='utf-8') as f:
+        f.writelines(lines)
+    os.replace(log_path + '.tmp', log_path)
+    # Only turns now in the log are removed, the others no longer end in .json
+    for filepath in migrated:
+        os.remove(filepath)
+    for filepath in unreadable:
+        os.replace(filepath, filepath + '.bad')
+    logger.info(f"Migrated {len(migrated)} legacy history files in {user_dir}")
+    return len(migrated)
+
+
+def migrate_all(root: str = 'data/users') -> int:
+    """One-time migration of every user directory, returns the number of files migrated."""
+    if not os.path.isdir(root):
+        return 0
+    total = 0
+    for user_id in os.listdir(root):
+        user_dir = os.path.join(root, user_id)
+        if not os.path.exists(os.path.join(user_dir, LOG_NAME)):
+            total += migrate_legacy_history(user_dir)
+    return total
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    print(f"Migrated {migrate_all()} legacy history files")
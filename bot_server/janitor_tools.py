@@ -0,0 +1,336 @@
+import asyncio
+import contextlib
+import fcntl
+import functools
+import logging
+import os
+import re
+import shutil
+import time
+from typing import List, Optional, Tuple
+
+from history_tools import LOG_NAME
+from language_tools import PROFILE_NAME
+
+logger = logging.getLogger(__name__)
+
+# Temp directories of convert_audio_to_wav in older versions: data/<uuid>/audio.wav
+UUID_NAME = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$')
+# Files of tts_tools.generate_speech: data/speech_<uuid>.wav
+SPEECH_NAME = re.compile(r'^speech_[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\.wav$')
+CATEGORIES = ('orphans', 'locks', 'llm_cache', 'history', 'quota')
+
+
+def usage(path: str) -> Tuple[int, int, float]:
+    """Bytes of the files under path, the files and directories counted as inodes, and the newest mtime"""
+    size = inodes = 0
+    newest = 0.0
+    for directory, dirs, files in os.walk(path):
+        inodes += len(dirs)
+        for name in files:
+            try:
+                stat = os.lstat(os.path.join(directory, name))
+            except FileNotFoundError:
+                continue
+            size += stat.st_size
+            inodes += 1
+            newest = max(newest, stat.st_mtime)
+    return size, inodes, newest
+
+
+@contextlib.asynccontextmanager
+async def _unlocked(user_id):
+    yield
+
+
+class Janitor:
+    """
+    Keeps data/ bounded. A sweep removes what failed requests left behind
+    once it is older than orphan_age: data/<uuid>/ audio directories,
+    data/speech_<uuid>.wav files, half-written *.tmp files and idle lock
+    files. It drops expired completions, compacts every history log and cuts
+    users over user_max_bytes down to their newest turns; legacy per-turn
+    history files are merged into the log on the way, which is what keeps
+    users under user_max_files.
+    Over max_bytes or max_files for the whole of data/, cached voice notes
+    and completions are evicted first, then the histories of the least
+    recently active users are cut down to their newest quota_keep_bytes.
+    Only with clear_users set are whole users cleared after that.
+    Users are swept under their turn lock, and only one process sweeps at a
+    time: the others skip while data/janitor.lock is held.
+    """
+
+    LOCK_NAME = 'janitor.lock'
+
+    def __init__(self, root: str = 'data', history=None, summarizer=None, languages=None, locks=None,
+                 lock_files=None, speech_cache=None, completion_cache=None, orphan_age: float = 3600,
+                 user_max_bytes: Optional[int] = None, user_max_files: Optional[int] = None,
+                 max_bytes: Optional[int] = None, max_files: Optional[int] = None,
+                 quota_keep_bytes: int = 64 * 1024, clear_users: bool = False, executor=None):
+        self.root = root
+        self.users_root = os.path.join(root, 'users')
+        self.history = history
+        self.summarizer = summarizer
+        # language_tools.LanguageProfiles, forgotten along with a cleared user
+        self.languages = languages
+        # Per-user turn locks (queue_tools.FileLocks or RedisLocks), None within one process
+        self.locks = locks
+        # queue_tools.FileLocks whose idle lock files are pruned
+        self.lock_files = lock_files
+        self.speech_cache = speech_cache
+        self.completion_cache = completion_cache
+        self.orphan_age = orphan_age
+        self.user_max_bytes = user_max_bytes
+        self.user_max_files = user_max_files
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.quota_keep_bytes = quota_keep_bytes
+        self.clear_users = clear_users
+        self.executor = executor
+        self.sweeps = 0
+        self.skipped = 0
+        self.errors = 0
+        self.reclaimed_bytes = 0
+        self.reclaimed_files = 0
+        self.last = None
+
+    async def _blocking(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args))
+
+    def _hold(self, user_id):
+        return self.locks.hold(user_id) if self.locks else _unlocked(user_id)
+
+    @staticmethod
+    def _add(report: dict, category: str, size: int, files: int) -> None:
+        report['reclaimed'][category]['bytes'] += size
+        report['reclaimed'][category]['files'] += files
+
+    def _acquire(self) -> Optional[int]:
+        os.makedirs(self.root, exist_ok=True)
+        fd = os.open(os.path.join(self.root, self.LOCK_NAME), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return fd
+        except BlockingIOError:
+            os.close(fd)
+            return None
+
+    def _users(self) -> List[str]:
+        try:
+            return sorted(
+                name for name in os.listdir(self.users_root)
+                if os.path.isdir(os.path.join(self.users_root, name))
+            )
+        except FileNotFoundError:
+            return []
+
+    def _remove_orphans(self, report: dict) -> None:
+        cutoff = time.time() - self.orphan_age
+        try:
+            entries = list(os.scandir(self.root))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            try:
+                if entry.stat(follow_symlinks=False).st_mtime > cutoff:
+                    continue
+                if UUID_NAME.match(entry.name) and entry.is_dir(follow_symlinks=False):
+                    size, inodes, _ = usage(entry.path)
+                    shutil.rmtree(entry.path)
+                    self._add(report, 'orphans', size, inodes + 1)
+                elif SPEECH_NAME.match(entry.name) and entry.is_file(follow_symlinks=False):
+                    size = entry.stat(follow_symlinks=False).st_size
+                    os.remove(entry.path)
+                    self._add(report, 'orphans', size, 1)
+            except FileNotFoundError:
+                continue
+
+        # Atomic writes leave *.tmp behind when the process dies between write and rename
+        directories = [self.root] + [os.path.join(self.users_root, user_id) for user_id in self._users()]
+        if self.speech_cache:
+            directories.append(self.speech_cache.root)
+        if self.completion_cache and self.completion_cache.root:
+            directories.append(self.completion_cache.root)
+        for directory in directories:
+            try:
+                entries = list(os.scandir(directory))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                if not entry.name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                    if stat.st_mtime <= cutoff and entry.is_file(follow_symlinks=False):
+                        os.remove(entry.path)
+                        self._add(report, 'orphans', stat.st_size, 1)
+                except FileNotFoundError:
+                    continue
+
+    def _expire(self, report: dict) -> None:
+        if self.lock_files:
+            self._add(report, 'locks', 0, self.lock_files.prune(self.orphan_age))
+        if self.completion_cache:
+            root = self.completion_cache.root
+            before = usage(root)[0] if root else 0
+            removed = self.completion_cache.purge()
+            after = usage(root)[0] if root else 0
+            self._add(report, 'llm_cache', max(0, before - after), removed)
+
+    def _tidy_user(self, user_id: str, report: dict) -> None:
+        user_dir = os.path.join(self.users_root, user_id)
+        size, inodes, _ = usage(user_dir)
+        # Loading the log merges legacy per-turn files into it, compaction drops the pruned prefix
+        self.history.compact(user_id)
+        if self.user_max_bytes:
+            now_size = usage(user_dir)[0]
+            if now_size > self.user_max_bytes:
+                log_path = os.path.join(user_dir, LOG_NAME)
+                log_size = os.path.getsize(log_path) if os.path.exists(log_path) else 0
+                # The other files stay, the log gets what is left of the quota
+                self.history.trim(user_id, max(0, self.user_max_bytes - (now_size - log_size)))
+                report['trimmed_users'].append(user_id)
+        after_size, after_inodes, _ = usage(user_dir)
+        self._add(report, 'history', max(0, size - after_size), max(0, inodes - after_inodes))
+        if self.user_max_files and after_inodes > self.user_max_files:
+            logger.warning(f"User {user_id} keeps {after_inodes} files, over the quota of {self.user_max_files}")
+
+    def _evict_caches(self, excess_bytes: int, excess_files: int, report: dict) -> Tuple[int, int]:
+        for cache in (self.speech_cache, self.completion_cache):
+            if cache is None or (excess_bytes <= 0 and excess_files <= 0):
+                continue
+            size, files = cache.evict(max(0, excess_bytes), max(0, excess_files))
+            self._add(report, 'quota', size, files)
+            excess_bytes -= size
+            excess_files -= files
+        return excess_bytes, excess_files
+
+    def _idle_users(self) -> List[Tuple[float, str]]:
+        """Users with their newest file's mtime, least recently active first"""
+        users = []
+        for user_id in self._users():
+            size, _, newest = usage(os.path.join(self.users_root, user_id))
+            if size:
+                users.append((newest, user_id))
+        return sorted(users)
+
+    def _trim_user(self, user_id: str, excess_bytes: int, report: dict) -> int:
+        """Drops the user's oldest turns, down to quota_keep_bytes of log at most, returns the bytes freed"""
+        log_path = os.path.join(self.users_root, user_id, LOG_NAME)
+        log_size = os.path.getsize(log_path) if os.path.exists(log_path) else 0
+        if log_size <= self.quota_keep_bytes:
+            return 0
+        freed = self.history.trim(user_id, max(self.quota_keep_bytes, log_size - excess_bytes))
+        if freed:
+            self._add(report, 'quota', freed, 0)
+            if user_id not in report['trimmed_users']:
+                report['trimmed_users'].append(user_id)
+        return freed
+
+    def _clear_user(self, user_id: str, report: dict) -> Tuple[int, int]:
+        user_dir = os.path.join(self.users_root, user_id)
+        size, inodes, _ = usage(user_dir)
+        self.history.clear(user_id)
+        if self.summarizer:
+            self.summarizer.clear(user_id)
+        if self.languages:
+            self.languages.clear(user_id)
+        else:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(user_dir, PROFILE_NAME))
+        after_size, after_inodes, _ = usage(user_dir)
+        freed = (max(0, size - after_size), max(0, inodes - after_inodes))
+        self._add(report, 'quota', *freed)
+        report['cleared_users'].append(user_id)
+        return freed
+
+    async def _enforce_quota(self, report: dict) -> None:
+        if not self.max_bytes and not self.max_files:
+            return
+        size, inodes, _ = await self._blocking(usage, self.root)
+        excess_bytes = size - self.max_bytes if self.max_bytes else 0
+        excess_files = inodes - self.max_files if self.max_files else 0
+        if excess_bytes <= 0 and excess_files <= 0:
+            return
+        excess_bytes, excess_files = await self._blocking(self._evict_caches, excess_bytes, excess_files, report)
+        if (excess_bytes <= 0 and excess_files <= 0) or self.history is None:
+            return
+        idle = await self._blocking(self._idle_users)
+        # The oldest turns go first, every user keeps the newest ones
+        for _, user_id in idle:
+            if excess_bytes <= 0:
+                break
+            async with self._hold(user_id):
+                excess_bytes -= await self._blocking(self._trim_user, user_id, excess_bytes, report)
+        if report['trimmed_users']:
+            logger.warning(f"data/ over quota, dropped the oldest turns of {len(report['trimmed_users'])} idle users")
+        for _, user_id in idle if self.clear_users else ():
+            if excess_bytes <= 0 and excess_files <= 0:
+                break
+            async with self._hold(user_id):
+                freed_bytes, freed_files = await self._blocking(self._clear_user, user_id, report)
+            excess_bytes -= freed_bytes
+            excess_files -= freed_files
+        if report['cleared_users']:
+            logger.warning(f"data/ over quota, cleared the history of {len(report['cleared_users'])} idle users")
+        if excess_bytes > 0 or excess_files > 0:
+            logger.warning(f"data/ still over quota by {max(0, excess_bytes)} bytes and {max(0, excess_files)} files")
+
+    async def sweep(self) -> Optional[dict]:
+        """One pass over data/, returns its report, or None when another process is sweeping"""
+        fd = await self._blocking(self._acquire)
+        if fd is None:
+            self.skipped += 1
+            return None
+        try:
+            started = time.perf_counter()
+            report = {
+                'reclaimed': {category: {'bytes': 0, 'files': 0} for category in CATEGORIES},
+                'trimmed_users': [],
+                'cleared_users': []
+            }
+            report['bytes_before'], report['files_before'], _ = await self._blocking(usage, self.root)
+            await self._blocking(self._remove_orphans, report)
+            await self._blocking(self._expire, report)
+            if self.history is not None:
+                for user_id in await self._blocking(self._users):
+                    async with self._hold(user_id):
+                        await self._blocking(self._tidy_user, user_id, report)
+            await self._enforce_quota(report)
+            report['bytes_after'], report['files_after'], _ = await self._blocking(usage, self.root)
+            report['reclaimed_bytes'] = sum(item['bytes'] for item in report['reclaimed'].values())
+            report['reclaimed_files'] = sum(item['files'] for item in report['reclaimed'].values())
+            report['seconds'] = round(time.perf_counter() - started, 3)
+        finally:
+            os.close(fd)
+        self.sweeps += 1
+        self.reclaimed_bytes += report['reclaimed_bytes']
+        self.reclaimed_files += report['reclaimed_files']
+        self.last = report
+        if report['reclaimed_files']:
+            logger.info(
+                f"Janitor reclaimed {report['reclaimed_bytes']} bytes and {report['reclaimed_files']} files "
+                f"in {report['seconds']} s, data/ now {report['bytes_after']} bytes in {report['files_after']} files"
+            )
+        return report
+
+    async def run(self, interval: float) -> None:
+        """Sweeps every interval seconds until cancelled"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Janitor sweep failed: {e!r}")
+
+    def stats(self) -> dict:
+        return {
+            'sweeps': self.sweeps,
+            'skipped': self.skipped,
+            'errors': self.errors,
+            'reclaimed_bytes': self.reclaimed_bytes,
+            'reclaimed_files': self.reclaimed_files,
+            'last': self.last
+        }
@@ -0,0 +1,121 @@
+import asyncio
+import functools
+import json
+import logging
+import os
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Listed in history_tools.OTHER_FILES, so legacy history migration leaves it alone
+PROFILE_NAME = 'languages.json'
+
+
+class LanguageProfiles:
+    """
+    Languages STT detected in each user's voice messages, cached in memory
+    and in data/users/{user_id}/languages.json. Older detections weigh less
+    with every new one, so a user who switches languages is picked up.
+    Once one language clearly dominates, recognition is asked for that
+    language and the others the user spoke, instead of every supported one.
+    With shared set, profiles are re-read on every use since other server
+    processes update them too.
+    """
+
+    def __init__(self, root: str = 'data/users', decay: float = 0.8, min_weight: float = 3.0,
+                 min_share: float = 0.8, keep_share: float = 0.1, shared: bool = False, executor=None):
+        self.root = root
+        self.shared = shared
+        # Pool for the blocking file I/O, the loop's default one without it
+        self.executor = executor
+        self.decay = decay
+        # Weight of detections needed before narrowing at all
+        self.min_weight = min_weight
+        # Share of the top language needed to narrow
+        self.min_share = min_share
+        # Other languages with at least this share stay as alternatives
+        self.keep_share = keep_share
+        self._cache = {}
+        self.narrowed = 0
+        self.full = 0
+        self.fallbacks = 0
+
+    def _path(self, user_id: str) -> str:
+        return os.path.join(self.root, str(user_id), PROFILE_NAME)
+
+    async def _blocking(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(func, *args))
+
+    def _read(self, user_id: str) -> dict:
+        try:
+            with open(self._path(user_id), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write(self, user_id: str, weights: dict) -> None:
+        path = self._path(user_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(weights, f)
+        os.replace(path + '.tmp', path)
+
+    async def _weights(self, user_id: str) -> dict:
+        if self.shared or user_id not in self._cache:
+            self._cache[user_id] = await self._blocking(self._read, user_id)
+        return self._cache[user_id]
+
+    async def codes(self, user_id: str, languages: List[str]) -> List[str]:
+        """
+        Language codes for recognizing a message of the user: the most likely
+        one first, narrowed when the profile is confident, otherwise all of
+        languages. Codes are taken from languages, detections are matched
+        case-insensitively since STT reports them in lower case.
+        """
+        weights = await self._weights(str(user_id))
+        shares = {}
+        total = sum(weights.values())
+        for code in languages:
+            if weights.get(code.lower()):
+                shares[code] = weights[code.lower()] / total
+        ranked = sorted(shares, key=shares.get, reverse=True)
+        if ranked and total >= self.min_weight and shares[ranked[0]] >= self.min_share:
+            self.narrowed += 1
+            return [code for code in ranked if shares[code] >= self.keep_share]
+        self.full += 1
+        return ranked + [code for code in languages if code not in shares]
+
+    async def record(self, user_id: str, language_code: Optional[str]) -> None:
+        """Counts a detected language for the user"""
+        if not language_code:
+            return
+        user_id = str(user_id)
+        weights = {
+            code: weight * self.decay
+            for code, weight in (await self._weights(user_id)).items()
+            if weight * self.decay >= 0.01
+        }
+        language_code = language_code.lower()
+        weights[language_code] = weights.get(language_code, 0.0) + 1.0
+        self._cache[user_id] = weights
+        try:
+            await self._blocking(self._write, user_id, weights)
+        except OSError as e:
+            logger.error(f"Failed to save the language profile of user {user_id}: {e}")
+
+    def clear(self, user_id: str) -> None:
+        """Forgets the languages detected for the user; blocking"""
+        user_id = str(user_id)
+        self._cache.pop(user_id, None)
+        try:
+            os.remove(self._path(user_id))
+        except FileNotFoundError:
+            pass
+
+    def stats(self) -> dict:
+        return {
+            'users': len(self._cache),
+            'narrowed': self.narrowed,
+            'full': self.full,
+            'fallbacks': self.fallbacks
+        }
@@ -0,0 +1,175 @@
+import bisect
+import contextlib
+import contextvars
+import json
+import logging
+import threading
+import time
+from typing import Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Seconds; covers a cached lookup up to a long LLM answer or TTS call
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra='') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Histogram:
+    """Prometheus histogram with labels, rendered in the text exposition format."""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts..., +Inf count], sum
+        self._series: Dict[tuple, Tuple[List[int], float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._series.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+            counts[index] += 1
+            self._series[key] = (counts, total + value)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((key, list(counts), total) for key, (counts, total) in self._series.items())
+        for key, counts, total in series:
+            cumulative = 0
+            labels = _labels(self.labelnames, key)
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                bucket_labels = _labels(self.labelnames, key, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    """Metrics served together on /metrics."""
+
+    def __init__(self):
+        self._metrics = []
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.histogram(
+    'echobridge_stage_seconds',
+    'Time spent in one pipeline stage of a turn.',
+    ('stage', 'type', 'language')
+)
+TURN_SECONDS = REGISTRY.histogram(
+    'echobridge_turn_seconds',
+    'Time from picking up a message to finishing its replies.',
+    ('type', 'language')
+)
+
+_current_turn = contextvars.ContextVar('current_turn', default=None)
+
+
+class Turn:
+    """
+    Stage spans of one message. They are exported when the turn ends, so
+    stages timed before STT detected the language still get its label.
+    """
+
+    def __init__(self, kind: str, user_id: str = None):
+        self.kind = kind
+        self.user_id = user_id
+        self.language = 'unknown'
+        self.spans: List[Tuple[str, float]] = []
+        self.marks: Dict[str, float] = {}
+        self.started = time.perf_counter()
+
+    def add(self, stage: str, seconds: float):
+        self.spans.append((stage, seconds))
+
+    def mark(self, name: str):
+        """Records the time since the turn started, once per name"""
+        self.marks.setdefault(name, time.perf_counter() - self.started)
+
+    def finish(self):
+        total = time.perf_counter() - self.started
+        stages = {}
+        for stage, seconds in self.spans:
+            STAGE_SECONDS.observe(seconds, stage=stage, type=self.kind, language=self.language)
+            stages[stage] = round(stages.get(stage, 0.0) + seconds, 3)
+        TURN_SECONDS.observe(total, type=self.kind, language=self.language)
+        # Stages overlap (TTS runs while the LLM streams), so they don't add up to total
+        logger.info("Turn timing " + json.dumps({
+            'user': self.user_id,
+            'type': self.kind,
+            'language': self.language,
+            'total': round(total, 3),
+            'stages': stages,
+            **{name: round(seconds, 3) for name, seconds in self.marks.items()}
+        }))
+
+
+@contextlib.contextmanager
+def turn_context(kind: str, user_id: str = None):
+    """Makes a new Turn current for the block and the tasks it starts, exports it at the end"""
+    turn = Turn(kind, user_id)
+    token = _current_turn.set(turn)
+    try:
+        yield turn
+    finally:
+        _current_turn.reset(token)
+        turn.finish()
+
+
+def current_turn():
+    return _current_turn.get()
+
+
+def set_language(language: str):
+    turn = _current_turn.get()
+    if turn is not None:
+        turn.language = language
+
+
+def mark(name: str):
+    turn = _current_turn.get()
+    if turn is not None:
+        turn.mark(name)
+
+
+@contextlib.contextmanager
+def span(stage: str):
+    """Times the block as a stage of the current turn, or on its own outside of one"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        turn = _current_turn.get()
+        if turn is not None:
+            turn.add(stage, seconds)
+        else:
+            STAGE_SECONDS.observe(seconds, stage=stage, type='none', language='unknown')
@@ -0,0 +1,351 @@
+import asyncio
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """Raised by JobQueue.submit when the queue is at capacity."""
+
+
+class MemoryBackend:
+    """Keeps pending jobs and seen update keys in process memory."""
+
+    def __init__(self, dedup_size=10000):
+        self._jobs = {}
+        self._seen = OrderedDict()
+        self._dedup_size = dedup_size
+        self._size = 0
+
+    async def mark_seen(self, key) -> bool:
+        """Remembers the key, returns False if it was already seen."""
+        if key in self._seen:
+            self._seen.move_to_end(key)
+            return False
+        self._seen[key] = True
+        if len(self._seen) > self._dedup_size:
+            self._seen.popitem(last=False)
+        return True
+
+    async def push(self, user_id, job):
+        self._jobs.setdefault(user_id, deque()).append(job)
+        self._size += 1
+
+    async def pop(self, user_id):
+        jobs = self._jobs.get(user_id)
+        if not jobs:
+            return None
+        job = jobs.popleft()
+        self._size -= 1
+        if not jobs:
+            del self._jobs[user_id]
+        return job
+
+    async def pending(self, user_id) -> int:
+        return len(self._jobs.get(user_id, ()))
+
+    async def size(self) -> int:
+        """Jobs pending for all users"""
+        return self._size
+
+    async def recover(self):
+        """Users with pending jobs when the queue starts"""
+        return list(self._jobs)
+
+
+class RedisBackend:
+    """
+    Keeps pending jobs in Redis lists and seen update keys as expiring keys,
+    so duplicates are dropped across workers and restarts.
+    Works with any Redis-compatible server, including a local stand-in.
+    """
+
+    # The job count shared by all workers changes with the list in one step
+    POP = "local job = redis.call('lpop', KEYS[1]) if job then redis.call('decr', KEYS[2]) end return job"
+    # Recounted from the lists, so jobs left by a dead worker don't hold capacity forever
+    RECOUNT = (
+        "local keys = redis.call('keys', ARGV[1]) local size = 0 "
+        "for _, key in ipairs(keys) do size = size + redis.call('llen', key) end "
+        "redis.call('set', KEYS[1], size) return keys"
+    )
+
+    def __init__(self, url='redis://localhost:6379/0', prefix='echobridge', dedup_ttl=3600):
+        # Optional dependency, only needed when QUEUE_BACKEND is redis
+        import redis.asyncio as redis
+        self._redis = redis.from_url(url)
+        self._prefix = prefix
+        self._dedup_ttl = dedup_ttl
+
+    async def mark_seen(self, key) -> bool:
+        return bool(await self._redis.set(f"{self._prefix}:seen:{key}", 1, nx=True, ex=self._dedup_ttl))
+
+    async def push(self, user_id, job):
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.rpush(f"{self._prefix}:jobs:{user_id}", json.dumps(job))
+            pipe.incr(f"{self._prefix}:size")
+            await pipe.execute()
+
+    async def pop(self, user_id):
+        job = await self._redis.eval(self.POP, 2, f"{self._prefix}:jobs:{user_id}", f"{self._prefix}:size")
+        return json.loads(job) if job is not None else None
+
+    async def pending(self, user_id) -> int:
+        return await self._redis.llen(f"{self._prefix}:jobs:{user_id}")
+
+    async def size(self) -> int:
+        """Jobs pending for all users of all workers"""
+        return int(await self._redis.get(f"{self._prefix}:size") or 0)
+
+    async def recover(self):
+        """Users with jobs left in Redis, e.g. by a restart, and the job count recounted"""
+        prefix = f"{self._prefix}:jobs:"
+        keys = await self._redis.eval(self.RECOUNT, 1, f"{self._prefix}:size", f"{prefix}*")
+        return [key.decode()[len(prefix):] for key in keys]
+
+
+class FileLocks:
+    """
+    Per-user locks held with flock on files under root. They serialize
+    workers on one host, or on hosts sharing root over a file system with
+    working flock. A crashed worker's lock is released with its process.
+    """
+
+    def __init__(self, root='data/locks', poll=0.02):
+        self.root = root
+        self.poll = poll
+        self.waits = 0
+
+    @contextlib.asynccontextmanager
+    async def hold(self, user_id):
+        os.makedirs(self.root, exist_ok=True)
+        path = os.path.join(self.root, f"{user_id}.lock")
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # Polled, so waiting never ties up an executor thread
+                    self.waits += 1
+                    await asyncio.sleep(self.poll)
+                    continue
+                if self._current(fd, path):
+                    break
+                # prune() removed the file meanwhile, lock the one that replaces it
+                os.close(fd)
+                fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            yield
+        finally:
+            # Closing the descriptor releases the lock
+            os.close(fd)
+
+    @staticmethod
+    def _current(fd, path) -> bool:
+        try:
+            return os.stat(path).st_ino == os.fstat(fd).st_ino
+        except FileNotFoundError:
+            return False
+
+    def prune(self, max_age: float) -> int:
+        """Removes lock files older than max_age seconds that nobody holds, returns how many; blocking"""
+        removed = 0
+        now = time.time()
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return 0
+        for name in names:
+            path = os.path.join(self.root, name)
+            try:
+                if now - os.stat(path).st_mtime < max_age:
+                    continue
+                fd = os.open(path, os.O_RDWR)
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                # Removed while locked, so a waiter notices it locked a stale file
+                if self._current(fd, path):
+                    os.remove(path)
+                    removed += 1
+            except BlockingIOError:
+                pass
+            finally:
+                os.close(fd)
+        return removed
+
+
+class RedisLocks:
+    """
+    Per-user leases in Redis, for workers on several hosts. A lease is
+    renewed while it is held and expires ttl seconds after its worker died.
+    Works with any Redis-compatible server, including a local stand-in.
+    """
+
+    # Only the holder may renew or release its lease
+    RENEW = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) end return 0"
+    RELEASE = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+    def __init__(self, url='redis://localhost:6379/0', prefix='echobridge', ttl=30.0, poll=0.05):
+        # Optional dependency, only needed when USER_LOCKS is redis
+        import redis.asyncio as redis
+        self._redis = redis.from_url(url)
+        self._prefix = prefix
+        self.ttl = ttl
+        self.poll = poll
+        self.waits = 0
+
+    async def _renew(self, key, token):
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            await self._redis.eval(self.RENEW, 1, key, token, int(self.ttl * 1000))
+
+    @contextlib.asynccontextmanager
+    async def hold(self, user_id):
+        key = f"{self._prefix}:lock:{user_id}"
+        token = uuid.uuid4().hex
+        while not await self._redis.set(key, token, nx=True, px=int(self.ttl * 1000)):
+            self.waits += 1
+            await asyncio.sleep(self.poll)
+        renewal = asyncio.create_task(self._renew(key, token))
+        try:
+            yield
+        finally:
+            renewal.cancel()
+            await self._redis.eval(self.RELEASE, 1, key, token)
+
+
+@contextlib.asynccontextmanager
+async def _unlocked(user_id):
+    yield
+
+
+class JobQueue:
+    """
+    Bounded job queue drained by a pool of asyncio workers.
+    Jobs of one user run strictly one at a time and in arrival order,
+    jobs of different users run concurrently.
+    With locks (FileLocks or RedisLocks) a job is taken and run only while
+    holding its user's lock, which extends this to several server processes.
+    A worker that hits a backend or lock error logs it and retries the user
+    after retry_delay seconds.
+    """
+
+    def __init__(self, handler, workers=8, maxsize=100, backend=None, locks=None, retry_delay=1.0):
+        self.handler = handler
+        self.workers = workers
+        self.maxsize = maxsize
+        self.backend = backend or MemoryBackend()
+        self.locks = locks
+        self.retry_delay = retry_delay
+        self._ready = None
+        self._active = set()
+        self._queued_users = set()
+        self._tasks = []
+        self.depth = 0
+        self.processed = 0
+        self.failed = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.errors = 0
+        self._waits = deque(maxlen=1000)
+
+    async def start(self):
+        # Created here so the queue binds to the server's event loop
+        self._ready = asyncio.Queue()
+        for i in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker(), name=f'job-worker-{i}'))
+        users = await self.backend.recover()
+        for user_id in users:
+            self._schedule(user_id)
+        self.depth = await self.backend.size()
+        logger.info(f"Job queue started with {self.workers} workers, {self.depth} jobs pending for {len(users)} users")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, user_id, key, payload) -> bool:
+        """
+        Enqueues a job for the user.
+        Returns False for a duplicate key, raises QueueFull when at capacity.
+        """
+        # Counted by the backend, which other server processes may share
+        self.depth = await self.backend.size()
+        if self.depth >= self.maxsize:
+            self.rejected += 1
+            raise QueueFull(f"Job queue is full ({self.maxsize} jobs)")
+        if not await self.backend.mark_seen(key):
+            self.duplicates += 1
+            logger.info(f"Dropping duplicate update {key}")
+            return False
+        await self.backend.push(user_id, {'enqueued': time.time(), 'payload': payload})
+        self.depth = await self.backend.size()
+        self._schedule(user_id)
+        return True
+
+    def _schedule(self, user_id):
+        # A user is handed to a worker only when none is busy with it
+        if user_id not in self._active and user_id not in self._queued_users:
+            self._queued_users.add(user_id)
+            self._ready.put_nowait(user_id)
+
+    async def _run_next(self, user_id):
+        # Taken under the lock, so processes sharing a backend keep the order
+        async with (self.locks.hold(user_id) if self.locks else _unlocked(user_id)):
+            job = await self.backend.pop(user_id)
+            if job is not None:
+                self._waits.append(time.time() - job['enqueued'])
+                try:
+                    await self.handler(job['payload'])
+                    self.processed += 1
+                except Exception as e:
+                    self.failed += 1
+                    logger.error(f"Job for user {user_id} failed: {e}")
+            self.depth = await self.backend.size()
+
+    async def _worker(self):
+        while True:
+            user_id = await self._ready.get()
+            self._queued_users.discard(user_id)
+            self._active.add(user_id)
+            try:
+                await self._run_next(user_id)
+                retry = await self.backend.pending(user_id)
+            except Exception as e:
+                # Still marked active, so no other worker takes the user meanwhile
+                self.errors += 1
+                logger.error(f"Job queue error for user {user_id}, retrying in {self.retry_delay}s: {e!r}")
+                await asyncio.sleep(self.retry_delay)
+                retry = True
+            finally:
+                self._active.discard(user_id)
+            if retry:
+                self._schedule(user_id)
+
+    def stats(self) -> dict:
+        waits = sorted(self._waits)
+        return {
+            'depth': self.depth,
+            'max_size': self.maxsize,
+            'in_flight': len(self._active),
+            'workers': self.workers,
+            'processed': self.processed,
+            'failed': self.failed,
+            'duplicates': self.duplicates,
+            'rejected': self.rejected,
+            'errors': self.errors,
+            'lock_waits': self.locks.waits if self.locks else 0,
+            'wait_avg_sec': round(sum(waits) / len(waits), 3) if waits else 0.0,
+            'wait_p95_sec': round(waits[int(0.95 * (len(waits) - 1))], 3) if waits else 0.0,
+            'wait_max_sec': round(waits[-1], 3) if waits else 0.0
+        }
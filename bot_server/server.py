@@ -1,567 +1,1001 @@
-from fastapi import FastAPI, Request, HTTPException, Header
-from fastapi.responses import JSONResponse
-import os
-import logging
-import json
-import telebot
-from telebot.formatting import escape_markdown
-from datetime import datetime
-from langchain_openai import ChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from typing import Union
-import requests
-from stt_tools import transcribe_multiple_languages
-import uuid
-from pydub import AudioSegment
-from tts_tools import upload_reference_file, generate_speech
-import time
-
-# Initialize FastAPI
-app = FastAPI()
-
-# Initialize logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-
-# Load config
-with open('config.json') as config_file:
-    config = json.load(config_file)
-    HISTORY_THRESHOLD = config.get('HISTORY_THRESHOLD', 4000)  # Default to 4000 chars if not specified
-
-# Set environment variables for LangSmith
-os.environ["LANGSMITH_TRACING"] = "true"
-os.environ["LANGSMITH_ENDPOINT"] = "https://api.smith.langchain.com"
-os.environ["LANGSMITH_API_KEY"] = config["LANGSMITH_API_KEY"]
-os.environ["LANGSMITH_PROJECT"] = config["LANGSMITH_PROJECT"]
-os.environ["OPENAI_API_KEY"] = config["OPENAI_API_KEY"]
-
-# Configure Telegram bot API endpoints
-server_api_uri = 'http://localhost:8081/bot{0}/{1}'
-telebot.apihelper.API_URL = server_api_uri
-server_file_url = 'http://localhost:8081'
-telebot.apihelper.FILE_URL = server_file_url
-
-# Initialize bot from config
-with open('config.json') as config_file:
-    config = json.load(config_file)
-    bot = telebot.TeleBot(config['TOKEN'])
-    
-# Initialize OpenAI chat model
-llm = ChatOpenAI(
-    model_name="gpt-4",
-    openai_api_key=config['OPENAI_API_KEY']
-)
-
-def user_access(message):
-    with open('data/users.txt') as f:
-        users = f.read().splitlines()
-    return str(message['from']['id']) in users
-
-def manage_chat_history(user_id: str, message_id: str, text: Union[str, dict], role: str = "user"):
-    """Manages chat history for a user, storing messages and pruning old ones."""
-    # Create user directory if it doesn't exist
-    user_dir = f'data/users/{user_id}'
-    os.makedirs(user_dir, exist_ok=True)
-
-    # Save current message
-    date = datetime.now().strftime('%Y%m%d_%H%M%S')
-    filename = f'{date}_{message_id}.json'
-    
-    if isinstance(text, dict):
-        # Store directly in new format
-        message_data = text
-    else:
-        # Legacy single message format
-        message_data = {
-            role: text
-        }
-    
-    with open(os.path.join(user_dir, filename), 'w', encoding='utf-8') as f:
-        json.dump(message_data, f, ensure_ascii=False)
-
-    # Get all message files and their creation times
-    files = []
-    total_length = 0
-    for f in os.listdir(user_dir):
-        if f.endswith('.json'):
-            filepath = os.path.join(user_dir, f)
-            with open(filepath, 'r', encoding='utf-8') as file:
-                content = json.load(file)
-                # Calculate length based on the format of the message
-                if 'user' in content and 'assistant' in content:
-                    # New format
-                    total_length += len(content['user']) + len(content['assistant'])
-                elif 'content' in content:
-                    # Old format
-                    if isinstance(content['content'], dict):
-                        total_length += len(content['content']['user_message']) + len(content['content']['assistant_response'])
-                    else:
-                        total_length += len(content['content'])
-                else:
-                    # Single message format
-                    total_length += sum(len(v) for v in content.values())
-
-    # Sort files by creation time (oldest first)
-    files.sort(key=lambda x: x[1])
-
-    # Remove oldest files until total length is below threshold
-    while total_length > HISTORY_THRESHOLD and files:
-        filepath, _, content = files[0]
-        total_length -= len(content['content'])
-        os.remove(filepath)
-        files.pop(0)
-
-def get_chat_history(user_id: str) -> list:
-    """Retrieves chat history for a user as a list of message tuples."""
-    user_dir = f'data/users/{user_id}'
-    if not os.path.exists(user_dir):
-        return []
-
-    # Get all message files and their creation times
-    files = []
-    for f in os.listdir(user_dir):
-        if f.endswith('.json'):
-            filepath = os.path.join(user_dir, f)
-            files.append((filepath, os.path.getctime(filepath)))
-
-    # Sort files by creation time (oldest first)
-    files.sort(key=lambda x: x[1])
-
-    # Build chat history list
-    history = []
-    for filepath, _ in files:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            message_data = json.load(f)
-            if 'user' in message_data and 'assistant' in message_data:
-                # Handle new format
-                history.extend([
-                    ("user", message_data['user']),
-                    ("assistant", message_data['assistant'])
-                ])
-            elif isinstance(message_data.get('content'), dict):
-                # Handle old conversation format
-                content = message_data['content']
-                history.extend([
-                    ("user", content['user_message']),
-                    ("assistant", content['assistant_response'])
-                ])
-            else:
-                # Handle legacy single message format
-                history.append((message_data['role'], message_data['content']))
-
-    return history
-
-def clear_chat_history(user_id: str) -> None:
-    """Clears all chat history for a given user."""
-    user_dir = f'data/users/{user_id}'
-    if os.path.exists(user_dir):
-        for file in os.listdir(user_dir):
-            if file.endswith('.json'):
-                os.remove(os.path.join(user_dir, file))
-
-def convert_audio_to_wav(input_path: str) -> str:
-    """
-    Convert audio file to WAV format with 16kHz sample rate, mono channel, and 16-bit depth.
-    Returns path to converted file and temp directory.
-    """
-    # Create unique output directory
-    output_dir = f'data/{str(uuid.uuid4())}'
-    os.makedirs(output_dir, exist_ok=True)
-    
-    # Generate output path
-    output_path = os.path.join(output_dir, 'audio.wav')
-    
-    # Convert audio with explicit parameters
-    audio = AudioSegment.from_file(input_path)
-    audio = audio.set_frame_rate(16000)  # Set sample rate to 16kHz
-    audio = audio.set_channels(1)        # Convert to mono
-    audio = audio.set_sample_width(2)    # Set to 16-bit (2 bytes)
-    
-    # Export with explicit parameters
-    audio.export(
-        output_path,
-        format="wav",
-        parameters=["-acodec", "pcm_s16le"]  # Force 16-bit PCM encoding
-    )
-    
-    return output_path, output_dir
-
-def send_voice_message(chat_id, voice_file_path, reply_to_message_id=None):
-    """Helper function to send voice messages via Telegram"""
-    try:
-        # Convert WAV to OGG format with OPUS codec
-        audio = AudioSegment.from_wav(voice_file_path)
-        ogg_path = voice_file_path.replace('.wav', '.ogg')
-        audio.export(
-            ogg_path,
-            format="ogg",
-            codec="libopus",  # Ensure we're using OPUS codec
-            parameters=["-strict", "-2"]  # Required for some ffmpeg versions
-        )
-        
-        # Send the OGG file using file object
-        with open(ogg_path, 'rb') as voice_file:
-            logger.info(f"Sending voice message: {ogg_path}")
-            bot.send_voice(
-                chat_id,
-                voice_file,  # Send the file object instead of path
-                reply_to_message_id=reply_to_message_id
-            )
-            
-        # Clean up OGG file
-        os.remove(ogg_path)
-            
-    except Exception as e:
-        logger.error(f"Error sending voice message: {e}")
-        if 'VOICE_MESSAGES_FORBIDDEN' in str(e):
-            bot.send_message(
-                chat_id,
-                "Sorry, I can't send voice messages. Please enable voice messages for everyone in your Telegram privacy settings (Settings -> Privacy and Security -> Voice Messages).",
-                reply_to_message_id=reply_to_message_id
-            )
-        raise
-
-def process_llm_response(user_id: str, message_id: str, user_message: str, chat_id: int, reply_to_message_id: int, language: str = 'en') -> None:
-    """Common function to handle LLM processing and response generation"""
-    try:
-        # Language format simplification "en-US" -> "en"
-        language = language.split('-')[0]
-                
-        # Get chat history and create prompt template
-        chat_history = get_chat_history(user_id)
-        
-        # Create prompt template with history placeholder
-        history_placeholder = MessagesPlaceholder("history")
-        prompt_template = ChatPromptTemplate.from_messages([
-            ("system", f"Your name is Janet. You are a helpful AI assistant. Please respond in {language} language."),
-            history_placeholder,
-            ("human", "{question}")
-        ])
-
-        # Generate prompt with chat history
-        prompt_value = prompt_template.invoke({
-            "history": chat_history,
-            "question": user_message
-        })
-
-        # Get response from LLM
-        llm_response = llm.invoke(prompt_value).content
-
-        # Store both user message and LLM response
-        manage_chat_history(
-            user_id,
-            str(message_id),
-            {
-                "user": user_message,
-                "assistant": llm_response
-            }
-        )
-        # Replace dots with newlines in the LLM response
-        llm_response = llm_response.replace('.', '\n')
-        # Crop extra spaces and newlines
-        llm_response = llm_response.strip()
-
-        # Generate and send voice response
-        try:
-            # Get TTS server URL from config
-            tts_api_url = config.get('TTS_API_URL', 'http://localhost:5000')
-            
-            # Generate speech using the user's reference file
-            speech_file_name = generate_speech(
-                text=llm_response,
-                language=language,
-                reference_file=f"{user_id}.wav",
-                api_url=tts_api_url
-            )
-            
-            # Send voice message
-            send_voice_message(
-                chat_id,
-                speech_file_name,
-                reply_to_message_id=reply_to_message_id
-            )
-            
-            # Clean up
-            os.remove(speech_file_name)
-            
-        except Exception as e:
-            logger.error(f"Error generating or sending voice message: {e}")
-            # Fall back to text message if voice generation fails
-            bot.send_message(
-                chat_id,
-                llm_response,
-                reply_to_message_id=reply_to_message_id,
-                parse_mode='Markdown'
-            )
-            
-    except Exception as e:
-        logger.error(f"Error in LLM processing: {e}")
-        bot.send_message(
-            chat_id,
-            "Sorry, there was an error processing your message.",
-            reply_to_message_id=reply_to_message_id
-        )
-
-async def send_reply(bot_token, chat_id, message_id, text):
-    url = f"http://localhost:8081/bot{bot_token}/sendMessage"
-    # Escape dots in text for MarkdownV2 format
-    text = text.replace('.', '\\.')
-    payload = {
-        'chat_id': chat_id,
-        'text': f"*{text}*",
-        'reply_to_message_id': message_id,
-        'parse_mode': 'MarkdownV2'
-    }
-    response = requests.post(url, data=payload)
-    logger.info(f"Update message response: {response.json()}")
-    return response.json()
-
-@app.post("/message")
-async def call_message(request: Request, authorization: str = Header(None)):
-    message = await request.json()
-    logger.info(message)
-
-    # if not user_access(message):
-    #     return JSONResponse(content={
-    #         "type": "text", 
-    #         "body": "You are not authorized to use this bot."
-    #     })
-
-    chat_id = message['chat']['id']
-    user_id = str(message['from']['id'])
-
-    # Handle audio document
-    if 'document' in message and 'mime_type' in message['document'] and 'audio' in message['document']['mime_type']:
-        try:
-            # Get the file from Telegram
-            file_id = message['document']['file_id']
-            file_info = bot.get_file(file_id)
-            file_path = file_info.file_path
-
-            # Convert to WAV if needed
-            wav_path, temp_dir = convert_audio_to_wav(file_path)
-            
-            # Upload to TTS server
-            tts_api_address = config.get('TTS_API_URL', 'http://localhost:5000')
-            filename = f"{user_id}.wav" # One reference for each user
-            response = upload_reference_file(wav_path, api_url=tts_api_address, filename=filename)
-            
-            # Clean up temporary files
-            os.remove(wav_path)
-            os.rmdir(temp_dir)
-            
-            bot.send_message(
-                chat_id,
-                "Reference audio file successfully uploaded!",
-                reply_to_message_id=message['message_id']
-            )
-        except Exception as e:
-            logger.error(f"Error processing audio document: {e}")
-            bot.send_message(
-                chat_id,
-                "Sorry, there was an error processing the audio file.",
-                reply_to_message_id=message['message_id']
-            )
-        return JSONResponse(content={"type": "empty", "body": ''})
-
-    # Handle voice message
-    if 'voice' in message and 'audio' in message['voice']['mime_type']:
-        voice_file_id = message['voice']['file_id']
-        duration = message['voice']['duration']
-        
-        if duration < 1:
-            response = "Voice message received, but duration is too short < 1 sec."
-        elif duration > 60:
-            response = "Voice message received, but duration is too long: > 60 sec."
-        else:
-            # Send status message
-            # bot.send_message(
-            #     chat_id,
-            #     "Converting audio...",
-            #     reply_to_message_id=message['message_id']
-            # )
-            update_message = await send_reply(config['TOKEN'], chat_id, message['message_id'], "[     ] Reading the reference voice..")
-            update_id = update_message['result']['message_id']
-            # Get the file path using the Telegram API
-            file_info = bot.get_file(voice_file_id)
-            file_path = file_info.file_path
-            # Log file info and path
-            logger.info(f"File info: {file_info}")
-            logger.info(f"File path: {file_path}")
-            # Check if file exists at file_path
-            if not os.path.exists(file_path):
-                logger.error(f"File not found at path: {file_path}")
-                bot.send_message(
-                    chat_id,
-                    "Sorry, there was an error accessing the voice message file.",
-                    reply_to_message_id=message['message_id']
-                )
-                return JSONResponse(content={"type": "empty", "body": ''})
-            
-            # Convert audio to WAV format
-            try:
-                start_time = time.time()
-                bot.edit_message_text(
-                    "`[█    ] Voice convertation..`".replace('.', '\\.'),
-                    chat_id=chat_id,
-                    message_id=update_id,
-                    parse_mode='MarkdownV2'
-                )
-                wav_path, temp_dir = convert_audio_to_wav(file_path)
-                logger.info(f"WAV path: {wav_path}")
-                logger.info(f"Temp dir: {temp_dir}")
-                
-                with open("BCP-47.txt", "r") as f:
-                    languages = [line.strip() for line in f if line.strip()]
-                
-                bot.edit_message_text(
-                    "`[██   ] Voice to text transcribation..`".replace('.', '\\.'),
-                    chat_id=chat_id,
-                    message_id=update_id,
-                    parse_mode='MarkdownV2'
-                )
-                stt_response = transcribe_multiple_languages(wav_path, languages)
-                for result in stt_response.results:
-                    detected_language = result.language_code
-                    transcript = result.alternatives[0].transcript
-                    logger.info(f"Detected Language: {detected_language}")
-                    logger.info(f"Transcript: {transcript}")
-                    
-                    # Get chat history and create prompt template
-                    chat_history = get_chat_history(user_id)
-                    
-                    # Create prompt template with history placeholder
-                    history_placeholder = MessagesPlaceholder("history")
-                    prompt_template = ChatPromptTemplate.from_messages([
-                        ("system", "Your name is Janet. You are a helpful AI assistant."),
-                        history_placeholder,
-                        ("human", "{question}")
-                    ])
-
-                    # Generate prompt with chat history
-                    prompt_value = prompt_template.invoke({
-                        "history": chat_history,
-                        "question": transcript
-                    })
-
-                    # Replace Chinese language code for compatibility
-                    if detected_language.lower() == "cmn-hans-cn":
-                        detected_language = "zh-cn"
-                    
-                    bot.edit_message_text(
-                        f"`[███  ] [{detected_language}] Thinking..`".replace('.', '\\.'),
-                        chat_id=chat_id,
-                        message_id=update_id,
-                        parse_mode='MarkdownV2'
-                    )
-                    
-                    # Get response from LLM
-                    llm_response = llm.invoke(prompt_value).content
-
-                    # Store both transcribed message and LLM response
-                    manage_chat_history(
-                        user_id,
-                        str(message['message_id']),
-                        {
-                            "user": transcript,
-                            "assistant": llm_response
-                        }
-                    )
-
-                    bot.edit_message_text(
-                        f"`[████ ] [{detected_language}] Voice synthesis..`".replace('.', '\\.'),
-                        chat_id=chat_id,
-                        message_id=update_id,
-                        parse_mode='MarkdownV2'
-                    )
-                    
-                    # Process LLM response
-                    process_llm_response(
-                        user_id,
-                        message['message_id'],
-                        transcript,
-                        chat_id,
-                        message['message_id'],
-                        detected_language
-                    )
-                    logger.info(f"Voice response sent to user {user_id}")
-                    bot.edit_message_text(
-                        f"`[█████] [{detected_language}] Done in {round(time.time() - start_time, 1)} sec.`".replace('.', '\\.'),
-                        chat_id=chat_id,
-                        message_id=update_id,
-                        parse_mode='MarkdownV2'
-                    )
-                # Clean up temporary files
-                os.remove(wav_path)
-                os.rmdir(temp_dir)
-                return JSONResponse(content={"type": "empty", "body": ''})
-                
-            except Exception as e:
-                logger.error(f"Error processing audio: {e}")
-                response = "Sorry, there was an error processing the voice message."
-                bot.send_message(
-                    chat_id,
-                    response,
-                    reply_to_message_id=message['message_id']
-                )
-
-        return JSONResponse(content={"type": "empty", "body": ''})
-
-    # Original text message handling
-    if 'text' not in message:
-        bot.send_message(
-            chat_id,
-            "Sorry, this message type is not supported yet.",
-            reply_to_message_id=message['message_id']
-        )
-        return JSONResponse(content={"type": "empty", "body": ''})
-
-    text = message['text']
-
-    if text == '/reset':
-        clear_chat_history(user_id)
-        bot.send_message(
-            chat_id,
-            "Chat history has been reset.",
-            reply_to_message_id=message['message_id']
-        )
-        return JSONResponse(content={"type": "empty", "body": ''})
-    
-    if text == '/start':
-        try:
-            with open('greeting.txt', 'r') as f:
-                greeting = f.read()
-            with open("BCP-47.txt", "r") as f:
-                languages = [line.strip() for line in f if line.strip()]
-            greeting += f'\nSupported languages: {languages}'
-            bot.send_message(
-                chat_id,
-                greeting,
-                reply_to_message_id=message['message_id']
-            )
-            return JSONResponse(content={"type": "empty", "body": ''})
-        except FileNotFoundError:
-            logger.error("greeting.txt not found")
-            bot.send_message(
-                chat_id,
-                "Welcome! I'm Janet, your AI assistant.",
-                reply_to_message_id=message['message_id']
-            )
-            return JSONResponse(content={"type": "empty", "body": ''})
-
-    # Process LLM response
-    process_llm_response(
-        user_id,
-        message['message_id'],
-        text,
-        chat_id,
-        message['message_id'],
-        'en'
-    )
-
-    return JSONResponse(content={"type": "empty", "body": ''})
-
-@app.get("/test")
-async def call_test():
-    return JSONResponse(content={"status": "ok"})
\ No newline at end of file
+from fastapi import FastAPI, Request, HTTPException, Header
+from fastapi.responses import JSONResponse, PlainTextResponse
+import os
+import logging
+import asyncio
+import hmac
+import signal
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Union
+from stt_tools import GoogleSTT, join_transcripts, transcribe_chunks, transcript_confidence
+from audio_tools import AudioPool, AudioBusy, AudioRejected, stream_pcm, to_wav, wav_to_ogg, concatenate_wavs, split_speech, prepare_reference
+from tts_tools import AsyncTTSClient, SentenceSplitter, SpeechCache
+from telegram_tools import TelegramClient, TelegramError, ProgressReporter
+from completion_tools import CompletionCache
+from history_tools import HistoryStore, HistoryCache, HistorySummarizer, flatten_turns
+from token_tools import count_message_tokens, prompt_budget, select_history
+from queue_tools import JobQueue, MemoryBackend, RedisBackend, QueueFull, FileLocks, RedisLocks
+from config_tools import ConfigStore
+from language_tools import LanguageProfiles
+from metrics_tools import REGISTRY, turn_context, span, mark, set_language
+from tracing_tools import Tracer, trace_turn, callbacks, mark_failed
+from janitor_tools import Janitor
+import time
+
+# Initialize FastAPI
+app = FastAPI()
+
+# Initialize logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Load config.json, users.txt, BCP-47.txt and greeting.txt once; each is re-read only when it changes
+config_store = ConfigStore()
+config = config_store.config
+LLM_MODEL = config.get('LLM_MODEL', 'gpt-4')
+HISTORY_MAX_TOKENS = config.get('HISTORY_MAX_TOKENS', 16000)  # Tokens of history kept per user
+PROMPT_TOKEN_BUDGET = config.get('PROMPT_TOKEN_BUDGET', {})  # {model: max prompt tokens}
+TTS_STREAM_MODE = config.get('TTS_STREAM_MODE', 'concat')  # 'concat' or 'separate' voice notes
+TTS_STREAM_CONCURRENCY = config.get('TTS_STREAM_CONCURRENCY', 2)  # Sentences synthesized at once per turn
+STT_STREAMING = config.get('STT_STREAMING', False)  # Stream decoded PCM to recognition while decoding
+MAX_VOICE_SECONDS = config.get('MAX_VOICE_SECONDS', 300)  # Longer voice messages are refused
+STT_CHUNK_SECONDS = config.get('STT_CHUNK_SECONDS', 55)  # Google recognize takes at most 60 s per request
+VAD_THRESHOLD_DB = config.get('VAD_THRESHOLD_DB', -45)  # Quieter audio counts as silence
+STT_MIN_CONFIDENCE = config.get('STT_MIN_CONFIDENCE', 0.6)  # Below it, narrowed recognition is retried with all languages
+REFERENCE_MAX_SECONDS = config.get('REFERENCE_MAX_SECONDS', 30)  # Longer reference voices are cut
+REFERENCE_MIN_SECONDS = config.get('REFERENCE_MIN_SECONDS', 3)
+REFERENCE_MIN_SAMPLE_RATE = config.get('REFERENCE_MIN_SAMPLE_RATE', 16000)
+REFERENCE_MAX_MB = config.get('REFERENCE_MAX_MB', 20)  # Larger files are refused before downloading
+SYSTEM_PROMPT = "Your name is Janet. You are a helpful AI assistant. Please respond in {language} language."
+WORKERS = config.get('WORKERS', 1)  # Server processes sharing data/ and the bot token, on all nodes
+
+# LangChain's own tracer would post every run from the request path, turns are traced by tracer instead
+os.environ["LANGSMITH_TRACING"] = "false"
+os.environ["OPENAI_API_KEY"] = config["OPENAI_API_KEY"]
+
+# Turns are recorded in memory, a sample of them plus failed and slow ones go to LangSmith in the background
+if config.get('LANGSMITH_TRACING', True) and config.get('LANGSMITH_API_KEY'):
+    tracer = Tracer(
+        api_key=config['LANGSMITH_API_KEY'],
+        api_url=config.get('LANGSMITH_ENDPOINT', 'https://api.smith.langchain.com'),
+        project=config.get('LANGSMITH_PROJECT'),
+        sample_rate=config.get('TRACE_SAMPLE_RATE', 0.1),
+        errors=config.get('TRACE_ERRORS', True),
+        slow_seconds=config.get('TRACE_SLOW_SECONDS', 30),
+        queue_size=config.get('TRACE_QUEUE_SIZE', 100)
+    )
+else:
+    tracer = None
+
+# Configure Telegram bot API endpoint
+server_api_url = 'http://localhost:8081'
+
+# Initialize bot from config, outbound calls are rate limited like Telegram does
+bot = TelegramClient(
+    config['TOKEN'],
+    api_url=server_api_url,
+    pool_size=config.get('TELEGRAM_POOL_SIZE', 20),
+    # Telegram's limit is per bot, so processes split it
+    rate=config.get('TELEGRAM_RATE', 30 / WORKERS),
+    chat_rate=config.get('TELEGRAM_CHAT_RATE', 1),
+    chat_burst=config.get('TELEGRAM_CHAT_BURST', 3),
+    retries=config.get('TELEGRAM_RETRIES', 3)
+)
+
+# Progress messages are edited in the background, at most once per interval per chat
+progress_reporter = ProgressReporter(interval=config.get('PROGRESS_INTERVAL', 1.0))
+
+# OpenAI chat model, built by load_models() since importing langchain_openai takes a second
+llm = None
+
+def make_chat_model(model_name: str):
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(model_name=model_name, openai_api_key=config['OPENAI_API_KEY'])
+
+@functools.lru_cache(maxsize=None)
+def prompt_template():
+    """Conversation prompt, built once and filled in for every turn"""
+    from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+    return ChatPromptTemplate.from_messages([
+        ("system", SYSTEM_PROMPT),
+        MessagesPlaceholder("history"),
+        ("human", "{question}")
+    ])
+
+def load_models():
+    """Imports LangChain and builds the chat models and the prompt, blocking"""
+    global llm
+    if llm is None:
+        llm = make_chat_model(LLM_MODEL)
+    if history_summarizer and history_summarizer.llm is None:
+        history_summarizer.llm = make_chat_model(config.get('HISTORY_SUMMARY_MODEL', LLM_MODEL))
+    prompt_template()
+
+# Pooled TTS server client with timeouts and retries
+tts = AsyncTTSClient(
+    config.get('TTS_API_URL', 'http://localhost:5000'),
+    connect_timeout=config.get('TTS_CONNECT_TIMEOUT', 5),
+    read_timeout=config.get('TTS_READ_TIMEOUT', 120),
+    retries=config.get('TTS_RETRIES', 2),
+    pool_size=config.get('TTS_POOL_SIZE', 10)
+)
+
+# Finished voice notes by reference voice, language and text; its index is per process
+if config.get('SPEECH_CACHE', WORKERS == 1):
+    speech_cache = SpeechCache(
+        'data/speech_cache',
+        max_bytes=config.get('SPEECH_CACHE_MB', 256) * 2 ** 20
+    )
+else:
+    speech_cache = None
+
+# Bounded pool for blocking work: history file I/O
+executor = ThreadPoolExecutor(
+    max_workers=config.get('EXECUTOR_WORKERS', os.cpu_count() or 4),
+    thread_name_prefix='blocking'
+)
+
+# Speech-to-text backend, its client is created on first use and then reused
+stt = GoogleSTT()
+
+# Languages each user speaks, learned from recognition and kept next to the history
+if config.get('STT_LANGUAGE_PROFILE', True):
+    language_profiles = LanguageProfiles('data/users', shared=WORKERS > 1, executor=executor)
+else:
+    language_profiles = None
+
+# ffmpeg conversions run at most one per CPU, with a bounded wait queue
+audio_pool = AudioPool(
+    workers=config.get('AUDIO_WORKERS', os.cpu_count() or 4),
+    max_queue=config.get('AUDIO_QUEUE_SIZE', 32)
+)
+AUDIO_BUSY_REPLY = "Sorry, I'm busy with other voice messages right now. Please try again in a minute."
+
+async def run_blocking(func, *args, **kwargs):
+    """Runs a blocking call in the executor so the event loop stays free."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+# Set once the models are loaded and warmup is done; turns queued before wait for it
+ready = None
+warmup_report = {}
+
+async def warmup_step(name, coro, timeout=None):
+    """Runs one warmup step, recording its time or error; a failed step doesn't stop startup"""
+    started = time.perf_counter()
+    try:
+        await asyncio.wait_for(coro, timeout)
+        warmup_report[name] = round(time.perf_counter() - started, 3)
+    except Exception as e:
+        warmup_report[name] = f"failed: {e!r}"
+        logger.warning(f"Warmup step {name} failed: {e!r}")
+
+async def warm_llm():
+    # A model list call opens the pooled HTTPS connection without paying for a completion
+    client = getattr(llm, 'root_async_client', None)
+    if client is not None:
+        await client.models.list()
+
+async def warmup():
+    """Loads the heavy modules in the background, then optionally opens the outbound connections"""
+    try:
+        # No timeout: the executor thread would keep loading after it, and ready means loaded
+        await warmup_step('models', run_blocking(load_models))
+        if config.get('WARMUP', True):
+            timeout = config.get('WARMUP_TIMEOUT', 10)
+            await asyncio.gather(
+                warmup_step('tokenizer', run_blocking(count_message_tokens, [('system', SYSTEM_PROMPT)], LLM_MODEL), timeout),
+                warmup_step('stt', stt.warmup(), timeout),
+                warmup_step('tts', tts.warmup(), timeout),
+                warmup_step('llm', warm_llm(), timeout),
+                warmup_step('telegram', bot.warmup(), timeout)
+            )
+    finally:
+        ready.set()
+        logger.info(f"Ready, warmup: {warmup_report}")
+
+@app.on_event("startup")
+async def startup():
+    global ready
+    ready = asyncio.Event()
+    await job_queue.start()
+    # Not awaited, so /test answers and updates are queued while it runs
+    app.state.warmup = asyncio.create_task(warmup())
+    if janitor:
+        app.state.janitor = asyncio.create_task(janitor.run(config.get('JANITOR_INTERVAL', 600)))
+    try:
+        # kill -HUP reloads config.json, users.txt, BCP-47.txt and greeting.txt
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, config_store.reload)
+    except (AttributeError, NotImplementedError, RuntimeError):
+        # No SIGHUP on this platform, or not running in the main thread
+        logger.info("SIGHUP config reload unavailable, use POST /admin/reload")
+
+@app.on_event("shutdown")
+async def shutdown():
+    if janitor:
+        app.state.janitor.cancel()
+    await job_queue.stop()
+    await progress_reporter.aclose()
+    await bot.aclose()
+    await tts.aclose()
+    if tracer:
+        await run_blocking(tracer.close)
+    if speech_cache:
+        await run_blocking(speech_cache.flush)
+    executor.shutdown(wait=False)
+
+# Append-only per-user history logs under data/users/, recent windows cached in memory.
+# With several processes each turn reads the log, so it sees what the others wrote.
+history_store = HistoryStore(
+    'data/users',
+    max_tokens=HISTORY_MAX_TOKENS,
+    count_tokens=functools.partial(count_message_tokens, model=LLM_MODEL),
+    shared=WORKERS > 1,
+    max_users=config.get('HISTORY_CACHE_USERS', 10000)
+)
+if WORKERS == 1:
+    history_store = HistoryCache(
+        history_store,
+        max_users=config.get('HISTORY_CACHE_USERS', 10000),
+        max_bytes=config.get('HISTORY_CACHE_MB', 64) * 2 ** 20
+    )
+
+# Completions of identical prompts, in memory and optionally in data/llm_cache for all workers
+if config.get('LLM_CACHE', True):
+    completion_cache = CompletionCache(
+        ttl=config.get('LLM_CACHE_TTL', 3600),
+        max_entries=config.get('LLM_CACHE_SIZE', 1000),
+        root='data/llm_cache' if config.get('LLM_CACHE_DISK', WORKERS > 1) else None,
+        max_disk_entries=config.get('LLM_CACHE_DISK_SIZE', 10000)
+    )
+else:
+    completion_cache = None
+
+# Optional rolling summary of the turns that don't fit the prompt budget
+if config.get('HISTORY_SUMMARY', False):
+    # The summary model is built by load_models() with the chat model
+    history_summarizer = HistorySummarizer(
+        None,
+        'data/users',
+        max_tokens=config.get('HISTORY_SUMMARY_TOKENS', 300),
+        executor=executor
+    )
+else:
+    history_summarizer = None
+
+def user_access(message):
+    return config_store.allowed(message['from']['id'])
+
+def manage_chat_history(user_id: str, message_id: str, text: Union[str, dict], role: str = "user"):
+    """Manages chat history for a user, storing messages and pruning old ones."""
+    if isinstance(text, dict):
+        # {"user": ..., "assistant": ...} turn
+        messages = list(text.items())
+    else:
+        # Single message
+        messages = [(role, text)]
+    history_store.append(user_id, message_id, messages)
+
+def get_chat_history(user_id: str) -> list:
+    """Retrieves chat history for a user as a list of message tuples."""
+    return history_store.read(user_id)
+
+def clear_chat_history(user_id: str) -> None:
+    """Clears all chat history for a given user."""
+    history_store.clear(user_id)
+    if history_summarizer:
+        history_summarizer.clear(user_id)
+
+async def build_chat_history(user_id: str, system_prompt: str, user_message: str) -> list:
+    """Newest history turns that fit the prompt token budget, led by the rolling summary if enabled."""
+    with span('history_load'):
+        turns = await run_blocking(history_store.read_turns, user_id)
+    budget = prompt_budget(LLM_MODEL, PROMPT_TOKEN_BUDGET) - count_message_tokens(
+        [("system", system_prompt), ("human", user_message)], LLM_MODEL
+    )
+    if history_summarizer:
+        budget -= history_summarizer.max_tokens
+    older, window = select_history(turns, budget)
+    chat_history = flatten_turns(window)
+    if history_summarizer:
+        summary = await history_summarizer.get(user_id, older)
+        if summary:
+            chat_history.insert(0, ("system", f"Summary of the earlier conversation: {summary}"))
+    return chat_history
+
+async def send_voice_message(chat_id, wav=None, reply_to_message_id=None, user_id=None, cache_key=None,
+                             cache_parts=()):
+    """
+    Helper function to send WAV audio as a Telegram voice message.
+    With a cache_key the encoded note is stored in the speech cache, along
+    with the keys of the sentences it was joined from, and wav=None sends
+    the cached note instead, by file_id when Telegram has it.
+    """
+    try:
+        if wav is None:
+            entry = speech_cache.entry(cache_key)
+            if entry and entry['file_id']:
+                try:
+                    with span('upload'):
+                        await bot.send_voice(chat_id, entry['file_id'], reply_to_message_id=reply_to_message_id)
+                    speech_cache.count_file_id_hit()
+                    return
+                except TelegramError as e:
+                    logger.warning(f"Cached voice file_id rejected, uploading the note again: {e}")
+                    await run_blocking(speech_cache.set_file_id, cache_key, None)
+            ogg = await run_blocking(speech_cache.read, cache_key)
+            if ogg is None:
+                raise RuntimeError("Cached voice note is gone")
+        else:
+            # Convert WAV to OGG format with OPUS codec, in memory
+            with span('encode'):
+                ogg = await audio_pool.run(wav_to_ogg, wav)
+            if cache_key:
+                await run_blocking(speech_cache.put, cache_key, user_id, ogg, cache_parts)
+        logger.info(f"Sending voice message: {len(ogg)} bytes")
+        with span('upload'):
+            result = await bot.send_voice(
+                chat_id,
+                ogg,
+                reply_to_message_id=reply_to_message_id
+            )
+        if cache_key and result.get('voice'):
+            await run_blocking(speech_cache.set_file_id, cache_key, result['voice']['file_id'])
+    except Exception as e:
+        logger.error(f"Error sending voice message: {e}")
+        if 'VOICE_MESSAGES_FORBIDDEN' in str(e):
+            await bot.send_message(
+                chat_id,
+                "Sorry, I can't send voice messages. Please enable voice messages for everyone in your Telegram privacy settings (Settings -> Privacy and Security -> Voice Messages).",
+                reply_to_message_id=reply_to_message_id
+            )
+        raise
+
+def discard_speech(task):
+    """Cancels a synthesis task that is no longer needed."""
+    if not task.done():
+        task.cancel()
+    elif not task.cancelled():
+        # Retrieve the exception so it isn't logged as never retrieved
+        task.exception()
+
+async def send_concatenated_speech(chat_id, ready, reply_to_message_id, user_id, language):
+    """
+    Sends the synthesis tasks of a whole reply, (sentence, task) pairs, as one
+    voice note, encoded once. A reply found in the speech cache skips the
+    pending syntheses, otherwise the sentences deferred for it are
+    synthesized now.
+    """
+    key = None
+    if speech_cache:
+        key = speech_cache.key(user_id, language, " ".join(sentence for sentence, _ in ready))
+        if speech_cache.lookup(key):
+            for _, task in ready:
+                discard_speech(task)
+            await send_voice_message(chat_id, None, reply_to_message_id, user_id, key)
+            return
+    speeches = [await task for _, task in ready]
+    deferred = [speech for speech in speeches if speech['wav'] is None]
+    for speech, wav in zip(deferred, await asyncio.gather(*(speech['later']() for speech in deferred))):
+        speech['wav'] = wav
+    wav = concatenate_wavs([speech['wav'] for speech in speeches])
+    parts = [speech['key'] for speech in speeches] if key and len(speeches) > 1 else ()
+    await send_voice_message(chat_id, wav, reply_to_message_id, user_id, key, parts)
+
+async def deliver_speech(chat_id, speech_queue, reply_to_message_id, on_first_audio, user_id=None, language=None):
+    """
+    Sends synthesized sentences from speech_queue in reply order, either as
+    one concatenated voice note or as successive notes (TTS_STREAM_MODE).
+    The queue holds (sentence, synthesis task) pairs and ends with None.
+    Returns the sentences that could not be delivered as voice.
+    """
+    ready = []
+    undelivered = []
+    failed = False
+    while True:
+        item = await speech_queue.get()
+        if item is None:
+            break
+        sentence, task = item
+        if TTS_STREAM_MODE != 'separate':
+            # Awaited once the reply is complete
+            ready.append((sentence, task))
+            continue
+        if failed:
+            discard_speech(task)
+            undelivered.append(sentence)
+            continue
+        try:
+            speech = await task
+        except Exception as e:
+            logger.error(f"Error generating voice message: {e}")
+            failed = True
+            undelivered.append(sentence)
+            continue
+        try:
+            await send_voice_message(chat_id, speech['wav'], reply_to_message_id, user_id, speech['key'])
+            on_first_audio()
+        except Exception as e:
+            logger.error(f"Error sending voice message: {e}")
+            failed = True
+            undelivered.append(sentence)
+
+    if ready:
+        try:
+            await send_concatenated_speech(chat_id, ready, reply_to_message_id, user_id, language)
+            on_first_audio()
+        except Exception as e:
+            logger.error(f"Error sending voice message: {e}")
+            for _, task in ready:
+                discard_speech(task)
+            undelivered = [sentence for sentence, _ in ready] + undelivered
+    return undelivered
+
+async def process_llm_response(user_id: str, message_id: str, user_message: str, chat_id: int, reply_to_message_id: int, language: str = 'en', progress=None, use_cache: bool = True) -> None:
+    """
+    Runs one conversation turn for both text and voice messages:
+    a single streamed LLM completion, a single history entry and the spoken
+    reply, synthesized sentence by sentence as the completion arrives.
+    progress is an optional callback called with the stage name
+    ('thinking', 'synthesis') when each stage starts; it must not block.
+    use_cache=False asks the LLM even if the completion cache has an answer.
+    """
+    try:
+        # Language format simplification "en-US" -> "en"
+        language = language.split('-')[0]
+        set_language(language)
+                
+        # Get chat history within the prompt token budget
+        system_prompt = SYSTEM_PROMPT.format(language=language)
+        chat_history = await build_chat_history(user_id, system_prompt, user_message)
+
+        # The same prompt with the same history within LLM_CACHE_TTL is answered from the cache
+        cache_key = cached = None
+        if completion_cache and use_cache:
+            cache_key = completion_cache.key(LLM_MODEL, system_prompt, language, chat_history, user_message)
+            cached = await run_blocking(completion_cache.get, cache_key)
+        elif completion_cache:
+            completion_cache.skipped += 1
+
+        # Generate prompt with chat history
+        prompt_value = prompt_template().invoke({
+            "language": language,
+            "history": chat_history,
+            "question": user_message
+        }, config={'callbacks': callbacks()})
+
+        # Each finished sentence goes to TTS while the LLM keeps generating
+        tts_slots = asyncio.Semaphore(TTS_STREAM_CONCURRENCY)
+
+        async def synthesize(sentence):
+            """
+            {'key': speech cache key, 'wav': audio}, wav is None for a note cached
+            as sent, or in concat mode for a sentence deferred until 'later'
+            """
+            key = speech_cache.key(user_id, language, sentence) if speech_cache else None
+            if key and TTS_STREAM_MODE == 'separate':
+                if speech_cache.lookup(key):
+                    return {'key': key, 'wav': None}
+            elif key and speech_cache.covers(key):
+                # Concatenated replies are cached as a whole, and this one is probably a repeat
+                return {'key': key, 'wav': None, 'later': functools.partial(synthesize_now, sentence)}
+            return {'key': key, 'wav': await synthesize_now(sentence)}
+
+        async def synthesize_now(sentence):
+            async with tts_slots:
+                with span('tts'):
+                    speech = await tts.synthesize(
+                        # Replace dots with newlines and crop extra spaces
+                        text=sentence.replace('.', '\n').strip(),
+                        language=language,
+                        reference_file=f"{user_id}.wav"
+                    )
+            if speech is None:
+                raise RuntimeError("Speech generation failed")
+            return speech
+
+        def on_first_audio():
+            mark('first_audio')
+
+        speech_queue = asyncio.Queue()
+        delivery = asyncio.create_task(
+            deliver_speech(chat_id, speech_queue, reply_to_message_id, on_first_audio, user_id, language)
+        )
+        syntheses = []
+        splitter = SentenceSplitter()
+        reply_parts = []
+        synthesis_started = False
+        async def completion():
+            if cached:
+                yield cached['reply']
+                return
+            async for chunk in llm.astream(prompt_value, config={'callbacks': callbacks()}):
+                yield chunk.content
+
+        def queue_sentence(sentence):
+            task = asyncio.create_task(synthesize(sentence))
+            syntheses.append(task)
+            speech_queue.put_nowait((sentence, task))
+
+        try:
+            if progress:
+                progress('thinking')
+            llm_started = time.perf_counter()
+            with span('llm'):
+                async for content in completion():
+                    mark('first_token')
+                    reply_parts.append(content)
+                    for sentence in splitter.feed(content):
+                        if progress and not synthesis_started:
+                            synthesis_started = True
+                            progress('synthesis')
+                        queue_sentence(sentence)
+            for sentence in splitter.flush():
+                queue_sentence(sentence)
+            speech_queue.put_nowait(None)
+            llm_response = "".join(reply_parts)
+            if cache_key and not cached and llm_response:
+                tokens = count_message_tokens(
+                    [("system", system_prompt), *chat_history, ("human", user_message), ("assistant", llm_response)],
+                    LLM_MODEL
+                )
+                await run_blocking(completion_cache.put, cache_key, llm_response, time.perf_counter() - llm_started, tokens)
+
+            # Store both user message and LLM response
+            with span('history_write'):
+                await run_blocking(
+                    manage_chat_history,
+                    user_id,
+                    str(message_id),
+                    {
+                        "user": user_message,
+                        "assistant": llm_response
+                    }
+                )
+
+            undelivered = await delivery
+        except BaseException:
+            # Nothing of a failed turn may reach the user after the error reply
+            for task in (delivery, *syntheses):
+                task.cancel()
+            await asyncio.gather(delivery, *syntheses, return_exceptions=True)
+            raise
+        if undelivered:
+            # Fall back to text message if voice generation fails
+            await bot.send_message(
+                chat_id,
+                " ".join(undelivered),
+                reply_to_message_id=reply_to_message_id,
+                parse_mode='Markdown'
+            )
+            
+    except Exception as e:
+        logger.error(f"Error in LLM processing: {e}")
+        mark_failed()
+        await bot.send_message(
+            chat_id,
+            "Sorry, there was an error processing your message.",
+            reply_to_message_id=reply_to_message_id
+        )
+
+async def recognize_voice(user_id, languages, chunks=None, file_path=None):
+    """
+    Recognizes a voice message given as WAV chunks, or streamed from file_path,
+    with the user's likely languages. A narrowed attempt that recognizes
+    nothing, is unsure or reports no confidence is repeated with all languages.
+    """
+    async def attempt(codes):
+        if chunks is not None:
+            with span('stt'):
+                return await transcribe_chunks(stt, chunks, codes)
+        # ffmpeg holds a worker only while decoding, not while Google answers;
+        # decoding overlaps recognition, so it counts as stt
+        pcm = await audio_pool.read_ahead(stream_pcm(file_path))
+        with span('stt'):
+            return await stt.transcribe_stream(pcm, codes)
+
+    codes = await language_profiles.codes(user_id, languages) if language_profiles else languages
+    response = await attempt(codes)
+    if len(codes) < len(languages):
+        transcript, _ = join_transcripts(response)
+        confidence = transcript_confidence(response)
+        # No confidence says nothing about the language, so a user who switched is still caught
+        if not transcript or confidence is None or confidence < STT_MIN_CONFIDENCE:
+            logger.info(f"Recognition in {codes} unsure ({confidence}), retrying with all languages")
+            language_profiles.fallbacks += 1
+            response = await attempt(languages)
+    if language_profiles:
+        await language_profiles.record(user_id, join_transcripts(response)[1])
+    return response
+
+async def send_reply(chat_id, message_id, text):
+    # Escape dots in text for MarkdownV2 format
+    text = text.replace('.', '\\.')
+    response = await bot.send_message(
+        chat_id,
+        f"*{text}*",
+        reply_to_message_id=message_id,
+        parse_mode='MarkdownV2'
+    )
+    logger.info(f"Update message response: {response}")
+    return response
+
+def progress_text(text):
+    """Progress line as MarkdownV2 code"""
+    return f"`{text}`".replace('.', '\\.')
+
+@app.post("/message")
+async def call_message(request: Request, authorization: str = Header(None)):
+    message = await request.json()
+    logger.info(message)
+
+    if 'message_id' not in message or 'chat' not in message or 'from' not in message:
+        raise HTTPException(status_code=400, detail="Not a Telegram message")
+
+    # The allow list is served from memory, config.json's ACCESS_CONTROL applies live
+    if config_store.config.get('ACCESS_CONTROL', False) and not user_access(message):
+        return JSONResponse(content={
+            "type": "text", 
+            "body": "You are not authorized to use this bot."
+        })
+
+    # Redelivered webhooks carry the same update_id, or at least the same message_id
+    if 'update_id' in message:
+        key = f"update:{message['update_id']}"
+    else:
+        key = f"message:{message['chat']['id']}:{message['message_id']}"
+
+    try:
+        await job_queue.submit(str(message['from']['id']), key, message)
+    except QueueFull:
+        logger.warning(f"Job queue is full, rejecting message {key}")
+        return JSONResponse(content={
+            "type": "text",
+            "body": "Sorry, I'm overloaded right now. Please try again in a minute."
+        })
+
+    return JSONResponse(content={"type": "empty", "body": ''})
+
+def message_type(message: dict) -> str:
+    """Metrics label of a Telegram message"""
+    if 'voice' in message:
+        return 'voice'
+    if 'document' in message:
+        return 'document'
+    return 'text' if 'text' in message else 'other'
+
+async def handle_message(message: dict) -> None:
+    """Processes one Telegram message, called by the job queue workers."""
+    user_id = str(message['from']['id'])
+    if ready is not None:
+        await ready.wait()
+    with turn_context(message_type(message), user_id), \
+            trace_turn(tracer, user_id=user_id, message_id=message['message_id'], type=message_type(message)):
+        await process_message(message)
+
+async def process_message(message: dict) -> None:
+    """Replies to one Telegram message, timing each stage of the current turn."""
+    chat_id = message['chat']['id']
+    user_id = str(message['from']['id'])
+
+    # Handle audio document
+    if 'document' in message and 'mime_type' in message['document'] and 'audio' in message['document']['mime_type']:
+        try:
+            # Telegram reports the size, so a huge file isn't even downloaded
+            if message['document'].get('file_size', 0) > REFERENCE_MAX_MB * 2 ** 20:
+                raise AudioRejected(f"it is larger than {REFERENCE_MAX_MB} MB")
+            # Get the file from Telegram
+            file_id = message['document']['file_id']
+            with span('fetch'):
+                file_info = await bot.get_file(file_id)
+            file_path = file_info['file_path']
+
+            # Checked from the header, then cut and normalized to WAV in memory
+            with span('transcode'):
+                wav = await audio_pool.run(
+                    prepare_reference,
+                    file_path,
+                    max_seconds=REFERENCE_MAX_SECONDS,
+                    min_seconds=REFERENCE_MIN_SECONDS,
+                    min_sample_rate=REFERENCE_MIN_SAMPLE_RATE,
+                    max_bytes=REFERENCE_MAX_MB * 2 ** 20
+                )
+            
+            # Upload to TTS server
+            filename = f"{user_id}.wav" # One reference for each user
+            with span('reference_upload'):
+                response = await tts.upload_reference_file(wav, filename=filename)
+            if speech_cache:
+                # Notes spoken in the replaced voice are stale now
+                await run_blocking(speech_cache.set_reference, user_id, wav)
+            
+            await bot.send_message(
+                chat_id,
+                "Reference audio file successfully uploaded!",
+                reply_to_message_id=message['message_id']
+            )
+        except AudioRejected as e:
+            logger.info(f"Rejecting reference voice of user {user_id}: {e}")
+            await bot.send_message(
+                chat_id,
+                f"Sorry, this file can't be used as a reference voice: {e}.",
+                reply_to_message_id=message['message_id']
+            )
+        except AudioBusy as e:
+            logger.warning(f"Rejecting audio document: {e}")
+            await bot.send_message(chat_id, AUDIO_BUSY_REPLY, reply_to_message_id=message['message_id'])
+        except Exception as e:
+            logger.error(f"Error processing audio document: {e}")
+            await bot.send_message(
+                chat_id,
+                "Sorry, there was an error processing the audio file.",
+                reply_to_message_id=message['message_id']
+            )
+        return
+
+    # Handle voice message
+    if 'voice' in message and 'audio' in message['voice']['mime_type']:
+        voice_file_id = message['voice']['file_id']
+        duration = message['voice']['duration']
+        
+        if duration < 1:
+            response = "Voice message received, but duration is too short < 1 sec."
+        elif duration > MAX_VOICE_SECONDS:
+            response = f"Voice message received, but duration is too long: > {MAX_VOICE_SECONDS} sec."
+        elif audio_pool.full():
+            # Fast answer instead of a progress message that would stall
+            logger.warning(f"Rejecting voice message of user {user_id}: audio workers busy")
+            await bot.send_message(chat_id, AUDIO_BUSY_REPLY, reply_to_message_id=message['message_id'])
+            return
+        else:
+            # Send status message
+            # bot.send_message(
+            #     chat_id,
+            #     "Converting audio...",
+            #     reply_to_message_id=message['message_id']
+            # )
+            update_message = await send_reply(chat_id, message['message_id'], "[     ] Reading the reference voice..")
+            progress = progress_reporter.track(bot, chat_id, update_message['message_id'])
+            try:
+                start_time = time.time()
+                # Get the file path using the Telegram API
+                with span('fetch'):
+                    file_info = await bot.get_file(voice_file_id)
+                file_path = file_info['file_path']
+                # Log file info and path
+                logger.info(f"File info: {file_info}")
+                logger.info(f"File path: {file_path}")
+                # Check if file exists at file_path
+                if not os.path.exists(file_path):
+                    logger.error(f"File not found at path: {file_path}")
+                    await bot.send_message(
+                        chat_id,
+                        "Sorry, there was an error accessing the voice message file.",
+                        reply_to_message_id=message['message_id']
+                    )
+                    return
+
+                # Convert audio to WAV format
+                progress.update(progress_text("[█    ] Voice convertation.."))
+                languages = config_store.languages
+
+                if STT_STREAMING:
+                    # Decoding and recognition overlap
+                    progress.update(progress_text("[██   ] Voice to text transcribation.."))
+                    stt_response = await recognize_voice(user_id, languages, file_path=file_path)
+                else:
+                    with span('transcode'):
+                        wav = await audio_pool.run(to_wav, file_path)
+                    logger.info(f"WAV size: {len(wav)} bytes")
+
+                    # Silence is not sent, long speech goes out in chunks recognized in parallel
+                    with span('vad'):
+                        chunks = await run_blocking(split_speech, wav, STT_CHUNK_SECONDS, VAD_THRESHOLD_DB)
+
+                    progress.update(progress_text("[██   ] Voice to text transcribation.."))
+                    stt_response = await recognize_voice(user_id, languages, chunks=chunks)
+                transcript, detected_language = join_transcripts(stt_response)
+                logger.info(f"Detected Language: {detected_language}")
+                logger.info(f"Transcript: {transcript}")
+
+                if not transcript:
+                    await bot.send_message(
+                        chat_id,
+                        "Sorry, I couldn't recognize any speech in the voice message.",
+                        reply_to_message_id=message['message_id']
+                    )
+                else:
+                    # Replace Chinese language code for compatibility
+                    if detected_language.lower() == "cmn-hans-cn":
+                        detected_language = "zh-cn"
+
+                    stages = {
+                        'thinking': f"[███  ] [{detected_language}] Thinking..",
+                        'synthesis': f"[████ ] [{detected_language}] Voice synthesis.."
+                    }
+
+                    # One completion and one history entry for the whole voice message
+                    await process_llm_response(
+                        user_id,
+                        message['message_id'],
+                        transcript,
+                        chat_id,
+                        message['message_id'],
+                        detected_language,
+                        progress=lambda stage: progress.update(progress_text(stages[stage]))
+                    )
+                    logger.info(f"Voice response sent to user {user_id}")
+                    progress.finish(progress_text(f"[█████] [{detected_language}] Done in {round(time.time() - start_time, 1)} sec."))
+                return
+                
+            except AudioBusy as e:
+                logger.warning(f"Rejecting voice message of user {user_id}: {e}")
+                await bot.send_message(chat_id, AUDIO_BUSY_REPLY, reply_to_message_id=message['message_id'])
+            except Exception as e:
+                logger.error(f"Error processing audio: {e}")
+                response = "Sorry, there was an error processing the voice message."
+                await bot.send_message(
+                    chat_id,
+                    response,
+                    reply_to_message_id=message['message_id']
+                )
+            finally:
+                # Stops the progress task, the final text above is still sent
+                progress.finish()
+
+        return
+
+    # Original text message handling
+    if 'text' not in message:
+        await bot.send_message(
+            chat_id,
+            "Sorry, this message type is not supported yet.",
+            reply_to_message_id=message['message_id']
+        )
+        return
+
+    text = message['text']
+
+    if text == '/reset':
+        await run_blocking(clear_chat_history, user_id)
+        await bot.send_message(
+            chat_id,
+            "Chat history has been reset.",
+            reply_to_message_id=message['message_id']
+        )
+        return
+    
+    if text == '/start':
+        greeting = config_store.greeting
+        if greeting is not None:
+            greeting += f'\nSupported languages: {config_store.languages}'
+            await bot.send_message(
+                chat_id,
+                greeting,
+                reply_to_message_id=message['message_id']
+            )
+        else:
+            logger.error("greeting.txt not found")
+            await bot.send_message(
+                chat_id,
+                "Welcome! I'm Janet, your AI assistant.",
+                reply_to_message_id=message['message_id']
+            )
+        return
+
+    # "/fresh <question>" skips the completion cache
+    use_cache = not text.startswith('/fresh ')
+    if not use_cache:
+        text = text[len('/fresh '):]
+
+    # Process LLM response
+    await process_llm_response(
+        user_id,
+        message['message_id'],
+        text,
+        chat_id,
+        message['message_id'],
+        'en',
+        use_cache=use_cache
+    )
+
+# Webhook updates are acknowledged at once and processed by the queue workers
+if config.get('QUEUE_BACKEND', 'memory') == 'redis':
+    queue_backend = RedisBackend(config.get('REDIS_URL', 'redis://localhost:6379/0'))
+else:
+    queue_backend = MemoryBackend()
+# Turns of one user never overlap, also across processes: 'none', 'file' or 'redis'
+user_locks = config.get('USER_LOCKS', 'file' if WORKERS > 1 else 'none')
+if user_locks == 'redis':
+    user_locks = RedisLocks(config.get('REDIS_URL', 'redis://localhost:6379/0'))
+elif user_locks == 'file':
+    user_locks = FileLocks('data/locks')
+else:
+    user_locks = None
+job_queue = JobQueue(
+    handle_message,
+    workers=config.get('QUEUE_WORKERS', 8),
+    maxsize=config.get('QUEUE_SIZE', 100),
+    backend=queue_backend,
+    locks=user_locks
+)
+
+# Removes leftovers of failed requests, compacts histories and keeps data/ within its quotas
+if config.get('JANITOR', True):
+    janitor = Janitor(
+        'data',
+        history=history_store,
+        summarizer=history_summarizer,
+        languages=language_profiles,
+        locks=user_locks,
+        lock_files=user_locks if isinstance(user_locks, FileLocks) else FileLocks('data/locks'),
+        speech_cache=speech_cache,
+        completion_cache=completion_cache,
+        orphan_age=config.get('JANITOR_ORPHAN_AGE', 3600),
+        user_max_bytes=int(config.get('USER_QUOTA_MB', 0) * 2 ** 20) or None,
+        user_max_files=config.get('USER_QUOTA_FILES'),
+        max_bytes=int(config.get('DATA_QUOTA_MB', 0) * 2 ** 20) or None,
+        max_files=config.get('DATA_QUOTA_FILES'),
+        quota_keep_bytes=int(config.get('DATA_QUOTA_KEEP_KB', 64) * 1024),
+        clear_users=config.get('DATA_QUOTA_CLEAR_USERS', False),
+        executor=executor
+    )
+else:
+    janitor = None
+
+@app.get("/test")
+async def call_test():
+    return JSONResponse(content={"status": "ok"})
+
+@app.get("/ready")
+async def call_ready():
+    """200 once models are loaded and warmup is done, 503 before; /test only says the process is up"""
+    is_ready = ready is not None and ready.is_set()
+    return JSONResponse(
+        content={"ready": is_ready, "warmup": warmup_report},
+        status_code=200 if is_ready else 503
+    )
+
+@app.post("/admin/reload")
+async def call_reload(authorization: str = Header(None)):
+    """Reloads config files at once, needs ADMIN_TOKEN from config.json as a Bearer token"""
+    admin_token = config_store.config.get('ADMIN_TOKEN')
+    if not admin_token or not hmac.compare_digest(authorization or '', f"Bearer {admin_token}"):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    return JSONResponse(content=await run_blocking(config_store.reload))
+
+@app.post("/admin/janitor")
+async def call_janitor(authorization: str = Header(None)):
+    """Runs a janitor sweep at once and returns its report, needs ADMIN_TOKEN like /admin/reload"""
+    admin_token = config_store.config.get('ADMIN_TOKEN')
+    if not admin_token or not hmac.compare_digest(authorization or '', f"Bearer {admin_token}"):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    if not janitor:
+        raise HTTPException(status_code=404, detail="Janitor disabled")
+    report = await janitor.sweep()
+    if report is None:
+        raise HTTPException(status_code=409, detail="Another process is sweeping")
+    return JSONResponse(content=report)
+
+@app.get("/metrics")
+async def call_metrics():
+    """Stage and turn latency histograms in the Prometheus text format"""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/stats")
+async def call_stats():
+    return JSONResponse(content={
+        "queue": job_queue.stats(),
+        "history_cache": history_store.stats() if isinstance(history_store, HistoryCache) else None,
+        "audio": audio_pool.stats(),
+        "config": config_store.stats(),
+        "speech_cache": speech_cache.stats() if speech_cache else None,
+        "progress": progress_reporter.stats(),
+        "telegram": bot.stats(),
+        "language_profiles": language_profiles.stats() if language_profiles else None,
+        "tracing": tracer.stats() if tracer else None,
+        "llm_cache": completion_cache.stats() if completion_cache else None,
+        "janitor": janitor.stats() if janitor else None
+    })
\ No newline at end of file
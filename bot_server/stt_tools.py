@@ -1,42 +1,158 @@
-from typing import List
-from google.cloud import speech_v1 as speech
-
-def transcribe_multiple_languages(audio_file: str, language_codes: List[str]):
-    """Transcribe an audio file using Google Cloud Speech-to-Text API with support for multiple languages.
-
-    Args:
-        audio_file (str): Path to the local audio file to be transcribed.
-        language_codes (List[str]): A list of BCP-47 language codes for transcription.
-
-    Returns:
-        None: Prints the transcription results.
-    """
-    client = speech.SpeechClient()
-
-    # Reads a file as bytes
-    with open(audio_file, "rb") as f:
-        audio_content = f.read()
-
-    config = {
-        "encoding": speech.RecognitionConfig.AudioEncoding.LINEAR16,
-        "language_code": language_codes[0],  # Primary language
-        "alternative_language_codes": language_codes[1:],  # Alternative languages
-        "model": "latest_long"  # Use the latest model
-    }
-
-    audio = {"content": audio_content}
-    
-    response = client.recognize(config=config, audio=audio)
-
-    return response
-
-# Example usage
-if __name__ == "__main__":
-    audio_file_path = "in.wav"  # Replace with your audio file path
-    with open("BCP-47.txt", "r") as f:  # https://cloud.google.com/speech-to-text/docs/speech-to-text-supported-languages
-        languages = [line.strip() for line in f if line.strip()]
-    response = transcribe_multiple_languages(audio_file_path, languages)
-    for result in response.results:
-        detected_language = result.language_code  # Get detected language code
-        print(f"Detected Language: {detected_language}")
-        print(f"Transcript: {result.alternatives[0].transcript}")
+import asyncio
+import functools
+from abc import ABC, abstractmethod
+from types import SimpleNamespace
+from typing import AsyncIterator, List
+
+# Raw PCM format of streamed audio: 16 kHz, mono, 16-bit
+STREAM_SAMPLE_RATE = 16000
+
+@functools.lru_cache(maxsize=None)
+def speech_module():
+    """google.cloud.speech_v1, imported on first use since it takes half a second to load."""
+    from google.cloud import speech_v1
+    return speech_v1
+
+@functools.lru_cache(maxsize=None)
+def get_client():
+    """Long-lived client, so the gRPC channel and credentials are set up once per process."""
+    return speech_module().SpeechClient()
+
+@functools.lru_cache(maxsize=None)
+def get_async_client():
+    """Long-lived async client, created lazily inside the running event loop."""
+    return speech_module().SpeechAsyncClient()
+
+def recognition_config(language_codes: List[str], sample_rate_hertz: int = None) -> dict:
+    config = {
+        "encoding": speech_module().RecognitionConfig.AudioEncoding.LINEAR16,
+        "language_code": language_codes[0],  # Primary language
+        "alternative_language_codes": language_codes[1:],  # Alternative languages
+        "model": "latest_long"  # Use the latest model
+    }
+    if sample_rate_hertz:
+        # Raw PCM has no WAV header to read it from
+        config["sample_rate_hertz"] = sample_rate_hertz
+    return config
+
+def transcribe_multiple_languages(audio_file: str, language_codes: List[str]):
+    """Transcribe an audio file using Google Cloud Speech-to-Text API with support for multiple languages.
+
+    Args:
+        audio_file (str): Path to the local audio file to be transcribed.
+        language_codes (List[str]): A list of BCP-47 language codes for transcription.
+
+    Returns:
+        RecognizeResponse: The transcription results.
+    """
+    # Reads a file as bytes
+    with open(audio_file, "rb") as f:
+        audio_content = f.read()
+
+    audio = {"content": audio_content}
+    
+    response = get_client().recognize(config=recognition_config(language_codes), audio=audio)
+
+    return response
+
+class STTBackend(ABC):
+    """
+    Speech-to-text backend interface. Both methods return an object with a
+    `results` list shaped like a Google RecognizeResponse, see join_transcripts.
+    A backend missing one of them fails when it is created.
+    """
+
+    @abstractmethod
+    async def transcribe(self, audio: bytes, language_codes: List[str]):
+        """Transcribe a 16-bit mono WAV file given as bytes."""
+
+    @abstractmethod
+    async def transcribe_stream(self, chunks: AsyncIterator[bytes], language_codes: List[str]):
+        """Transcribe raw 16 kHz mono 16-bit PCM arriving as chunks."""
+
+    async def warmup(self):
+        """Sets up the client before the first message, optional."""
+
+class GoogleSTT(STTBackend):
+    """Google Cloud Speech-to-Text through the shared async client."""
+
+    async def warmup(self):
+        # Loading the library and the credentials blocks, the client itself binds to the loop
+        await asyncio.get_running_loop().run_in_executor(None, speech_module)
+        get_async_client()
+
+    async def transcribe(self, audio: bytes, language_codes: List[str]):
+        return await get_async_client().recognize(
+            config=recognition_config(language_codes),
+            audio={"content": audio}
+        )
+
+    async def transcribe_stream(self, chunks: AsyncIterator[bytes], language_codes: List[str]):
+        """Sends audio while it is still being decoded and collects the final results."""
+        speech = speech_module()
+
+        async def requests():
+            # The first request carries only the config, the rest only audio
+            yield speech.StreamingRecognizeRequest(
+                streaming_config=speech.StreamingRecognitionConfig(
+                    config=recognition_config(language_codes, STREAM_SAMPLE_RATE)
+                )
+            )
+            async for chunk in chunks:
+                yield speech.StreamingRecognizeRequest(audio_content=chunk)
+
+        results = []
+        stream = await get_async_client().streaming_recognize(requests=requests())
+        async for response in stream:
+            results.extend(result for result in response.results if result.is_final)
+        return SimpleNamespace(results=results)
+
+async def transcribe_chunks(backend: STTBackend, chunks: List[bytes], language_codes: List[str]):
+    """Transcribes the WAV chunks of one message at once, results stay in chunk order."""
+    responses = await asyncio.gather(*[backend.transcribe(chunk, language_codes) for chunk in chunks])
+    return SimpleNamespace(results=[result for response in responses for result in response.results])
+
+def join_transcripts(response):
+    """Join the results of a recognize response into a single transcript.
+
+    Long audio comes back as several consecutive results, each with its own
+    detected language. They are parts of one utterance, so the transcripts
+    are joined in order and the language of the first result is reported.
+
+    Returns:
+        tuple: (transcript, language_code), ("", None) when nothing was recognized.
+    """
+    transcripts = []
+    language_code = None
+    for result in response.results:
+        if not result.alternatives:
+            continue
+        transcript = result.alternatives[0].transcript.strip()
+        if not transcript:
+            continue
+        transcripts.append(transcript)
+        if language_code is None:
+            language_code = result.language_code
+    return " ".join(transcripts), language_code
+
+def transcript_confidence(response):
+    """Mean confidence of the top alternatives, None when recognition reported none.
+
+    Google leaves confidence at 0.0 when it wasn't computed, so zeros are skipped.
+    """
+    confidences = [
+        result.alternatives[0].confidence
+        for result in response.results
+        if result.alternatives and getattr(result.alternatives[0], 'confidence', 0.0)
+    ]
+    return sum(confidences) / len(confidences) if confidences else None
+
+# Example usage
+if __name__ == "__main__":
+    audio_file_path = "in.wav"  # Replace with your audio file path
+    with open("BCP-47.txt", "r") as f:  # https://cloud.google.com/speech-to-text/docs/speech-to-text-supported-languages
+        languages = [line.strip() for line in f if line.strip()]
+    response = transcribe_multiple_languages(audio_file_path, languages)
+    transcript, detected_language = join_transcripts(response)
+    print(f"Detected Language: {detected_language}")
+    print(f"Transcript: {transcript}")
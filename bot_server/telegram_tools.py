@@ -0,0 +1,325 @@
+import asyncio
+import logging
+import time
+import httpx
+
+logger = logging.getLogger(__name__)
+
+
+class TelegramError(Exception):
+    """Raised when the Bot API server answers a call with ok=false."""
+
+    def __init__(self, method, error_code, description, parameters=None):
+        super().__init__(f"{method} failed: [{error_code}] {description}")
+        self.method = method
+        self.error_code = error_code
+        self.description = description
+        self.parameters = parameters or {}
+
+
+class TokenBucket:
+    """Token bucket for one rate limit, reserve() returns how long to wait before the call"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        # Tokens go negative while calls queue up, so waiters are served in order
+        self._refill()
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def pause(self, seconds):
+        """No calls for the next seconds, as asked by a 429 retry_after"""
+        self._refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def idle(self) -> bool:
+        self._refill()
+        return self.tokens >= self.burst
+
+
+class TelegramClient:
+    """
+    Async client for the local Telegram Bot API server. Calls share one
+    keep-alive connection pool and go through token buckets matching
+    Telegram's limits: rate calls per second overall, chat_rate per private
+    chat and group_rate per group. 429 answers are retried after retry_after,
+    5xx answers, JSON or not (a proxy's error page), after backoff seconds
+    doubling with every attempt.
+    """
+
+    def __init__(self, token, api_url='http://localhost:8081', timeout=30.0, pool_size=20,
+                 rate=30.0, chat_rate=1.0, chat_burst=3, group_rate=20 / 60, retries=3,
+                 max_retry_after=60, backoff=0.5):
+        self.token = token
+        self.api_url = api_url
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.retries = retries
+        self.max_retry_after = max_retry_after
+        self.backoff = backoff
+        self._client = httpx.AsyncClient(
+            base_url=f"{api_url}/bot{token}",
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        )
+        self._global = TokenBucket(rate, rate)
+        self._chats = {}
+        self._prune_at = 1000
+        self.calls = 0
+        self.throttled = 0
+        self.throttle_seconds = 0.0
+        self.rate_limited = 0
+        self.server_errors = 0
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self._prune_at:
+                # Buckets that refilled completely hold no state worth keeping
+                self._chats = {key: value for key, value in self._chats.items() if not value.idle()}
+                self._prune_at = max(1000, 2 * len(self._chats))
+            # Group chat ids are negative
+            rate = self.group_rate if str(chat_id).startswith('-') else self.chat_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, self.chat_burst)
+        return bucket
+
+    async def _throttle(self, chat_id):
+        # Per chat first, so a call held back by its chat doesn't hold a global token meanwhile
+        for bucket in (self._chat_bucket(chat_id), self._global):
+            delay = bucket.reserve()
+            if delay > 0:
+                self.throttled += 1
+                self.throttle_seconds += delay
+                await asyncio.sleep(delay)
+
+    async def call(self, method, data=None, files=None):
+        """Call a Bot API method and return its result field."""
+        if data:
+            # The Bot API treats missing and null fields differently
+            data = {key: value for key, value in data.items() if value is not None}
+        chat_id = (data or {}).get('chat_id')
+        attempt = 0
+        while True:
+            if chat_id is not None:
+                await self._throttle(chat_id)
+            for _, content, _ in (files or {}).values():
+                # A retried upload has to send the file from the start again
+                if hasattr(content, 'seek'):
+                    content.seek(0)
+            self.calls += 1
+            response = await self._client.post(f"/{method}", data=data, files=files)
+            try:
+                payload = response.json()
+            except ValueError:
+                payload = {'error_code': response.status_code, 'description': f"Non-JSON answer: {response.text[:200]}"}
+            if payload.get('ok'):
+                return payload['result']
+            error = TelegramError(
+                method,
+                payload.get('error_code'),
+                payload.get('description'),
+                payload.get('parameters')
+            )
+            if response.status_code >= 500:
+                self.server_errors += 1
+                if attempt >= self.retries:
+                    raise error
+                delay = self.backoff * 2 ** attempt
+                logger.warning(f"{method} failed with {response.status_code}, retrying in {delay}s")
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            retry_after = error.parameters.get('retry_after')
+            if error.error_code != 429 or retry_after is None:
+                raise error
+            self.rate_limited += 1
+            if attempt >= self.retries or retry_after > self.max_retry_after:
+                raise error
+            logger.warning(f"{method} rate limited, retrying in {retry_after}s")
+            if chat_id is not None:
+                self._chat_bucket(chat_id).pause(retry_after)
+            else:
+                await asyncio.sleep(retry_after)
+            attempt += 1
+
+    async def warmup(self):
+        """Opens a pooled connection to the Bot API server and checks the token"""
+        return await self.call('getMe')
+
+    async def send_message(self, chat_id, text, reply_to_message_id=None, parse_mode=None):
+        return await self.call('sendMessage', {
+            'chat_id': chat_id,
+            'text': text,
+            'reply_to_message_id': reply_to_message_id,
+            'parse_mode': parse_mode
+        })
+
+    async def edit_message_text(self, text, chat_id, message_id, parse_mode=None):
+        return await self.call('editMessageText', {
+            'chat_id': chat_id,
+            'message_id': message_id,
+            'text': text,
+            'parse_mode': parse_mode
+        })
+
+    async def get_file(self, file_id):
+        return await self.call('getFile', {'file_id': file_id})
+
+    async def send_voice(self, chat_id, voice, reply_to_message_id=None):
+        """
+        Send OGG/OPUS voice given as bytes or a binary file object, or as the
+        file_id of a voice sent before, which needs no upload.
+        """
+        data = {'chat_id': chat_id, 'reply_to_message_id': reply_to_message_id}
+        if isinstance(voice, str):
+            return await self.call('sendVoice', {**data, 'voice': voice})
+        return await self.call(
+            'sendVoice',
+            data,
+            files={'voice': ('voice.ogg', voice, 'audio/ogg')}
+        )
+
+    def stats(self) -> dict:
+        return {
+            'calls': self.calls,
+            'throttled': self.throttled,
+            'throttle_seconds': round(self.throttle_seconds, 3),
+            'rate_limited': self.rate_limited,
+            'server_errors': self.server_errors,
+            'chats': len(self._chats)
+        }
+
+    async def aclose(self):
+        await self._client.aclose()
+
+
+class ProgressMessage:
+    """One progress message edited in the background, see ProgressReporter.track."""
+
+    def __init__(self, reporter, bot, chat_id, message_id, text=None):
+        self.reporter = reporter
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self._shown = text
+        self._pending = None
+        self._closing = False
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        reporter._tasks.add(self._task)
+        self._task.add_done_callback(reporter._tasks.discard)
+
+    def update(self, text):
+        """Shows text as soon as the chat may be edited again, replacing any update not sent yet."""
+        if self._closing:
+            return
+        if self._pending is not None:
+            self.reporter.coalesced += 1
+        self._pending = text
+        self._wake.set()
+
+    def finish(self, text=None):
+        """Sends the final text, if any, and stops; does not wait for the edit."""
+        if text is not None:
+            self.update(text)
+        self._closing = True
+        self._wake.set()
+
+    async def _run(self):
+        reporter = self.reporter
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            # Debounce: later updates arriving meanwhile replace this one
+            delay = reporter._next_edit.get(self.chat_id, 0) - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            text, self._pending = self._pending, None
+            if text is not None and text != self._shown:
+                await self._edit(text)
+            if self._pending is not None:
+                self._wake.set()
+            elif self._closing:
+                break
+        # Forget chats that may be edited again already
+        now = time.monotonic()
+        if reporter._next_edit.get(self.chat_id, 0) <= now:
+            reporter._next_edit.pop(self.chat_id, None)
+
+    async def _edit(self, text):
+        reporter = self.reporter
+        try:
+            await self.bot.edit_message_text(
+                text,
+                chat_id=self.chat_id,
+                message_id=self.message_id,
+                parse_mode=reporter.parse_mode
+            )
+            reporter.edits += 1
+            self._shown = text
+            reporter._next_edit[self.chat_id] = time.monotonic() + reporter.interval
+        except TelegramError as e:
+            if e.error_code == 429:
+                retry_after = e.parameters.get('retry_after', reporter.interval)
+                logger.warning(f"Progress edits in chat {self.chat_id} rate limited for {retry_after}s")
+                reporter.rate_limited += 1
+                reporter._next_edit[self.chat_id] = time.monotonic() + retry_after
+                # Retried after the wait, unless a newer text arrives first
+                if self._pending is None:
+                    self._pending = text
+            elif 'message is not modified' in str(e.description):
+                self._shown = text
+            else:
+                reporter.failed += 1
+                logger.warning(f"Progress edit failed: {e}")
+        except Exception as e:
+            # Progress is cosmetic, it never fails the turn
+            reporter.failed += 1
+            logger.warning(f"Progress edit failed: {e}")
+
+
+class ProgressReporter:
+    """
+    Edits progress messages off the critical path. Each chat gets at most
+    one edit per interval, intermediate states that were superseded before
+    their turn are skipped, and 429 responses pause the chat for retry_after.
+    """
+
+    def __init__(self, interval=1.0, parse_mode='MarkdownV2'):
+        self.interval = interval
+        self.parse_mode = parse_mode
+        self._next_edit = {}
+        self._tasks = set()
+        self.edits = 0
+        self.coalesced = 0
+        self.rate_limited = 0
+        self.failed = 0
+
+    def track(self, bot, chat_id, message_id, text=None):
+        """Progress handle for a message sent through bot, already showing text."""
+        return ProgressMessage(self, bot, chat_id, message_id, text)
+
+    async def aclose(self):
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            'active': len(self._tasks),
+            'edits': self.edits,
+            'coalesced': self.coalesced,
+            'rate_limited': self.rate_limited,
+            'failed': self.failed
+        }
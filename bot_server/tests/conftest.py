@@ -0,0 +1,48 @@
+import json
+import os
+import shutil
+import sys
+
+import pytest
+
+BOT_SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BOT_SERVER_DIR)
+
+
+@pytest.fixture(scope='session')
+def server(tmp_path_factory):
+    """server.py imported from a scratch directory with a dummy config.json, kept for the session"""
+    workdir = tmp_path_factory.mktemp('server')
+    os.makedirs(workdir / 'data')
+    with open(workdir / 'config.json', 'w') as f:
+        json.dump({
+            "TOKEN": "test",
+            "OPENAI_API_KEY": "test",
+            # Off the network and out of LangSmith
+            "LANGSMITH_TRACING": False,
+            "WARMUP": False,
+            "LLM_CACHE": False,
+            "JANITOR": False
+        }, f)
+    for name in ('BCP-47.txt', 'greeting.txt'):
+        shutil.copy(os.path.join(BOT_SERVER_DIR, name), workdir / name)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    import server
+    yield server
+    os.chdir(cwd)
+
+
+@pytest.fixture
+def fake_server(server, monkeypatch):
+    """The server with every outside service replaced by the fakes"""
+    from fakes import FakeChatModel, FakeSTT, FakeTTS, FakeTelegram, fake_stream_pcm, fake_to_wav, fake_wav_to_ogg
+
+    monkeypatch.setattr(server, 'bot', FakeTelegram(latency=0))
+    monkeypatch.setattr(server, 'llm', FakeChatModel(latency=0))
+    monkeypatch.setattr(server, 'tts', FakeTTS(latency=0))
+    monkeypatch.setattr(server, 'stt', FakeSTT(latency=0))
+    monkeypatch.setattr(server, 'to_wav', fake_to_wav)
+    monkeypatch.setattr(server, 'wav_to_ogg', fake_wav_to_ogg)
+    monkeypatch.setattr(server, 'stream_pcm', fake_stream_pcm)
+    return server
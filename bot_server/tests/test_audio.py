@@ -0,0 +1,46 @@
+import asyncio
+
+import pytest
+
+from audio_tools import AudioBusy, AudioPool
+
+
+async def decode(chunks=5):
+    for i in range(chunks):
+        await asyncio.sleep(0)
+        yield bytes([i])
+
+
+def test_read_ahead_frees_the_worker_before_the_stream_is_consumed():
+    async def run():
+        pool = AudioPool(workers=1, max_queue=0)
+        stream = await pool.read_ahead(decode())
+        # Recognition is slow to take the first chunk, decoding is done by then
+        await asyncio.sleep(0.05)
+        running = pool.running
+        chunks = [chunk async for chunk in stream]
+        return running, chunks, pool.stats()['completed']
+
+    running, chunks, completed = asyncio.run(run())
+    assert running == 0
+    assert chunks == [bytes([i]) for i in range(5)]
+    assert completed == 1
+
+
+def test_read_ahead_is_refused_when_busy_and_passes_decode_errors():
+    async def failing():
+        yield b'\x00'
+        raise RuntimeError("ffmpeg failed")
+
+    async def run():
+        pool = AudioPool(workers=1, max_queue=0)
+        async with pool.slot():
+            with pytest.raises(AudioBusy):
+                await pool.read_ahead(decode())
+        stream = await pool.read_ahead(failing())
+        with pytest.raises(RuntimeError):
+            async for _ in stream:
+                pass
+        return pool.running
+
+    assert asyncio.run(run()) == 0
@@ -0,0 +1,63 @@
+import asyncio
+import gc
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from fakes import FakeChatModel
+from history_tools import HistoryCache, HistoryStore, HistorySummarizer, make_turn, migrate_legacy_history
+
+
+def write_json(path, data):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+
+
+def test_migration_keeps_unreadable_files(tmp_path):
+    user_dir = tmp_path / 'users' / '1'
+    os.makedirs(user_dir)
+    write_json(user_dir / '20240101_000000_1.json', {'user': 'Hi', 'assistant': 'Hello'})
+    with open(user_dir / '20240101_000001_2.json', 'w') as f:
+        f.write('{"user": "torn')
+    write_json(user_dir / '20240101_000002_3.json', ['not', 'a', 'turn'])
+    write_json(user_dir / 'languages.json', {'en-us': 1.0})
+
+    assert migrate_legacy_history(str(user_dir)) == 1
+    assert sorted(os.listdir(user_dir)) == [
+        '20240101_000001_2.json.bad', '20240101_000002_3.json.bad', 'history.jsonl', 'languages.json'
+    ]
+    assert HistoryStore(str(tmp_path / 'users')).read('1') == [('user', 'Hi'), ('assistant', 'Hello')]
+    # Nothing left to migrate, so a second run doesn't touch the log
+    assert migrate_legacy_history(str(user_dir)) == 0
+
+
+def test_memory_is_bounded_by_user_count(tmp_path):
+    store = HistoryStore(str(tmp_path / 'users'), max_users=10)
+    cache = HistoryCache(store, max_users=10)
+    for user_id in range(100):
+        cache.append(user_id, 1, [('user', 'Hi'), ('assistant', 'Hello')])
+        cache.read_turns(user_id)
+    assert len(store._logs) == len(store._locks) == 10
+    assert len(cache._entries) == 10 and not cache._reads
+    # An evicted user's index is rebuilt from the log
+    assert cache.read('0') == [('user', 'Hi'), ('assistant', 'Hello')]
+    assert store.evictions == 91
+
+
+def test_summary_update_runs_to_the_end(tmp_path):
+    executor = ThreadPoolExecutor(max_workers=1)
+    summarizer = HistorySummarizer(FakeChatModel(latency=0.05), str(tmp_path), executor=executor)
+    older = [make_turn(1, [('user', 'Hi'), ('assistant', 'Hello')], 10)]
+
+    async def run():
+        assert await summarizer.get('1', older) is None
+        assert len(summarizer._tasks) == 1
+        # Nothing else references the update
+        gc.collect()
+        await asyncio.sleep(0.2)
+        return await summarizer.get('1', older)
+
+    assert asyncio.run(run()) == FakeChatModel().reply
+    assert not summarizer._tasks
+    assert os.path.exists(tmp_path / '1' / 'summary.json')
+    executor.shutdown()
@@ -0,0 +1,31 @@
+import asyncio
+import time
+
+
+def test_warmup_timeout_does_not_cut_model_loading(fake_server, monkeypatch):
+    server = fake_server
+    loaded = []
+
+    def slow_load_models():
+        time.sleep(0.3)
+        loaded.append(True)
+
+    async def slow_probe():
+        await asyncio.sleep(1)
+
+    monkeypatch.setattr(server, 'load_models', slow_load_models)
+    monkeypatch.setattr(server.bot, 'warmup', slow_probe, raising=False)
+    monkeypatch.setitem(server.config, 'WARMUP', True)
+    monkeypatch.setitem(server.config, 'WARMUP_TIMEOUT', 0.1)
+    monkeypatch.setattr(server, 'warmup_report', {})
+
+    async def warmup():
+        monkeypatch.setattr(server, 'ready', asyncio.Event())
+        await server.warmup()
+        return server.ready.is_set()
+
+    assert asyncio.run(warmup())
+    # Ready only once the models are loaded, while a slow probe is skipped
+    assert loaded == [True]
+    assert isinstance(server.warmup_report['models'], float)
+    assert server.warmup_report['telegram'].startswith('failed: TimeoutError')
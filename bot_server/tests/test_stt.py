@@ -0,0 +1,43 @@
+import asyncio
+
+import pytest
+
+from fakes import FakeSTT, silence_wav
+from language_tools import LanguageProfiles
+from stt_tools import STTBackend, join_transcripts
+
+
+def test_backend_missing_a_method_fails_when_created():
+    class BatchOnly(STTBackend):
+        async def transcribe(self, audio, language_codes):
+            return None
+
+    with pytest.raises(TypeError):
+        BatchOnly()
+    assert isinstance(FakeSTT(), STTBackend)
+
+
+class NoConfidenceSTT(FakeSTT):
+    """Recognition that never reports a confidence, as Google often does"""
+
+    def _response(self, language_codes):
+        response = super()._response(language_codes)
+        for result in response.results:
+            result.alternatives[0].confidence = 0.0
+        return response
+
+
+def test_switched_language_is_detected_without_confidence(server, monkeypatch, tmp_path):
+    profiles = LanguageProfiles(str(tmp_path))
+    monkeypatch.setattr(server, 'language_profiles', profiles)
+    monkeypatch.setattr(server, 'stt', NoConfidenceSTT(language_code='en-us', latency=0))
+    languages = ['en-US', 'ru-RU']
+
+    async def run():
+        for _ in range(5):
+            await profiles.record('1', 'ru-ru')
+        assert await profiles.codes('1', languages) == ['ru-RU']
+        return await server.recognize_voice('1', languages, chunks=[silence_wav(seconds=1)])
+
+    assert join_transcripts(asyncio.run(run()))[1] == 'en-us'
+    assert server.stt.calls == 2
@@ -0,0 +1,43 @@
+import asyncio
+
+import httpx
+import pytest
+
+from telegram_tools import TelegramClient, TelegramError
+
+PROXY_ERROR = '<html><body><h1>502 Bad Gateway</h1></body></html>'
+
+
+def mock_client(answers):
+    """Client whose Bot API answers are taken from answers in order"""
+    client = TelegramClient('token', backoff=0.01)
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return answers.pop(0)
+
+    client._client = httpx.AsyncClient(
+        base_url='http://telegram/bottoken', transport=httpx.MockTransport(handler)
+    )
+    return client, requests
+
+
+def test_non_json_server_error_is_retried():
+    client, requests = mock_client([
+        httpx.Response(502, text=PROXY_ERROR),
+        httpx.Response(500, json={'ok': False, 'error_code': 500, 'description': 'Internal Server Error'}),
+        httpx.Response(200, json={'ok': True, 'result': {'message_id': 1}})
+    ])
+    result = asyncio.run(client.call('sendMessage', {'chat_id': 1, 'text': 'Hi'}))
+    assert result == {'message_id': 1}
+    assert len(requests) == 3
+    assert client.stats()['server_errors'] == 2
+
+
+def test_non_json_client_error_raises():
+    client, requests = mock_client([httpx.Response(404, text='Not Found')])
+    with pytest.raises(TelegramError) as raised:
+        asyncio.run(client.call('sendMessage', {'chat_id': 1, 'text': 'Hi'}))
+    assert raised.value.error_code == 404
+    assert len(requests) == 1
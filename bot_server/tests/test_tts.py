@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import os
+import socket
+
+import pytest
+
+from fakes import make_tts_stub, serve_in_thread, write_silence
+from tts_tools import AsyncTTSClient, SpeechCache, TTSClient
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def stub():
+    """Starts a stub TTS server, call it with make_tts_stub arguments, returns (app, url)"""
+    servers = []
+
+    def start(**kwargs):
+        app = make_tts_stub(**kwargs)
+        port = free_port()
+        servers.append(serve_in_thread(app, port))
+        return app, f"http://127.0.0.1:{port}"
+
+    yield start
+    for server in servers:
+        server.should_exit = True
+
+
+def test_5xx_is_retried(stub):
+    app, url = stub(latency=0, fail_every=2)
+    with TTSClient(url, retries=2, backoff=0.001) as client:
+        results = [client.synthesize(f"Request {i}", 'en') for i in range(10)]
+    assert all(results)
+    # Every request after the first failed once and was sent again
+    assert app.state.requests == 19
+
+
+def test_5xx_gives_up_after_retries(stub):
+    app, url = stub(latency=0, fail_every=1)
+    with TTSClient(url, retries=2, backoff=0.001) as client:
+        assert client.synthesize("Hello", 'en') is None
+    assert app.state.requests == 3
+
+
+def test_connect_errors_are_retried(caplog):
+    url = f"http://127.0.0.1:{free_port()}"
+    with caplog.at_level(logging.WARNING, logger='tts_tools'):
+        with TTSClient(url, retries=2, backoff=0.001) as client:
+            assert client.synthesize("Hello", 'en') is None
+    assert sum('retrying' in record.message for record in caplog.records) == 2
+
+
+def test_read_timeout_is_not_retried(stub):
+    # The server may still be synthesizing, so asking again would only add load
+    app, url = stub(latency=0.5)
+    with TTSClient(url, retries=2, backoff=0.001, read_timeout=0.1) as client:
+        assert client.synthesize("Hello", 'en') is None
+    assert app.state.requests == 1
+
+
+def test_async_client_retries_5xx_and_uploads(stub, tmp_path):
+    app, url = stub(latency=0, fail_every=2)
+    reference = write_silence(str(tmp_path / 'reference.wav'), seconds=2)
+
+    async def run():
+        client = AsyncTTSClient(url, retries=2, backoff=0.001)
+        try:
+            results = [await client.synthesize(f"Request {i}", 'en') for i in range(10)]
+            # A retried upload sends the whole file again
+            await client.upload_reference_file(reference, filename='reference.wav')
+            return results
+        finally:
+            await client.aclose()
+
+    assert all(asyncio.run(run()))
+    # The upload was the 20th request, so it failed once too
+    assert app.state.requests == 21
+    assert app.state.references['reference.wav'] >= os.path.getsize(reference)
+
+
+def test_speech_cache_saves_index_on_flush(tmp_path):
+    root = str(tmp_path / 'speech_cache')
+    cache = SpeechCache(root, save_interval=3600)
+    keys = [cache.key(1, 'en', f"Sentence {i}") for i in range(3)]
+    for key in keys:
+        cache.put(key, 1, b'ogg')
+        cache.set_file_id(key, f"file-{key}")
+    assert not os.path.exists(os.path.join(root, 'index.json'))
+
+    # A crash before the save leaves notes that the next start removes
+    cache = SpeechCache(root, save_interval=3600)
+    assert cache.stats()['entries'] == 0 and os.listdir(root) == []
+    for key in keys:
+        cache.put(key, 1, b'ogg')
+    cache.flush()
+    reloaded = SpeechCache(root)
+    assert [reloaded.read(key) for key in keys] == [b'ogg'] * 3
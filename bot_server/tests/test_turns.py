@@ -0,0 +1,85 @@
+import asyncio
+import os
+
+import pytest
+
+from fakes import text_update, voice_update, write_silence
+
+
+@pytest.mark.parametrize('kind', ['text', 'voice', 'voice-stream'])
+def test_turn_makes_one_llm_call_and_one_history_entry(fake_server, monkeypatch, kind):
+    server = fake_server
+    monkeypatch.setattr(server, 'STT_STREAMING', kind == 'voice-stream')
+    user_id = {'text': 1, 'voice': 2, 'voice-stream': 3}[kind]
+    voice_file = write_silence('data/voice.wav')
+
+    async def turns():
+        for message_id in range(1, 4):
+            if kind == 'text':
+                update = text_update(user_id, message_id, "Hello!")
+            else:
+                update = voice_update(user_id, message_id, voice_file)
+            await server.handle_message(update)
+
+    asyncio.run(turns())
+    assert server.llm.calls == 3
+    assert len(server.get_chat_history(str(user_id))) == 3 * 2
+    assert len(server.bot.replies[user_id]) >= 3
+
+
+def test_failed_stream_sends_nothing_after_the_error(fake_server, monkeypatch):
+    from fakes import FakeChatModel, FakeTTS
+
+    server = fake_server
+    # The first sentence is being synthesized when the stream breaks off
+    monkeypatch.setattr(server, 'llm', FakeChatModel(latency=0, fail_after=7))
+    monkeypatch.setattr(server, 'tts', FakeTTS(latency=0.2))
+    user_id = 4
+
+    async def turn():
+        await server.handle_message(text_update(user_id, 1, "Hello!"))
+        left = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        await asyncio.sleep(0.5)
+        return left
+
+    assert asyncio.run(turn()) == []
+    assert server.bot.replies[user_id] == ["Sorry, there was an error processing your message."]
+    assert server.bot.calls['sendVoice'] == 0
+    assert server.get_chat_history(str(user_id)) == []
+
+
+def test_concatenated_replies_are_cached_as_whole_notes(fake_server, monkeypatch):
+    server = fake_server
+    monkeypatch.setattr(server, 'TTS_STREAM_MODE', 'concat')
+    user_id = 5
+
+    async def turn(message_id, reply):
+        server.llm.reply = reply
+        await server.handle_message(text_update(user_id, message_id, "Hello!"))
+
+    asyncio.run(turn(1, "Hello there, nice to see you. How are you today?"))
+    # The repeat waits for the whole reply, the variant synthesizes its shared sentence after all
+    asyncio.run(turn(2, "Hello there, nice to see you. How are you today?"))
+    asyncio.run(turn(3, "Hello there, nice to see you. What is new with you?"))
+    assert server.tts.calls == 4
+    assert server.bot.calls['sendVoice'] == 3
+    assert all(name.endswith(('.ogg', '.json')) for name in os.listdir(server.speech_cache.root))
+
+
+def test_failed_voice_fetch_replies_and_stops_the_progress(fake_server, monkeypatch):
+    server = fake_server
+    user_id = 6
+
+    async def get_file(file_id):
+        raise ConnectionError("Bot API unreachable")
+
+    monkeypatch.setattr(server.bot, 'get_file', get_file)
+
+    async def turn():
+        await server.handle_message(voice_update(user_id, 1, write_silence('data/voice.wav')))
+        # Time for the progress task to send its last edit
+        await asyncio.sleep(0.1)
+        return [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+
+    assert asyncio.run(turn()) == []
+    assert server.bot.replies[user_id][-1] == "Sorry, there was an error processing the voice message."
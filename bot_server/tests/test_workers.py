@@ -0,0 +1,144 @@
+import asyncio
+import json
+import multiprocessing
+
+import pytest
+
+from history_tools import HistoryStore
+from queue_tools import FileLocks, JobQueue, MemoryBackend, RedisBackend
+
+PROCESSES = 4
+TURNS = 10
+
+
+def run_worker(workdir, turns):
+    """One server process: a job queue whose turns read and append the shared history"""
+    store = HistoryStore(str(workdir / 'users'), max_tokens=10 ** 9, shared=True)
+
+    async def run():
+        done = asyncio.Event()
+        finished = []
+
+        async def handle(payload):
+            try:
+                turns_before = store.read_turns('user')
+                # Time the LLM would take between reading the history and writing the turn
+                await asyncio.sleep(0.005)
+                store.append('user', payload['message_id'], [('user', json.dumps({'seen': len(turns_before)}))])
+            finally:
+                finished.append(payload['message_id'])
+                if len(finished) == turns:
+                    done.set()
+
+        queue = JobQueue(handle, workers=4, locks=FileLocks(str(workdir / 'locks')))
+        await queue.start()
+        for turn in range(turns):
+            message_id = f"{multiprocessing.current_process().pid}:{turn}"
+            await queue.submit('user', message_id, {'message_id': message_id})
+        await done.wait()
+        await queue.stop()
+        return queue.failed
+
+    if asyncio.run(run()):
+        raise SystemExit(1)
+
+
+def test_processes_take_turns_on_a_shared_history(tmp_path):
+    # Forked, so the children need not import this module
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=run_worker, args=(tmp_path, TURNS)) for _ in range(PROCESSES)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+    assert [process.exitcode for process in processes] == [0] * PROCESSES
+
+    seen = []
+    with open(tmp_path / 'users' / 'user' / 'history.jsonl', 'rb') as f:
+        for line in f:
+            seen.append(json.loads(json.loads(line)['messages'][0][1])['seen'])
+    # Every turn in the log, one at a time, each seeing all turns before it
+    assert sorted(seen) == list(range(PROCESSES * TURNS))
+
+
+def test_redis_jobs_run_after_a_restart():
+    fakeredis = pytest.importorskip('fakeredis')
+    pytest.importorskip('lupa')
+    redis_server = fakeredis.FakeServer()
+
+    def backend():
+        backend = RedisBackend()
+        backend._redis = fakeredis.FakeAsyncRedis(server=redis_server)
+        return backend
+
+    async def run():
+        # The first process queues jobs and dies while the first ones run
+        stuck = asyncio.Event()
+        queue = JobQueue(lambda payload: stuck.wait(), workers=2, backend=backend())
+        await queue.start()
+        for user_id in ('1', '2'):
+            for turn in range(3):
+                await queue.submit(user_id, f"{user_id}:{turn}", {'user': user_id, 'turn': turn})
+        await asyncio.sleep(0.05)
+        await queue.stop()
+        # A count that also lost track of the lists
+        await queue.backend._redis.set('echobridge:size', 10)
+
+        handled = []
+        done = asyncio.Event()
+
+        async def handle(payload):
+            handled.append((payload['user'], payload['turn']))
+            if len(handled) == 4:
+                done.set()
+
+        queue = JobQueue(handle, workers=2, maxsize=5, backend=backend())
+        await queue.start()
+        assert queue.depth == 4
+        await asyncio.wait_for(done.wait(), 5)
+        # Idle workers, so stopping doesn't cut off a Redis call
+        await asyncio.sleep(0.05)
+        await queue.stop()
+        return handled, await queue.backend.size()
+
+    handled, size = asyncio.run(run())
+    assert sorted(handled) == [('1', 1), ('1', 2), ('2', 1), ('2', 2)]
+    assert size == 0
+
+
+class FlakyBackend(MemoryBackend):
+    """Memory backend whose first pop fails, like a dropped Redis connection"""
+
+    def __init__(self):
+        super().__init__()
+        self.failures = 1
+
+    async def pop(self, user_id):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("Connection reset by peer")
+        return await super().pop(user_id)
+
+
+def test_worker_survives_a_backend_error():
+    async def run():
+        handled = []
+        done = asyncio.Event()
+
+        async def handle(payload):
+            handled.append(payload)
+            if len(handled) == 3:
+                done.set()
+
+        # One worker, so the one that hit the error has to run every job
+        queue = JobQueue(handle, workers=1, backend=FlakyBackend(), retry_delay=0.01)
+        await queue.start()
+        for turn in range(3):
+            await queue.submit('1', f"{turn}", turn)
+        await asyncio.wait_for(done.wait(), 5)
+        await queue.stop()
+        return handled, queue.stats()
+
+    handled, stats = asyncio.run(run())
+    assert handled == [0, 1, 2]
+    assert stats['errors'] == 1 and stats['depth'] == 0
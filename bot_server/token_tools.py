@@ -0,0 +1,65 @@
+import functools
+import logging
+from typing import List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Context window sizes of the chat models the bot can be configured with
+MODEL_CONTEXT_TOKENS = {
+    'gpt-4': 8192,
+    'gpt-4-turbo': 128000,
+    'gpt-4o': 128000,
+    'gpt-4o-mini': 128000,
+    'gpt-3.5-turbo': 16385
+}
+# Tokens left free for the completion when no budget is configured
+REPLY_RESERVE_TOKENS = 1024
+# Role and separator tokens OpenAI chat formatting adds to every message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str):
+    """Returns the cached tiktoken encoding for a model, None if unavailable."""
+    try:
+        import tiktoken
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding('cl100k_base')
+    except Exception as e:
+        # tiktoken missing, or its BPE file can't be downloaded
+        logger.warning(f"No tokenizer for {model}, estimating token counts: {e}")
+        return None
+
+
+def count_tokens(text: str, model: str = 'gpt-4') -> int:
+    encoding = get_encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages: List[Tuple[str, str]], model: str = 'gpt-4') -> int:
+    """Tokens that (role, text) messages take in a chat prompt."""
+    return sum(MESSAGE_OVERHEAD_TOKENS + count_tokens(text, model) for _, text in messages)
+
+
+def prompt_budget(model: str, budgets: dict = None) -> int:
+    """Prompt token budget of a model: configured value, or its context window minus a reply reserve."""
+    if budgets and model in budgets:
+        return budgets[model]
+    return MODEL_CONTEXT_TOKENS.get(model, 8192) - REPLY_RESERVE_TOKENS
+
+
+def select_history(turns: List[dict], budget: int) -> Tuple[List[dict], List[dict]]:
+    """
+    Splits history turns into (older, window), where window is the longest
+    run of newest turns whose precomputed token counts fit the budget.
+    """
+    used = 0
+    start = len(turns)
+    while start > 0 and used + turns[start - 1]['tokens'] <= budget:
+        start -= 1
+        used += turns[start]['tokens']
+    return turns[:start], turns[start:]
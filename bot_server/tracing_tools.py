@@ -0,0 +1,205 @@
+import contextlib
+import contextvars
+import functools
+import logging
+import queue
+import random
+import threading
+import time
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+@functools.lru_cache(maxsize=None)
+def turn_trace_class():
+    """TurnTrace, defined on first use so importing this module doesn't load LangChain"""
+    from langchain_core.tracers.base import BaseTracer
+
+    class TurnTrace(BaseTracer):
+        """
+        LangChain runs of one turn, collected in memory. Nothing leaves the
+        process while the turn runs; the Tracer decides at the end whether
+        the runs are exported at all.
+        """
+
+        # Recording is cheap, so callbacks run in the event loop instead of a thread each
+        run_inline = True
+
+        def __init__(self, metadata: dict = None):
+            super().__init__()
+            self.metadata = metadata or {}
+            self.roots = []
+            self.failed = False
+
+        def _persist_run(self, run):
+            # Called once per finished root run, with its child runs attached
+            self.roots.append(run)
+
+    return TurnTrace
+
+
+def _walk(run):
+    yield run
+    for child in run.child_runs:
+        yield from _walk(child)
+
+
+class Tracer:
+    """
+    Tail-sampled LangSmith export. Every turn is recorded in memory, then a
+    sample_rate share of turns is kept, plus every failed turn and every
+    turn slower than slow_seconds. Kept turns go through a bounded queue to
+    one background thread, and are dropped when the queue is full, so a slow
+    or unreachable collector never holds up a reply.
+    The LangSmith client is created by the export thread on first use.
+    """
+
+    def __init__(self, api_key: str = None, api_url: str = 'https://api.smith.langchain.com',
+                 project: str = None, sample_rate: float = 0.1, errors: bool = True,
+                 slow_seconds: float = 30.0, queue_size: int = 100, client=None):
+        self.api_key = api_key
+        self.api_url = api_url
+        self.project = project
+        self.sample_rate = sample_rate
+        self.errors = errors
+        self.slow_seconds = slow_seconds
+        self.client = client
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.turns = 0
+        self.sampled = 0
+        self.failed_kept = 0
+        self.slow_kept = 0
+        self.exported = 0
+        self.dropped = 0
+        self.export_errors = 0
+
+    def keep(self, trace, seconds: float) -> bool:
+        """Tail sampling decision for a finished turn"""
+        if trace.failed and self.errors:
+            self.failed_kept += 1
+            return True
+        if self.slow_seconds is not None and seconds >= self.slow_seconds:
+            self.slow_kept += 1
+            return True
+        if random.random() < self.sample_rate:
+            self.sampled += 1
+            return True
+        return False
+
+    def finish(self, trace, seconds: float) -> None:
+        """Queues the turn's runs for export if it is kept, never blocks"""
+        self.turns += 1
+        if not trace.roots or not self.keep(trace, seconds):
+            return
+        self._start()
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._export_loop, name='trace-export', daemon=True)
+                self._thread.start()
+
+    def _connect(self):
+        if self.client is None:
+            from langsmith import Client
+            # Posted from this thread, not through the client's own unbounded batch queue
+            self.client = Client(api_url=self.api_url, api_key=self.api_key, auto_batch_tracing=False)
+        return self.client
+
+    def _export(self, trace) -> None:
+        client = self._connect()
+        for root in trace.roots:
+            for run in _walk(root):
+                extra = dict(run.extra or {})
+                extra['metadata'] = {**extra.get('metadata', {}), **trace.metadata}
+                client.create_run(
+                    name=run.name,
+                    inputs=run.inputs,
+                    run_type=run.run_type,
+                    id=run.id,
+                    parent_run_id=run.parent_run_id,
+                    trace_id=run.trace_id,
+                    dotted_order=run.dotted_order,
+                    start_time=run.start_time,
+                    end_time=run.end_time,
+                    outputs=run.outputs,
+                    error=run.error,
+                    extra=extra,
+                    tags=run.tags,
+                    project_name=self.project
+                )
+
+    def _export_loop(self):
+        while True:
+            trace = self._queue.get()
+            if trace is None:
+                return
+            try:
+                self._export(trace)
+                self.exported += 1
+            except Exception as e:
+                self.export_errors += 1
+                logger.warning(f"Failed to export a trace to LangSmith: {e}")
+
+    def close(self, timeout: float = 5.0) -> None:
+        """Exports what is queued within timeout, the rest is dropped"""
+        if self._thread is None:
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+    def stats(self) -> dict:
+        return {
+            'turns': self.turns,
+            'sampled': self.sampled,
+            'failed_kept': self.failed_kept,
+            'slow_kept': self.slow_kept,
+            'queued': self._queue.qsize(),
+            'exported': self.exported,
+            'dropped': self.dropped,
+            'export_errors': self.export_errors
+        }
+
+
+@contextlib.contextmanager
+def trace_turn(tracer: Optional[Tracer], **metadata):
+    """Records the LangChain runs of the block as one turn, handed to tracer at the end"""
+    if tracer is None:
+        yield None
+        return
+    trace = turn_trace_class()(metadata)
+    token = _current_trace.set(trace)
+    started = time.perf_counter()
+    try:
+        yield trace
+    except BaseException:
+        trace.failed = True
+        raise
+    finally:
+        _current_trace.reset(token)
+        tracer.finish(trace, time.perf_counter() - started)
+
+
+def callbacks() -> List:
+    """Callbacks for LangChain calls of the current turn, none when it isn't traced"""
+    trace = _current_trace.get()
+    return [trace] if trace is not None else []
+
+
+def mark_failed():
+    """Keeps the current turn's trace as failed, for errors that are handled"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.failed = True
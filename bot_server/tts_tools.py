@@ -1,41 +1,31 @@
-import requests
+import asyncio
+import functools
+import hashlib
+import json
+import logging
+import httpx
+import io
 import os
+import re
+import threading
 import time
+import unicodedata
 import uuid
+from collections import Counter, OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Audio files of the speech cache, named by their key
+SPEECH_FILE_NAME = re.compile(r'^[0-9a-f]{64}\.ogg$')
+
+
+@functools.lru_cache(maxsize=None)
+def default_client(api_url):
+    """Shared TTSClient per server URL for the module-level helpers"""
+    return TTSClient(api_url)
 
 def generate_speech(text, language, reference_file='asmr_0.wav', api_url="http://localhost:5000"):
-    # Request payload
-    payload = {
-        'text': text,
-        'language': language,
-        'reference_file': reference_file
-    }
-    
-    try:
-        # Send POST request
-        response = requests.post(f"{api_url}/tts", json=payload)
-        
-        # Check if request was successful
-        if response.status_code == 200:
-            # Create data directory if it doesn't exist
-            os.makedirs('data', exist_ok=True)
-            
-            # Generate unique filename using UUID
-            unique_id = str(uuid.uuid4())
-            output_filename = f'data/speech_{unique_id}.wav'
-            
-            # Save the audio file
-            with open(output_filename, 'wb') as f:
-                f.write(response.content)
-            print(f"Audio saved as {output_filename}")
-            return output_filename
-        else:
-            print(f"Error: {response.json().get('error', 'Unknown error')}")
-            return None
-            
-    except requests.exceptions.RequestException as e:
-        print(f"Connection error: {str(e)}")
-        return None
+    return default_client(api_url).generate_speech(text, language, reference_file)
 
 def upload_reference_file(file_path, api_url="http://localhost:5000", filename="reference.wav"):
     """
@@ -48,33 +38,554 @@ def upload_reference_file(file_path, api_url="http://localhost:5000", filename="
     Returns:
         dict: Server response
     """
+    return default_client(api_url).upload_reference_file(file_path, filename)
+
+def new_speech_filename():
+    """Unique path under data/ for a synthesized WAV file"""
+    # Create data directory if it doesn't exist
+    os.makedirs('data', exist_ok=True)
+    return f'data/speech_{uuid.uuid4()}.wav'
+
+def _open_reference(source):
+    """Binary file object for a reference given as a path or as bytes"""
+    if isinstance(source, (bytes, bytearray)):
+        return io.BytesIO(source)
     # Check if file exists
-    if not os.path.exists(file_path):
-        raise FileNotFoundError(f"File not found: {file_path}")
-    
-    # Prepare the file and filename for upload
-    files = {
-        'file': open(file_path, 'rb')
-    }
-    
-    data = {
-        'filename': filename
-    }
-    
-    try:
-        response = requests.post(
-            f"{api_url}/upload_reference",
-            files=files,
-            data=data
-        )
-        response.raise_for_status()
-        return response.json()
-    
-    except requests.exceptions.RequestException as e:
-        print(f"Error uploading file: {str(e)}")
-        raise
-    finally:
-        files['file'].close()
+    if not os.path.exists(source):
+        raise FileNotFoundError(f"File not found: {source}")
+    return open(source, 'rb')
+
+class TTSError(Exception):
+    """Raised when the TTS server rejects a request or stays unreachable"""
+
+class _TTSClientBase:
+    """Settings and retry policy shared by the sync and async TTS clients"""
+
+    # Connection failures worth retrying; read timeouts are not, the server may still be synthesizing
+    RETRY_EXCEPTIONS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError, httpx.PoolTimeout)
+
+    def __init__(self, api_url="http://localhost:5000", connect_timeout=5.0, read_timeout=120.0,
+                 retries=2, backoff=0.5, pool_size=10):
+        self.api_url = api_url
+        self.retries = retries
+        self.backoff = backoff
+        self._timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self._limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+
+    def _delay(self, attempt):
+        return self.backoff * 2 ** attempt
+
+    def _should_retry(self, attempt, response=None, error=None):
+        if attempt >= self.retries:
+            return False
+        if error is not None:
+            return isinstance(error, self.RETRY_EXCEPTIONS)
+        return response.status_code >= 500
+
+    @staticmethod
+    def _rewind(kwargs):
+        # A retried upload has to send the file from the start again
+        for _, file, _ in (kwargs.get('files') or {}).values():
+            file.seek(0)
+
+    @staticmethod
+    def _error_message(response):
+        try:
+            return response.json().get('error', 'Unknown error')
+        except ValueError:
+            return response.text or 'Unknown error'
+
+class TTSClient(_TTSClientBase):
+    """
+    TTS server client with a keep-alive connection pool, connect/read timeouts
+    and bounded retries with exponential backoff on 5xx and connection errors.
+    Synthesized audio is streamed straight to disk.
+    """
+
+    def __init__(self, api_url="http://localhost:5000", **kwargs):
+        super().__init__(api_url, **kwargs)
+        self._client = httpx.Client(base_url=api_url, timeout=self._timeout, limits=self._limits)
+
+    def _request(self, method, path, **kwargs):
+        """Sends a request with retries and returns the open streamed response"""
+        attempt = 0
+        while True:
+            try:
+                self._rewind(kwargs)
+                request = self._client.build_request(method, path, **kwargs)
+                response = self._client.send(request, stream=True)
+            except httpx.HTTPError as e:
+                if not self._should_retry(attempt, error=e):
+                    raise TTSError(f"TTS server unreachable: {e}") from e
+                logger.warning(f"TTS {path} failed ({e}), retrying")
+            else:
+                if not self._should_retry(attempt, response=response):
+                    return response
+                response.close()
+                logger.warning(f"TTS {path} returned {response.status_code}, retrying")
+            time.sleep(self._delay(attempt))
+            attempt += 1
+
+    def generate_speech(self, text, language, reference_file='asmr_0.wav'):
+        """Synthesize text with the voice of reference_file, returns the WAV path or None on failure"""
+        payload = {
+            'text': text,
+            'language': language,
+            'reference_file': reference_file
+        }
+        output_filename = None
+        try:
+            response = self._request('POST', '/tts', json=payload)
+            try:
+                if response.status_code != 200:
+                    response.read()
+                    logger.error(f"TTS error: {self._error_message(response)}")
+                    return None
+                output_filename = new_speech_filename()
+                with open(output_filename, 'wb') as f:
+                    for chunk in response.iter_bytes():
+                        f.write(chunk)
+            finally:
+                response.close()
+            logger.info(f"Audio saved as {output_filename}")
+            return output_filename
+        except (TTSError, httpx.HTTPError) as e:
+            logger.error(f"TTS connection error: {e}")
+            if output_filename and os.path.exists(output_filename):
+                os.remove(output_filename)
+            return None
+
+    def synthesize(self, text, language, reference_file='asmr_0.wav'):
+        """Synthesize text with the voice of reference_file, returns the WAV bytes or None on failure"""
+        payload = {
+            'text': text,
+            'language': language,
+            'reference_file': reference_file
+        }
+        try:
+            response = self._request('POST', '/tts', json=payload)
+            try:
+                audio = response.read()
+            finally:
+                response.close()
+        except (TTSError, httpx.HTTPError) as e:
+            logger.error(f"TTS connection error: {e}")
+            return None
+        if response.status_code != 200:
+            logger.error(f"TTS error: {self._error_message(response)}")
+            return None
+        return audio
+
+    def upload_reference_file(self, file_path, filename="reference.wav"):
+        """
+        Upload a reference audio file to the TTS server, given as a path
+        (streamed from disk) or as bytes. Returns the server response
+        """
+        with _open_reference(file_path) as f:
+            response = self._request(
+                'POST', '/upload_reference',
+                files={'file': (filename, f, 'audio/wav')},
+                data={'filename': filename}
+            )
+        try:
+            response.read()
+            if response.status_code != 200:
+                raise TTSError(f"Reference upload failed: {self._error_message(response)}")
+            return response.json()
+        finally:
+            response.close()
+
+    def close(self):
+        self._client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class AsyncTTSClient(_TTSClientBase):
+    """Async variant of TTSClient with the same interface"""
+
+    def __init__(self, api_url="http://localhost:5000", **kwargs):
+        super().__init__(api_url, **kwargs)
+        self._client = httpx.AsyncClient(base_url=api_url, timeout=self._timeout, limits=self._limits)
+
+    async def _request(self, method, path, **kwargs):
+        """Sends a request with retries and returns the open streamed response"""
+        attempt = 0
+        while True:
+            try:
+                self._rewind(kwargs)
+                request = self._client.build_request(method, path, **kwargs)
+                response = await self._client.send(request, stream=True)
+            except httpx.HTTPError as e:
+                if not self._should_retry(attempt, error=e):
+                    raise TTSError(f"TTS server unreachable: {e}") from e
+                logger.warning(f"TTS {path} failed ({e}), retrying")
+            else:
+                if not self._should_retry(attempt, response=response):
+                    return response
+                await response.aclose()
+                logger.warning(f"TTS {path} returned {response.status_code}, retrying")
+            await asyncio.sleep(self._delay(attempt))
+            attempt += 1
+
+    async def warmup(self):
+        """Opens a pooled connection to the TTS server, any answer will do"""
+        response = await self._client.get('/')
+        await response.aclose()
+
+    async def generate_speech(self, text, language, reference_file='asmr_0.wav'):
+        """Synthesize text with the voice of reference_file, returns the WAV path or None on failure"""
+        payload = {
+            'text': text,
+            'language': language,
+            'reference_file': reference_file
+        }
+        output_filename = None
+        try:
+            response = await self._request('POST', '/tts', json=payload)
+            try:
+                if response.status_code != 200:
+                    await response.aread()
+                    logger.error(f"TTS error: {self._error_message(response)}")
+                    return None
+                output_filename = new_speech_filename()
+                with open(output_filename, 'wb') as f:
+                    async for chunk in response.aiter_bytes():
+                        f.write(chunk)
+            finally:
+                await response.aclose()
+            logger.info(f"Audio saved as {output_filename}")
+            return output_filename
+        except (TTSError, httpx.HTTPError) as e:
+            logger.error(f"TTS connection error: {e}")
+            if output_filename and os.path.exists(output_filename):
+                os.remove(output_filename)
+            return None
+
+    async def synthesize(self, text, language, reference_file='asmr_0.wav'):
+        """Synthesize text with the voice of reference_file, returns the WAV bytes or None on failure"""
+        payload = {
+            'text': text,
+            'language': language,
+            'reference_file': reference_file
+        }
+        try:
+            response = await self._request('POST', '/tts', json=payload)
+            try:
+                audio = await response.aread()
+            finally:
+                await response.aclose()
+        except (TTSError, httpx.HTTPError) as e:
+            logger.error(f"TTS connection error: {e}")
+            return None
+        if response.status_code != 200:
+            logger.error(f"TTS error: {self._error_message(response)}")
+            return None
+        return audio
+
+    async def upload_reference_file(self, file_path, filename="reference.wav"):
+        """
+        Upload a reference audio file to the TTS server, given as a path
+        (streamed from disk) or as bytes. Returns the server response
+        """
+        with _open_reference(file_path) as f:
+            response = await self._request(
+                'POST', '/upload_reference',
+                files={'file': (filename, f, 'audio/wav')},
+                data={'filename': filename}
+            )
+        try:
+            await response.aread()
+            if response.status_code != 200:
+                raise TTSError(f"Reference upload failed: {self._error_message(response)}")
+            return response.json()
+        finally:
+            await response.aclose()
+
+    async def aclose(self):
+        await self._client.aclose()
+
+class SentenceSplitter:
+    """
+    Cuts streamed LLM text into sentences as soon as they are complete,
+    so each one can be synthesized while the rest is still generating.
+    Fragments shorter than min_chars are joined with the next sentence.
+    """
+
+    # A dot needs trailing whitespace to end a sentence ("3.5" does not),
+    # CJK full stops end it right away
+    BOUNDARY = re.compile(r'(?<=[.!?…])\s+|(?<=[。！？])|\n+')
+
+    def __init__(self, min_chars=20):
+        self.min_chars = min_chars
+        self._buffer = ''
+        self._carry = ''
+
+    def _emit(self, parts):
+        sentences = []
+        for part in parts:
+            part = part.strip()
+            if not part:
+                continue
+            self._carry = f"{self._carry} {part}" if self._carry else part
+            if len(self._carry) >= self.min_chars:
+                sentences.append(self._carry)
+                self._carry = ''
+        return sentences
+
+    def feed(self, text):
+        """Adds streamed text, returns the sentences it completed"""
+        self._buffer += text
+        parts = self.BOUNDARY.split(self._buffer)
+        # The last part may still be growing
+        self._buffer = parts.pop()
+        return self._emit(parts)
+
+    def flush(self):
+        """Returns whatever is left once the stream ended"""
+        sentences = self._emit([self._buffer])
+        self._buffer = ''
+        if self._carry:
+            sentences.append(self._carry)
+            self._carry = ''
+        return sentences
+
+def normalize_speech_text(text):
+    """Text as far as synthesis is concerned: NFC, single spaces, no outer whitespace"""
+    return unicodedata.normalize('NFC', ' '.join(text.split()))
+
+def reference_hash(audio):
+    """Content hash identifying a reference voice"""
+    return hashlib.sha256(audio).hexdigest()
+
+class SpeechCache:
+    """
+    Disk-backed cache of final OGG/Opus voice notes, keyed by reference
+    voice, language and normalized text, evicted least recently used once
+    it exceeds max_bytes. Also remembers the Telegram file_id of each
+    cached note, so it can be sent again without an upload. A note joined
+    from several sentences keeps their keys as parts, so a reply that is
+    probably cached can wait before synthesizing them.
+    The index is kept in memory and saved to index.json at most every
+    save_interval seconds while it changes, and by flush() on shutdown;
+    LRU order from hits alone is not saved. Notes stored after the last save
+    are removed on the next start, a new reference voice is saved at once.
+    """
+
+    INDEX_NAME = 'index.json'
+
+    def __init__(self, root='data/speech_cache', max_bytes=256 * 2 ** 20, save_interval=5.0):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.save_interval = save_interval
+        self._dirty = False
+        self._saved_at = time.monotonic()
+        self._entries = OrderedDict()  # key -> {'size', 'reference', 'file_id'[, 'parts']}
+        self._parts = Counter()  # sentence key -> cached notes joined from it
+        self._references = {}  # user_id -> reference id
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.file_id_hits = 0
+        self.stores = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # Create cache directory if it doesn't exist
+        os.makedirs(root, exist_ok=True)
+        self._load_index()
+
+    def _path(self, key):
+        return os.path.join(self.root, f"{key}.ogg")
+
+    def _load_index(self):
+        index = {}
+        try:
+            with open(os.path.join(self.root, self.INDEX_NAME), 'r') as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            logger.error(f"Speech cache index unreadable, starting empty: {e}")
+        self._references = index.get('references', {})
+        for key, entry in index.get('entries', []):
+            # Files may have been removed behind the cache's back
+            if os.path.exists(self._path(key)):
+                self._entries[key] = entry
+                self._bytes += entry['size']
+                self._parts.update(entry.get('parts', ()))
+        # Notes stored after the last save, their entries died with the process
+        indexed = {f"{key}.ogg" for key in self._entries}
+        for name in os.listdir(self.root):
+            if SPEECH_FILE_NAME.match(name) and name not in indexed:
+                try:
+                    os.remove(os.path.join(self.root, name))
+                except FileNotFoundError:
+                    pass
+
+    def _save_index(self):
+        index = {'references': self._references, 'entries': list(self._entries.items())}
+        tmp_path = os.path.join(self.root, f"{self.INDEX_NAME}.tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, os.path.join(self.root, self.INDEX_NAME))
+        self._dirty = False
+        self._saved_at = time.monotonic()
+
+    def _changed(self):
+        """Marks the index changed, saving it if the last save is save_interval old"""
+        self._dirty = True
+        if time.monotonic() - self._saved_at >= self.save_interval:
+            self._save_index()
+
+    def flush(self):
+        """Saves the index if it changed since the last save"""
+        with self._lock:
+            if self._dirty:
+                self._save_index()
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry['size']
+        for part in entry.get('parts', ()):
+            self._parts[part] -= 1
+            if not self._parts[part]:
+                del self._parts[part]
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def reference(self, user_id):
+        """Reference id of a user's voice: its content hash once uploaded through the cache"""
+        return self._references.get(str(user_id), f"user:{user_id}")
+
+    def key(self, user_id, language, text):
+        """Cache key of a text spoken in the user's voice"""
+        material = f"{self.reference(user_id)}\n{language}\n{normalize_speech_text(text)}"
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def entry(self, key):
+        """Entry of a cached note or None, without counting a lookup"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return dict(entry) if entry else None
+
+    def lookup(self, key):
+        """Entry of a cached note or None, counted as a hit or miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return dict(entry)
+
+    def covers(self, key):
+        """Whether a sentence is a cached note or part of one, without counting a lookup"""
+        return key in self._parts or key in self._entries
+
+    def read(self, key):
+        """OGG bytes of a cached note, None if it is gone"""
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            with self._lock:
+                if key in self._entries:
+                    self._drop(key)
+                    self._changed()
+            return None
+
+    def evict(self, bytes_needed=0, files_needed=0):
+        """Drops least recently used notes until both amounts are freed, returns (bytes, files) freed"""
+        freed_bytes = freed_files = 0
+        with self._lock:
+            while self._entries and (freed_bytes < bytes_needed or freed_files < files_needed):
+                key = next(iter(self._entries))
+                freed_bytes += self._entries[key]['size']
+                freed_files += 1
+                self._drop(key)
+                self.evictions += 1
+            if freed_files:
+                self._changed()
+        return freed_bytes, freed_files
+
+    def put(self, key, user_id, ogg, parts=()):
+        """Stores a note spoken in the user's voice, evicting the least recently used"""
+        if len(ogg) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            tmp_path = f"{self._path(key)}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(ogg)
+            os.replace(tmp_path, self._path(key))
+            self._entries[key] = {'size': len(ogg), 'reference': self.reference(user_id), 'file_id': None}
+            if parts:
+                self._entries[key]['parts'] = list(parts)
+                self._parts.update(parts)
+            self._bytes += len(ogg)
+            self.stores += 1
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+            self._changed()
+
+    def set_file_id(self, key, file_id):
+        """Remembers (or with None forgets) the Telegram file_id a note was sent as"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry['file_id'] == file_id:
+                return
+            entry['file_id'] = file_id
+            self._changed()
+
+    def count_file_id_hit(self):
+        with self._lock:
+            self.file_id_hits += 1
+
+    def set_reference(self, user_id, audio):
+        """
+        Records the reference voice a user just uploaded and drops the notes
+        spoken in the voice it replaces. Returns the number of notes dropped.
+        """
+        user_id = str(user_id)
+        with self._lock:
+            old = self.reference(user_id)
+            new = reference_hash(audio)
+            self._references[user_id] = new
+            dropped = 0
+            # Another user may have uploaded the very same voice
+            if old != new and old not in self._references.values():
+                for key in [key for key, entry in self._entries.items() if entry['reference'] == old]:
+                    self._drop(key)
+                    dropped += 1
+            self.invalidations += dropped
+            self._save_index()
+        if dropped:
+            logger.info(f"Dropped {dropped} cached notes of user {user_id}'s previous voice")
+        return dropped
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self._bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            'file_id_hits': self.file_id_hits,
+            'stores': self.stores,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations
+        }
 
 if __name__ == "__main__":
     url = 'https://d676-5-178-149-227.ngrok-free.app'
@@ -83,4 +594,4 @@ if __name__ == "__main__":
     language = 'ru'
     reference_file = 'kompot.wav'
     # Generate speech
-    generate_speech(url, text, language, reference_file)
+    generate_speech(text, language, reference_file, api_url=url)